@@ -0,0 +1,83 @@
+# admin.py
+# Команды оператора сервера "Башни Забытого Пламени" (сервер запущен с --admin-token):
+# подключается соединением оператора (hello с паролем в "admin") — в мир такое
+# соединение не входит и в запись сессии не попадает, — отправляет admin и печатает ответ.
+#
+#   python admin.py 127.0.0.1 5000 --token СЕКРЕТ            # профиль тика
+#   python admin.py 127.0.0.1 5000 --token СЕКРЕТ --reset    # обнулить гистограммы
+import argparse
+import json
+import socket
+import sys
+
+from netproto import FrameReader, encode_json_line
+
+COLUMNS = ("n", "p50_ms", "p95_ms", "p99_ms", "max_ms")
+
+
+def request(host, port, token, action, timeout):
+    """Ответ сервера на admin-команду (словарь admin или error)."""
+    sock = socket.create_connection((host, port), timeout=timeout)
+    reader = FrameReader()
+    try:
+        sock.sendall(encode_json_line({"type": "hello", "admin": token}) +
+                     encode_json_line({"type": "command", "command": "admin", "action": action}))
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                # неверный пароль или сервер без --admin-token: соединение просто закрывают
+                raise ConnectionError("сервер закрыл соединение (неверный пароль?)")
+            reader.feed(data)
+            while True:
+                msg = reader.next_message()
+                if msg is None:
+                    break
+                if msg.get("type") in ("admin", "error"):
+                    return msg
+    finally:
+        sock.close()
+
+
+def print_table(title, rows):
+    print(f"\n{title:<28}" + "".join(f"{c:>10}" for c in COLUMNS))
+    # сначала самые долгие по p99
+    for name, row in sorted(rows.items(), key=lambda item: -item[1].get("p99_ms", 0.0)):
+        print(f"{name:<28}" + "".join(f"{row.get(c, 0):>10}" for c in COLUMNS))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Команды оператора «Башни Забытого Пламени»")
+    parser.add_argument("host", nargs="?", default="127.0.0.1")
+    parser.add_argument("port", nargs="?", type=int, default=5000)
+    parser.add_argument("--token", required=True, help="пароль оператора (--admin-token сервера)")
+    parser.add_argument("--reset", action="store_true", help="обнулить гистограммы профиля")
+    parser.add_argument("--json", action="store_true", help="напечатать ответ как есть, JSON")
+    parser.add_argument("--timeout", type=float, default=5.0, help="таймаут ответа, с")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    try:
+        msg = request(args.host, args.port, args.token,
+                      "profile_reset" if args.reset else "profile", args.timeout)
+    except OSError as e:
+        print(f"нет ответа от {args.host}:{args.port}: {e}", file=sys.stderr)
+        return 1
+    if msg.get("type") == "error":
+        print(f"ошибка: {msg.get('msg')}", file=sys.stderr)
+        return 1
+    if args.json:
+        print(json.dumps(msg, ensure_ascii=False, indent=2))
+    elif msg.get("action") == "profile":
+        profile = msg.get("profile") or {}
+        print(f"окно ~{msg.get('window_s', 0):.0f} с; тики: {msg.get('tick')}")
+        print_table("фаза", profile.get("phases") or {})
+        print_table("команда", profile.get("commands") or {})
+    else:
+        print("гистограммы обнулены")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
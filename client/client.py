@@ -4,13 +4,17 @@
 import pygame
 import socket
 import threading
-import json
 import sys
 import time
 import math
+from collections import deque
+
+from netproto import PROTO_JSON, PROTO_BINARY, FrameReader, encode_json_frame, encode_json_line
 
 SERVER_HOST = "79.174.82.250"
 SERVER_PORT = 5000
+# бинарные кадры (proto 2) вместо JSON-строк; False — JSON, удобно для отладки
+USE_BINARY_PROTOCOL = True
 
 WIDTH, HEIGHT = 1920, 1080
 tile = 64
@@ -23,7 +27,7 @@ ZOOM_MAX = 1.2
 ZOOM_STEP = 0.1
 zoom_factor = 1.0  # 1.0 = обычный масштаб
 
-MOVE_STEP = 0.15  # размер шага за один кадр при удержании клавиши
+PLAYER_SPEED = 9.0  # тайлов в секунду, должно совпадать с сервером
 
 pygame.init()
 
@@ -91,6 +95,19 @@ game_state = {
 
 network_socket = None
 network_running = False
+network_proto = PROTO_JSON  # переключается по welcome от сервера
+# в сокет пишут и главный цикл (команды), и поток сети (подтверждения снимков)
+send_lock = threading.Lock()
+
+# движение по состоянию ввода: серверу уходит только смена направления
+move_input_seq = 0
+move_input_dir = (0.0, 0.0)
+# вводы, которые сервер ещё не подтвердил: [seq, dx, dy, начало, конец или None]
+pending_inputs = deque(maxlen=256)
+
+# дельта-снимки: seq -> {"level": dict, "enemies": {id: dict}, "players": {id: dict}}
+SNAPSHOT_HISTORY = 64
+snapshots = {}
 
 # статус подключения
 connect_status_msg = ""
@@ -121,8 +138,13 @@ panel_dragging = False
 panel_drag_mouse_start = 0.0
 panel_drag_panel_start = 0.0
 
-# сглаживание (визуальное) движения врагов
-smooth_enemy_pos = {}
+# интерполяция чужих сущностей: рисуем их немного в прошлом, между двумя снимками
+INTERP_DELAY = 0.1        # секунд
+INTERP_HISTORY = 32       # сколько последних снимков помним
+# (время получения, этаж, {id врага: (x, y)}, {id игрока: (x, y)})
+position_history = deque(maxlen=INTERP_HISTORY)
+# позиции, в которых враги нарисованы в текущем кадре (для кликов мышью)
+render_enemy_pos = {}
 
 # камера: координаты верхнего левого угла видимой области (в тайлах)
 camera_x = 0.0
@@ -131,20 +153,33 @@ camera_y = 0.0
 
 def send_json(sock, obj):
     try:
-        data = json.dumps(obj, ensure_ascii=False) + "\n"
-        sock.sendall(data.encode("utf-8"))
+        if network_proto == PROTO_BINARY:
+            data = encode_json_frame(obj)
+        else:
+            data = encode_json_line(obj)
+        with send_lock:
+            sock.sendall(data)
     except Exception:
         pass
 
 
-def recv_json_line(fileobj):
-    line = fileobj.readline()
-    if not line:
-        return None
-    line = line.strip()
-    if not line:
-        return None
-    return json.loads(line)
+def recv_messages(sock, reader):
+    """Дочитывает из сокета и возвращает все целые сообщения; None — соединение закрыто."""
+    msgs = []
+    while not msgs:
+        data = sock.recv(65536)
+        if not data:
+            return None
+        reader.feed(data)
+        while True:
+            msg = reader.next_message()
+            if msg is None:
+                break
+            msgs.append(msg)
+            if msg.get("type") == "welcome" and msg.get("proto") == PROTO_BINARY:
+                # всё после welcome сервер шлёт бинарными кадрами
+                reader.binary = True
+    return msgs
 
 
 def add_message(text):
@@ -155,30 +190,61 @@ def add_message(text):
             del msgs[0]
 
 
-def network_listener(sock, fileobj):
+def merge_records(base, records, gone):
+    """Накладывает изменённые записи (полные или частичные) и удаления на словарь id -> запись."""
+    result = dict(base)
+    for rec in records:
+        rid = rec.get("id")
+        old = result.get(rid)
+        result[rid] = dict(old, **rec) if old else rec
+    for rid in gone:
+        result.pop(rid, None)
+    return result
+
+
+def apply_snapshot(msg):
+    """Собирает снимок из дельты и базового снимка. None — базы у нас нет."""
+    base_seq = msg.get("base")
+    if base_seq is None:
+        base = {"level": {}, "enemies": {}, "players": {}}
+    else:
+        base = snapshots.get(base_seq)
+        if base is None:
+            return None
+    snap = {
+        "level": dict(base["level"], **msg["level"]) if "level" in msg else base["level"],
+        "enemies": merge_records(base["enemies"], msg.get("enemies", []), msg.get("enemies_gone", [])),
+        "players": merge_records(base["players"], msg.get("players", []), msg.get("players_gone", [])),
+    }
+    seq = msg.get("seq", 0)
+    snapshots[seq] = snap
+    # сервер шлёт «последний побеждает» и номера пропускает — удаляем все
+    # устаревшие, а не ровно seq - SNAPSHOT_HISTORY (номера идут по возрастанию,
+    # значит и ключи словаря — в порядке вставки)
+    while snapshots:
+        oldest = next(iter(snapshots))
+        if oldest > seq - SNAPSHOT_HISTORY:
+            break
+        del snapshots[oldest]
+    return snap
+
+
+def network_listener(sock):
     global network_running
+    reader = FrameReader()
     try:
         while network_running:
-            msg = recv_json_line(fileobj)
-            if msg is None:
+            msgs = recv_messages(sock, reader)
+            if msgs is None:
                 add_message("Соединение с сервером потеряно.")
                 break
-            mtype = msg.get("type")
-            if mtype == "welcome":
-                add_message(msg.get("msg", "Добро пожаловать."))
-            elif mtype == "event":
-                add_message(msg.get("msg", ""))
-            elif mtype == "error":
-                add_message("[Ошибка] " + msg.get("msg", ""))
-            elif mtype == "state":
-                with state_lock:
-                    game_state["you"] = msg.get("you")
-                    game_state["level"] = msg.get("level")
-                    game_state["players"] = msg.get("players", [])
-            elif mtype == "attack":
-                handle_attack_message(msg)
-            else:
-                add_message(str(msg))
+            # сервер пишет всё за тик одной пачкой; подтверждение шлём одно,
+            # на последний снимок пачки — серверу важен только он
+            reply = None
+            for msg in msgs:
+                reply = handle_server_message(msg) or reply
+            if reply is not None:
+                send_json(sock, reply)
     except Exception as e:
         add_message(f"Ошибка сети: {e}")
     finally:
@@ -189,6 +255,40 @@ def network_listener(sock, fileobj):
             pass
 
 
+def handle_server_message(msg):
+    """Разбирает сообщение сервера; возвращает ответ серверу (ack/resync) или None."""
+    global network_proto
+    mtype = msg.get("type")
+    if mtype == "welcome":
+        network_proto = msg.get("proto", PROTO_JSON)
+        add_message(msg.get("msg", "Добро пожаловать."))
+    elif mtype == "event":
+        add_message(msg.get("msg", ""))
+    elif mtype == "error":
+        add_message("[Ошибка] " + msg.get("msg", ""))
+    elif mtype == "state":
+        with state_lock:
+            game_state["level"] = msg.get("level")
+            game_state["players"] = msg.get("players", [])
+            set_server_you(msg.get("you"))
+            record_positions(game_state["you"], game_state["level"], game_state["players"])
+    elif mtype == "snapshot":
+        snap = apply_snapshot(msg)
+        if snap is None:
+            # базовый снимок потерян — просим полный
+            return {"type": "resync"}
+        with state_lock:
+            game_state["level"] = dict(snap["level"], enemies=list(snap["enemies"].values()))
+            game_state["players"] = list(snap["players"].values())
+            set_server_you(msg.get("you"))
+            record_positions(game_state["you"], game_state["level"], game_state["players"])
+        return {"type": "ack", "seq": msg.get("seq")}
+    elif mtype == "attack":
+        handle_attack_message(msg)
+    else:
+        add_message(str(msg))
+
+
 def handle_attack_message(msg):
     """Создаём красивый эффект атаки в зависимости от класса/типа."""
     fx = msg.get("from_x", 0.0)
@@ -273,25 +373,110 @@ def send_command(command, **kwargs):
 
 
 
-def apply_local_move(dx, dy):
-    """Простое клиентское предсказание движения, чтобы сгладить лаги.
-    Обновляем только свои координаты локально, сервер остаётся источником истины."""
+def send_move_input(dx, dy):
+    """Сообщает серверу новое удерживаемое направление (единичный вектор или ноль).
+    Повторно одно и то же направление не шлём: сервер сам двигает игрока каждый тик."""
+    global move_input_seq, move_input_dir
+    if (dx, dy) == move_input_dir:
+        return
+    move_input_seq += 1
+    move_input_dir = (dx, dy)
+    now = time.time()
     with state_lock:
-        you = game_state.get("you")
-        level = game_state.get("level")
-        if not you or not level:
-            return
-        nx = you.get("x", 0.0) + dx
-        ny = you.get("y", 0.0) + dy
+        if pending_inputs:
+            pending_inputs[-1][4] = now
+        pending_inputs.append([move_input_seq, dx, dy, now, None])
+    send_command("input", dx=dx, dy=dy, seq=move_input_seq)
+
+
+def set_server_you(you):
+    """Принимает авторитетное состояние игрока от сервера (вызывать под state_lock)."""
+    if you:
+        you["server_x"] = you.get("x", 0.0)
+        you["server_y"] = you.get("y", 0.0)
+    game_state["you"] = you
+    predict_you(time.time())
+
+
+def record_positions(you, level, players):
+    """Запоминает позиции врагов и игроков из очередного снимка (под state_lock)."""
+    stage = you.get("stage") if you else None
+    if position_history and position_history[-1][1] != stage:
+        # сменили этаж — интерполировать со старым уровнем нечего
+        position_history.clear()
+    enemies = {e.get("id"): (e.get("x", 0.0), e.get("y", 0.0)) for e in (level or {}).get("enemies") or []}
+    others = {p.get("id"): (p.get("x", 0.0), p.get("y", 0.0)) for p in players or []}
+    position_history.append((time.time(), stage, enemies, others))
+
+
+def interpolated_positions(render_time):
+    """Позиции врагов и игроков на момент render_time по истории снимков.
+
+    Ищем два снимка вокруг render_time и линейно интерполируем между ними.
+    Вперёд не экстраполируем: если новее ничего нет, стоим на последнем снимке.
+    """
+    with state_lock:
+        history = list(position_history)
+    if not history:
+        return {}, {}
+    if render_time >= history[-1][0]:
+        return history[-1][2], history[-1][3]
+    older = history[0]
+    newer = history[0]
+    for entry in history:
+        if entry[0] > render_time:
+            newer = entry
+            break
+        older = entry
+    if newer is older:
+        return older[2], older[3]
+    span = newer[0] - older[0]
+    k = (render_time - older[0]) / span if span > 0 else 1.0
+
+    def lerp(old_map, new_map):
+        result = {}
+        for eid, (nx, ny) in new_map.items():
+            ox, oy = old_map.get(eid, (nx, ny))
+            result[eid] = (ox + (nx - ox) * k, oy + (ny - oy) * k)
+        return result
+
+    return lerp(older[2], newer[2]), lerp(older[3], newer[3])
+
+
+def predict_you(now):
+    """Клиентское предсказание со сверкой (вызывать под state_lock).
+
+    Берём позицию из последнего снимка сервера и заново проигрываем поверх неё
+    все вводы, которые сервер ещё не учёл: по текущему вводу (input_seq) сервер
+    уже прошёл input_time секунд, остаток и более поздние вводы доигрываем сами.
+    Так свежий снимок не откатывает игрока назад, а расхождения гасятся сами.
+    """
+    you = game_state.get("you")
+    level = game_state.get("level")
+    if not you or not level or "server_x" not in you:
+        return
+    seq = you.get("input_seq", 0)
+    while pending_inputs and pending_inputs[0][0] < seq:
+        pending_inputs.popleft()
+
+    x = you["server_x"]
+    y = you["server_y"]
+    cls = (you.get("class") or "").lower()
+    can_move = you.get("alive", True) and not (cls == "лучник" and you.get("archer_stance") == "ready")
+    if can_move:
         w = level.get("width", 20)
         h = level.get("height", 12)
-        # лёгкий клип по краям карты
-        if w > 0:
-            nx = max(0.0, min(w - 0.001, nx))
-        if h > 0:
-            ny = max(0.0, min(h - 0.001, ny))
-        you["x"] = nx
-        you["y"] = ny
+        for in_seq, dx, dy, start, end in pending_inputs:
+            dur = (end if end is not None else now) - start
+            if in_seq == seq:
+                dur -= you.get("input_time", 0.0)
+            if dur <= 0.0 or (dx == 0.0 and dy == 0.0):
+                continue
+            # как и сервер, упираемся в край карты на каждом отрезке
+            x = max(0.0, min(w - 1, x + dx * PLAYER_SPEED * dur))
+            y = max(0.0, min(h - 1, y + dy * PLAYER_SPEED * dur))
+    you["x"] = x
+    you["y"] = y
 
 
 def draw_text(surface, text, x, y, font, color=(255, 255, 255)):
@@ -686,21 +871,14 @@ def draw_game(screen, font, small_font):
             pygame.draw.circle(screen, color, (cx, cy), radius_px, width=3)
 
 
-    # рисуем врагов (сглаженное движение и разные формы)
-    global smooth_enemy_pos
-    current_ids = set()
+    # рисуем врагов (интерполяция между снимками и разные формы)
+    global render_enemy_pos
+    enemy_pos, player_pos = interpolated_positions(now_t - INTERP_DELAY)
+    render_enemy_pos = {}
     for e in enemies:
         eid = e.get("id")
-        current_ids.add(eid)
-        ex = e.get("x", 0.0)
-        ey = e.get("y", 0.0)
-
-        # сглаживание позиции (визуальное)
-        vx, vy = smooth_enemy_pos.get(eid, (ex, ey))
-        alpha = 0.35  # чем выше, тем быстрее "догоняет" реальное положение
-        vx += (ex - vx) * alpha
-        vy += (ey - vy) * alpha
-        smooth_enemy_pos[eid] = (vx, vy)
+        vx, vy = enemy_pos.get(eid, (e.get("x", 0.0), e.get("y", 0.0)))
+        render_enemy_pos[eid] = (vx, vy)
 
         etype = e.get("etype", "melee")
         is_boss = e.get("boss")
@@ -736,14 +914,14 @@ def draw_game(screen, font, small_font):
         if e.get("id") == selected_enemy_id:
             pygame.draw.rect(screen, (255, 255, 0), rect.inflate(4, 4), 2)
 
-    # чистим позиции врагов, которые исчезли
-    smooth_enemy_pos = {eid: pos for eid, pos in smooth_enemy_pos.items() if eid in current_ids}
-
     # рисуем игроков (разные формы)
     shield_outline_color = (120, 220, 255)
     for p in players:
-        px = p.get("x", 0.0)
-        py = p.get("y", 0.0)
+        if p.get("id") == you.get("id"):
+            # себя рисуем в предсказанной позиции, а не по снимку
+            px, py = you["x"], you["y"]
+        else:
+            px, py = player_pos.get(p.get("id"), (p.get("x", 0.0), p.get("y", 0.0)))
         alive = p.get("alive", True)
         cls = (p.get("class") or "").lower()
         base_color = CLASS_COLORS.get(cls, (60, 200, 80))
@@ -958,13 +1136,12 @@ def handle_mouse_click(pos):
     enemies = level.get("enemies", []) or []
 
     # сначала ищем врага (используем те же размеры, что и при отрисовке)
-    global smooth_enemy_pos
     clicked = False
     for e in enemies:
         eid = e.get("id")
         ex = e.get("x", 0.0)
         ey = e.get("y", 0.0)
-        vx, vy = smooth_enemy_pos.get(eid, (ex, ey))
+        vx, vy = render_enemy_pos.get(eid, (ex, ey))
         is_boss = e.get("boss")
         base_half = (tile - 8) // 2
         half_size = base_half * (3 if is_boss else 1)
@@ -1002,7 +1179,9 @@ def handle_mouse_click(pos):
 
 def connect_to_server(player_name, cls_name):
     """Функция, которая запускается в отдельном потоке."""
-    global network_socket, network_running, connect_status_msg, connect_attempt_in_progress, connect_success
+    global network_socket, network_running, network_proto
+    global move_input_seq, move_input_dir
+    global connect_status_msg, connect_attempt_in_progress, connect_success
     try:
         connect_status_msg = f"Подключение к серверу {SERVER_HOST}:{SERVER_PORT}..."
         sock = socket.create_connection((SERVER_HOST, SERVER_PORT), timeout=5)
@@ -1013,18 +1192,27 @@ def connect_to_server(player_name, cls_name):
         connect_attempt_in_progress = False
         return
 
-    f = sock.makefile("r", encoding="utf-8")
+    sock.settimeout(None)
+    snapshots.clear()
+    network_proto = PROTO_JSON
+    move_input_seq = 0
+    move_input_dir = (0.0, 0.0)
+    with state_lock:
+        pending_inputs.clear()
+        position_history.clear()
     hello = {
         "type": "hello",
         "name": player_name,
-        "class": cls_name
+        "class": cls_name,
+        "snapshots": True,
+        "proto": PROTO_BINARY if USE_BINARY_PROTOCOL else PROTO_JSON,
     }
     send_json(sock, hello)
     network_socket = sock
     network_running = True
     connect_success = True
     connect_status_msg = "Подключено. Ожидание данных от сервера..."
-    t = threading.Thread(target=network_listener, args=(sock, f), daemon=True)
+    t = threading.Thread(target=network_listener, args=(sock,), daemon=True)
     t.start()
     connect_attempt_in_progress = False
 
@@ -1199,14 +1387,16 @@ def main():
                 if cls_local == "лучник" and you_local.get("archer_stance", "move") == "ready":
                     can_move = False
 
-            if can_move and (dx != 0.0 or dy != 0.0):
-                length = math.hypot(dx, dy)
-                if length != 0.0:
-                    dx = dx / length * MOVE_STEP
-                    dy = dy / length * MOVE_STEP
-                    send_command("move", dx=dx, dy=dy)
-                    # локально предсказываем движение для плавности
-                    apply_local_move(dx, dy)
+            if not can_move:
+                dx = dy = 0.0
+            length = math.hypot(dx, dy)
+            if length != 0.0:
+                dx /= length
+                dy /= length
+            send_move_input(dx, dy)
+            # локально предсказываем движение для плавности
+            with state_lock:
+                predict_you(time.time())
 
 
             # проверка двери
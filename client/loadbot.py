@@ -0,0 +1,485 @@
+
+# loadbot.py
+# Нагрузочные боты для "Башни Забытого Пламени": сотни безголовых клиентов
+# в одном процессе говорят с сервером тем же протоколом, что client.py
+# (hello, затем command; снимки подтверждаются ack).
+#
+#   python loadbot.py 127.0.0.1 5000 --bots 300 --profiles idle=2,mover=1,attacker=2,healer=1,door=1
+import argparse
+import json
+import math
+import random
+import selectors
+import socket
+import sys
+import time
+
+from netproto import PROTO_JSON, PROTO_BINARY, FrameReader, encode_json_frame, encode_json_line
+
+CLASSES = ("воин", "лучник", "маг", "хилер")
+PROFILES = ("idle", "mover", "attacker", "healer", "door")
+PROTOS = ("binary", "json", "legacy")
+
+PROBE_INTERVAL = 1.0     # как часто idle-бот шлёт пустой input, чтобы мерить задержку
+MOVE_RATE = 60.0         # mover: новый ввод каждый кадр, как клиент на 60 FPS
+ATTACK_INTERVAL = 0.5    # attacker/healer/door: обычная атака (или быстрый хил)
+SPECIAL_INTERVAL = 5.0   # и спецспособность
+WALK_INTERVAL = 0.1      # как часто бот пересчитывает направление к цели
+DOOR_REACH = 0.5         # ближе этого к двери — пробуем войти
+LATENCY_KEEP = 20000     # сколько замеров задержки держим на профиль за окно отчёта
+
+
+class ProfileStats:
+    """Счётчики одного профиля за окно отчёта."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.started = time.monotonic()
+        self.commands = 0
+        self.frames = 0          # state/snapshot
+        self.bytes = 0
+        self.latencies = []      # секунды от input до state с его input_seq
+
+    def add_latency(self, value):
+        if len(self.latencies) < LATENCY_KEEP:
+            self.latencies.append(value)
+        else:
+            self.latencies[random.randrange(LATENCY_KEEP)] = value
+
+    def summary(self, bots):
+        window = max(time.monotonic() - self.started, 1e-9)
+        lat = sorted(self.latencies)
+
+        def pct(q):
+            if not lat:
+                return None
+            return round(1000 * lat[min(len(lat) - 1, int(q * len(lat)))], 1)
+
+        return {
+            "bots": bots,
+            "cmd_per_s": round(self.commands / window, 1),
+            "frames_per_s": round(self.frames / window, 1),
+            "frames_per_bot_s": round(self.frames / window / max(bots, 1), 2),
+            "kb_per_s": round(self.bytes / window / 1024, 1),
+            "latency_ms": {
+                "n": len(lat),
+                "p50": pct(0.50),
+                "p95": pct(0.95),
+                "p99": pct(0.99),
+                "max": round(1000 * lat[-1], 1) if lat else None,
+            },
+        }
+
+
+class Bot:
+    """Один безголовый игрок: сокет, разбор кадров и поведение профиля."""
+
+    def __init__(self, index, profile, cls_name, proto, stats):
+        self.name = f"bot{index}"
+        self.profile = profile
+        self.cls = cls_name
+        self.proto_mode = proto
+        self.stats = stats
+        self.sock = None
+        self.reader = FrameReader()
+        self.proto = PROTO_JSON
+        self.out = bytearray()
+        self.closed = False
+
+        # что бот знает о мире (из state/snapshot)
+        self.you = None
+        self.level = {}
+        self.enemies = {}        # id -> (x, y)
+        self.players = {}        # id -> alive
+
+        self.input_seq = 0
+        self.input_sent = {}     # seq -> время отправки
+        self.direction = (0.0, 0.0)
+        self.angle = random.uniform(0, 2 * math.pi)
+        self.next_action = 0.0
+        self.next_attack = 0.0
+        self.next_special = 0.0
+
+    # --- сеть ---
+
+    def connect(self, host, port):
+        self.sock = socket.create_connection((host, port), timeout=5)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.setblocking(False)
+        hello = {"type": "hello", "name": self.name, "class": self.cls}
+        if self.proto_mode != "legacy":
+            hello["snapshots"] = True
+            hello["proto"] = PROTO_BINARY if self.proto_mode == "binary" else PROTO_JSON
+        self.send(hello)
+
+    def send(self, obj):
+        if self.closed:
+            return
+        if self.proto == PROTO_BINARY:
+            self.out += encode_json_frame(obj)
+        else:
+            self.out += encode_json_line(obj)
+        self.flush()
+
+    def flush(self):
+        try:
+            while self.out:
+                sent = self.sock.send(self.out)
+                del self.out[:sent]
+        except BlockingIOError:
+            pass
+        except OSError:
+            self.closed = True
+
+    def command(self, command, **kwargs):
+        msg = {"type": "command", "command": command}
+        msg.update(kwargs)
+        self.stats.commands += 1
+        self.send(msg)
+
+    def send_input(self, dx, dy, now):
+        """input с новым seq; пришедший state с этим input_seq даёт замер задержки."""
+        self.input_seq += 1
+        self.input_sent[self.input_seq] = now
+        self.direction = (dx, dy)
+        self.command("input", dx=dx, dy=dy, seq=self.input_seq)
+
+    def on_readable(self):
+        try:
+            data = self.sock.recv(262144)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.closed = True
+            return
+        self.stats.bytes += len(data)
+        self.reader.feed(data)
+        reply = None
+        while True:
+            msg = self.reader.next_message()
+            if msg is None:
+                break
+            reply = self.handle(msg) or reply
+        # как client.py: одно подтверждение на пачку
+        if reply is not None:
+            self.send(reply)
+
+    def handle(self, msg):
+        mtype = msg.get("type")
+        if mtype == "welcome":
+            self.proto = msg.get("proto", PROTO_JSON)
+            if self.proto == PROTO_BINARY:
+                self.reader.binary = True
+        elif mtype == "state":
+            self.stats.frames += 1
+            level = msg.get("level") or {}
+            self.level = level
+            self.enemies = {e["id"]: (e["x"], e["y"]) for e in level.get("enemies") or []}
+            self.players = {p["id"]: p.get("alive", True) for p in msg.get("players") or []}
+            self.set_you(msg.get("you"))
+        elif mtype == "snapshot":
+            self.stats.frames += 1
+            if msg.get("base") is None:
+                self.level, self.enemies, self.players = {}, {}, {}
+            if "level" in msg:
+                self.level = dict(self.level, **msg["level"])
+            # в JSON-дельтах записи частичные (только изменившиеся поля):
+            # недостающее берём из прежней записи, как merge_records в client.py
+            for e in msg.get("enemies") or []:
+                old = self.enemies.get(e["id"])
+                if "x" in e and "y" in e:
+                    self.enemies[e["id"]] = (e["x"], e["y"])
+                elif old is not None:
+                    self.enemies[e["id"]] = (e.get("x", old[0]), e.get("y", old[1]))
+            for eid in msg.get("enemies_gone") or []:
+                self.enemies.pop(eid, None)
+            for p in msg.get("players") or []:
+                self.players[p["id"]] = p.get("alive", self.players.get(p["id"], True))
+            for pid in msg.get("players_gone") or []:
+                self.players.pop(pid, None)
+            self.set_you(msg.get("you"))
+            return {"type": "ack", "seq": msg.get("seq")}
+        return None
+
+    def set_you(self, you):
+        if not you:
+            return
+        if self.you is not None and you.get("stage") != self.you.get("stage"):
+            self.enemies.clear()
+        self.you = you
+        acked = you.get("input_seq", 0)
+        if acked and self.input_sent:
+            now = time.monotonic()
+            for seq in [s for s in self.input_sent if s <= acked]:
+                self.stats.add_latency(now - self.input_sent.pop(seq))
+
+    # --- поведение ---
+
+    def act(self, now):
+        """Очередной шаг профиля; возвращает время следующего."""
+        you = self.you
+        if you is None:
+            return now + 0.05
+        if self.profile == "idle":
+            self.send_input(0.0, 0.0, now)
+            return now + PROBE_INTERVAL
+        if self.profile == "mover":
+            self.wander(now)
+            return now + 1.0 / MOVE_RATE
+
+        if not you.get("alive", True):
+            if self.direction != (0.0, 0.0):
+                self.send_input(0.0, 0.0, now)
+            return now + 0.5
+        door = self.level.get("door") or {}
+        stage = you.get("stage", 0)
+        # в ХАБе все, кроме idle/mover, идут к двери; door-бегуны — на каждом открытом этаже,
+        # остальные — когда на этаже больше некого бить
+        if stage == 0 or (door.get("open") and (self.profile == "door" or not self.enemies)):
+            if self.walk_to_door(door, now):
+                return now + WALK_INTERVAL
+        if self.profile == "healer":
+            self.heal(now)
+        else:
+            self.fight(now)
+        return now + WALK_INTERVAL
+
+    def steer(self, tx, ty, now, stop=0.3):
+        x, y = self.you.get("x", 0.0), self.you.get("y", 0.0)
+        dx, dy = tx - x, ty - y
+        dist = math.hypot(dx, dy)
+        if dist <= stop:
+            direction = (0.0, 0.0)
+        else:
+            direction = (round(dx / dist, 3), round(dy / dist, 3))
+        if direction != self.direction:
+            self.send_input(direction[0], direction[1], now)
+        return dist
+
+    def walk_to_door(self, door, now):
+        """Идёт к открытой двери и входит; False — двери нет."""
+        if not door.get("open") or door.get("x") is None:
+            return False
+        dist = self.steer(door["x"], door["y"], now, stop=DOOR_REACH * 0.5)
+        if dist <= DOOR_REACH:
+            self.command("enter_door")
+        return True
+
+    def wander(self, now):
+        w = self.level.get("width", 20)
+        h = self.level.get("height", 12)
+        x, y = self.you.get("x", 0.0), self.you.get("y", 0.0)
+        if x < 1 or y < 1 or x > w - 2 or y > h - 2:
+            self.angle = math.atan2(h / 2 - y, w / 2 - x)
+        else:
+            self.angle += random.uniform(-0.3, 0.3)
+        self.send_input(round(math.cos(self.angle), 3), round(math.sin(self.angle), 3), now)
+
+    def fight(self, now):
+        if self.enemies:
+            x, y = self.you.get("x", 0.0), self.you.get("y", 0.0)
+            eid, (ex, ey) = min(self.enemies.items(),
+                                key=lambda item: (item[1][0] - x) ** 2 + (item[1][1] - y) ** 2)
+            # воин бьёт только вплотную, остальным хватает и издалека
+            self.steer(ex, ey, now, stop=1.0 if self.cls == "воин" else 4.0)
+            if now >= self.next_attack:
+                self.command("attack", target_enemy_id=eid)
+                self.next_attack = now + ATTACK_INTERVAL
+        elif self.direction != (0.0, 0.0):
+            self.send_input(0.0, 0.0, now)
+        if now >= self.next_special and self.cls != "лучник":
+            self.command("special")
+            self.next_special = now + SPECIAL_INTERVAL
+
+    def heal(self, now):
+        my_id = self.you.get("id")
+        dead = [pid for pid, alive in self.players.items() if not alive]
+        allies = [pid for pid, alive in self.players.items() if alive and pid != my_id]
+        if dead and now >= self.next_special:
+            self.command("res", target_player_id=random.choice(dead))
+            self.next_special = now + SPECIAL_INTERVAL
+        elif now >= self.next_special:
+            self.command("special", target_player_id=random.choice(allies) if allies else my_id)
+            self.next_special = now + SPECIAL_INTERVAL
+        if now >= self.next_attack:
+            self.command("attack", target_player_id=random.choice(allies) if allies else my_id)
+            self.next_attack = now + ATTACK_INTERVAL
+
+
+def parse_mix(text, names, what):
+    """"воин=2,маг=1" -> [(имя, вес), ...]."""
+    mix = []
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        try:
+            weight = float(weight) if weight else 1.0
+        except ValueError:
+            weight = -1.0
+        if name not in names or weight < 0:
+            raise argparse.ArgumentTypeError(f"{what}: неверный элемент {item!r}, допустимо: {', '.join(names)}")
+        mix.append((name, weight))
+    if not any(w > 0 for _, w in mix):
+        raise argparse.ArgumentTypeError(f"{what}: все веса нулевые")
+    return mix
+
+
+def spread(mix, count):
+    """Раскладывает count ботов по весам без случайности (для повторяемых прогонов)."""
+    total = sum(w for _, w in mix)
+    out = []
+    acc = 0.0
+    for name, weight in mix:
+        acc += weight * count / total
+        out.extend([name] * (round(acc) - len(out)))
+    return out
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Нагрузочные боты «Башни Забытого Пламени»")
+    parser.add_argument("host", nargs="?", default="127.0.0.1")
+    parser.add_argument("port", nargs="?", type=int, default=5000)
+    parser.add_argument("--bots", type=int, default=100, help="сколько ботов подключить")
+    parser.add_argument(
+        "--classes", default="воин=1,лучник=1,маг=1,хилер=1",
+        type=lambda s: parse_mix(s, CLASSES, "--classes"),
+        help="смесь классов (healer-боты всегда хилеры), по умолчанию поровну",
+    )
+    parser.add_argument(
+        "--profiles", default="idle=1,mover=1,attacker=1,healer=1,door=1",
+        type=lambda s: parse_mix(s, PROFILES, "--profiles"),
+        help="смесь поведений: " + ", ".join(PROFILES),
+    )
+    parser.add_argument("--proto", choices=PROTOS, default="binary",
+                        help="binary/json — снимки с ack, legacy — полные state JSON-строками")
+    parser.add_argument("--duration", type=float, default=60.0, help="сколько секунд гонять")
+    parser.add_argument("--ramp", type=float, default=5.0, help="за сколько секунд подключить всех")
+    parser.add_argument("--report", type=float, default=10.0, help="период промежуточного отчёта, с")
+    parser.add_argument("--json", metavar="ФАЙЛ", help="записать итоговый отчёт в JSON")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args(argv)
+
+
+def report(bots, stats, reset=True):
+    counts = {}
+    stages = {}
+    for bot in bots:
+        if not bot.closed:
+            counts[bot.profile] = counts.get(bot.profile, 0) + 1
+            if bot.you is not None:
+                where = stages.setdefault(bot.profile, {})
+                stage = bot.you.get("stage", 0)
+                where[stage] = where.get(stage, 0) + 1
+    out = {}
+    for name in stats:
+        out[name] = stats[name].summary(counts.get(name, 0))
+        out[name]["stages"] = dict(sorted(stages.get(name, {}).items()))
+    if reset:
+        for s in stats.values():
+            s.reset()
+    return out
+
+
+def main(argv):
+    args = parse_args(argv)
+    random.seed(args.seed)
+    stats = {name: ProfileStats() for name, w in args.profiles if w > 0}
+    profiles = spread(args.profiles, args.bots)
+    classes = spread(args.classes, args.bots)
+    random.shuffle(profiles)
+    random.shuffle(classes)
+    bots = []
+    for i, profile in enumerate(profiles):
+        cls_name = "хилер" if profile == "healer" else classes[i]
+        bots.append(Bot(i + 1, profile, cls_name, args.proto, stats[profile]))
+
+    sel = selectors.DefaultSelector()
+    started = time.monotonic()
+    end = started + args.duration
+    next_report = started + args.report
+    pending = list(bots)           # ещё не подключены
+    live = []
+    connect_gap = args.ramp / max(len(bots), 1)
+    next_connect = started
+    failed = 0
+    totals = {name: ProfileStats() for name in stats}
+
+    try:
+        while True:
+            now = time.monotonic()
+            if now >= end:
+                break
+            while pending and now >= next_connect:
+                bot = pending.pop(0)
+                try:
+                    bot.connect(args.host, args.port)
+                except OSError as e:
+                    failed += 1
+                    print(f"[BOT] {bot.name}: не подключился: {e}", flush=True)
+                else:
+                    sel.register(bot.sock, selectors.EVENT_READ, bot)
+                    bot.next_action = now + random.uniform(0, 0.1)
+                    live.append(bot)
+                next_connect += connect_gap
+
+            for bot in live:
+                if not bot.closed and now >= bot.next_action:
+                    bot.next_action = bot.act(now)
+                if bot.out and not bot.closed:
+                    bot.flush()
+            wake = min((b.next_action for b in live if not b.closed), default=now + 0.05)
+            if pending:
+                wake = min(wake, next_connect)
+            timeout = max(0.0, min(wake, end) - time.monotonic())
+            for key, _ in sel.select(timeout):
+                bot = key.data
+                bot.on_readable()
+                if bot.closed:
+                    sel.unregister(bot.sock)
+                    bot.sock.close()
+
+            if time.monotonic() >= next_report:
+                for name, s in stats.items():
+                    t = totals[name]
+                    t.commands += s.commands
+                    t.frames += s.frames
+                    t.bytes += s.bytes
+                    for v in s.latencies:
+                        t.add_latency(v)
+                print(f"[BOT] {json.dumps(report(live, stats), ensure_ascii=False)}", flush=True)
+                next_report += args.report
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for name, s in stats.items():
+            t = totals[name]
+            t.commands += s.commands
+            t.frames += s.frames
+            t.bytes += s.bytes
+            for v in s.latencies:
+                t.add_latency(v)
+            t.started = started
+        final = {
+            "bots": len(bots),
+            "connected": len(live),
+            "disconnected": sum(1 for b in live if b.closed),
+            "failed": failed,
+            "duration": round(time.monotonic() - started, 1),
+            "proto": args.proto,
+            "profiles": report(live, totals, reset=False),
+        }
+        for bot in live:
+            if not bot.closed:
+                bot.sock.close()
+        print(f"[BOT] итог: {json.dumps(final, ensure_ascii=False, indent=2)}", flush=True)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(final, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,234 @@
+
+# netproto.py
+# Сетевой протокол клиента "Башни Забытого Пламени": JSON-строки и бинарные кадры (версия 2).
+# Раскладка записей должна совпадать с server/server.py.
+import json
+import struct
+
+PROTO_JSON = 1
+PROTO_BINARY = 2
+
+FRAME_HEADER = struct.Struct("<BI")
+FRAME_JSON = 1
+FRAME_SNAPSHOT = 2
+FRAME_ATTACK = 3
+FRAME_NAMES = 4
+
+COORD_SCALE = 256
+NO_BASE = 0xFFFFFFFF
+
+CLASS_NAMES = {1: "воин", 2: "лучник", 3: "маг", 4: "хилер"}
+ATTACKER_TYPES = {1: "player", 2: "enemy"}
+
+EF_RANGED, EF_BOSS, EF_MINIBOSS = 1, 2, 4
+PF_ALIVE, PF_READY = 1, 2
+
+SNAP_HEADER = struct.Struct("<IIB")
+YOU_REC = struct.Struct("<IHBBBiiiiffffIf")
+ENEMY_FULL = struct.Struct("<IHBiiHH")
+ENEMY_DYN = struct.Struct("<IiHH")
+PLAYER_FULL = struct.Struct("<IHBBBiiiiHH")
+PLAYER_DYN = struct.Struct("<IBiiHH")
+COUNT = struct.Struct("<H")
+ID = struct.Struct("<I")
+BLOB_LEN = struct.Struct("<I")
+ATTACK_REC = struct.Struct("<BIBIBBiHHHH")
+NAME_REC = struct.Struct("<HH")
+
+
+def encode_json_line(obj) -> bytes:
+    return (json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+def encode_json_frame(obj) -> bytes:
+    payload = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+    return FRAME_HEADER.pack(FRAME_JSON, len(payload)) + payload
+
+
+class FrameReader:
+    """Собирает сообщения сервера из потока байт.
+
+    До welcome сервер шлёт JSON-строки; если в welcome пришёл proto=2,
+    вызывающий включает binary, и дальше идут кадры [тип u8][длина u32].
+    Кадры разбираются в такие же словари, как JSON-сообщения, так что
+    остальной код клиента не знает, каким протоколом они пришли.
+    """
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.binary = False
+        self.names = {}   # код -> имя (FRAME_NAMES)
+
+    def feed(self, data: bytes):
+        self.buf += data
+
+    def next_message(self):
+        """Следующее целое сообщение или None, если нужно дочитать данные."""
+        while True:
+            if not self.binary:
+                pos = self.buf.find(b"\n")
+                if pos < 0:
+                    return None
+                line = bytes(self.buf[:pos]).strip()
+                del self.buf[:pos + 1]
+                if line:
+                    return json.loads(line)
+                continue
+
+            if len(self.buf) < FRAME_HEADER.size:
+                return None
+            kind, length = FRAME_HEADER.unpack_from(self.buf, 0)
+            end = FRAME_HEADER.size + length
+            if len(self.buf) < end:
+                return None
+            payload = bytes(self.buf[FRAME_HEADER.size:end])
+            del self.buf[:end]
+
+            if kind == FRAME_JSON:
+                return json.loads(payload)
+            if kind == FRAME_SNAPSHOT:
+                return self.decode_snapshot(payload)
+            if kind == FRAME_ATTACK:
+                return decode_attack(payload)
+            if kind == FRAME_NAMES:
+                self.decode_names(payload)
+            # неизвестные кадры пропускаем
+
+    def decode_names(self, payload: bytes):
+        (count,) = COUNT.unpack_from(payload, 0)
+        pos = COUNT.size
+        for _ in range(count):
+            code, length = NAME_REC.unpack_from(payload, pos)
+            pos += NAME_REC.size
+            self.names[code] = payload[pos:pos + length].decode("utf-8")
+            pos += length
+
+    def decode_snapshot(self, payload: bytes) -> dict:
+        """FRAME_SNAPSHOT -> словарь того же вида, что JSON-кадр "snapshot"."""
+        names = self.names
+        seq, base, has_level = SNAP_HEADER.unpack_from(payload, 0)
+        pos = SNAP_HEADER.size
+
+        (pid, name, cls, flags, stage, hp, max_hp, mana, max_mana,
+         x, y, special_cd, special_cd_left, input_seq, input_time) = YOU_REC.unpack_from(payload, pos)
+        pos += YOU_REC.size
+        msg = {
+            "type": "snapshot",
+            "seq": seq,
+            "base": None if base == NO_BASE else base,
+            "you": {
+                "id": pid,
+                "name": names.get(name, "?"),
+                "class": CLASS_NAMES.get(cls, ""),
+                "hp": hp,
+                "max_hp": max_hp,
+                "mana": mana,
+                "max_mana": max_mana,
+                "stage": stage,
+                "alive": bool(flags & PF_ALIVE),
+                "x": x,
+                "y": y,
+                "archer_stance": "ready" if flags & PF_READY else "move",
+                "special_cd": special_cd,
+                "special_cd_left": special_cd_left,
+                "input_seq": input_seq,
+                "input_time": input_time,
+            },
+        }
+
+        if has_level:
+            (length,) = BLOB_LEN.unpack_from(payload, pos)
+            pos += BLOB_LEN.size
+            msg["level"] = json.loads(payload[pos:pos + length])
+            pos += length
+
+        enemies = []
+        (count,) = COUNT.unpack_from(payload, pos)
+        pos += COUNT.size
+        for _ in range(count):
+            eid, name, eflags, hp, max_hp, qx, qy = ENEMY_FULL.unpack_from(payload, pos)
+            pos += ENEMY_FULL.size
+            enemies.append({
+                "id": eid,
+                "name": names.get(name, "?"),
+                "etype": "ranged" if eflags & EF_RANGED else "melee",
+                "hp": hp,
+                "max_hp": max_hp,
+                "boss": bool(eflags & EF_BOSS),
+                "miniboss": bool(eflags & EF_MINIBOSS),
+                "x": qx / COORD_SCALE,
+                "y": qy / COORD_SCALE,
+            })
+        (count,) = COUNT.unpack_from(payload, pos)
+        pos += COUNT.size
+        for _ in range(count):
+            eid, hp, qx, qy = ENEMY_DYN.unpack_from(payload, pos)
+            pos += ENEMY_DYN.size
+            enemies.append({"id": eid, "hp": hp, "x": qx / COORD_SCALE, "y": qy / COORD_SCALE})
+        msg["enemies"] = enemies
+        msg["enemies_gone"], pos = _decode_ids(payload, pos)
+
+        players = []
+        (count,) = COUNT.unpack_from(payload, pos)
+        pos += COUNT.size
+        for _ in range(count):
+            (pid, name, cls, pflags, stage, hp, max_hp, mana, max_mana,
+             qx, qy) = PLAYER_FULL.unpack_from(payload, pos)
+            pos += PLAYER_FULL.size
+            players.append({
+                "id": pid,
+                "name": names.get(name, "?"),
+                "class": CLASS_NAMES.get(cls, ""),
+                "hp": hp,
+                "max_hp": max_hp,
+                "mana": mana,
+                "max_mana": max_mana,
+                "stage": stage,
+                "alive": bool(pflags & PF_ALIVE),
+                "x": qx / COORD_SCALE,
+                "y": qy / COORD_SCALE,
+                "archer_stance": "ready" if pflags & PF_READY else "move",
+            })
+        (count,) = COUNT.unpack_from(payload, pos)
+        pos += COUNT.size
+        for _ in range(count):
+            pid, pflags, hp, mana, qx, qy = PLAYER_DYN.unpack_from(payload, pos)
+            pos += PLAYER_DYN.size
+            players.append({
+                "id": pid,
+                "hp": hp,
+                "mana": mana,
+                "alive": bool(pflags & PF_ALIVE),
+                "archer_stance": "ready" if pflags & PF_READY else "move",
+                "x": qx / COORD_SCALE,
+                "y": qy / COORD_SCALE,
+            })
+        msg["players"] = players
+        msg["players_gone"], pos = _decode_ids(payload, pos)
+        return msg
+
+
+def _decode_ids(payload: bytes, pos: int):
+    (count,) = COUNT.unpack_from(payload, pos)
+    pos += COUNT.size
+    ids = [ID.unpack_from(payload, pos + i * ID.size)[0] for i in range(count)]
+    return ids, pos + count * ID.size
+
+
+def decode_attack(payload: bytes) -> dict:
+    (attacker, attacker_id, target, target_id, stage, special, damage,
+     fx, fy, tx, ty) = ATTACK_REC.unpack(payload)
+    return {
+        "type": "attack",
+        "stage": stage,
+        "attacker_type": ATTACKER_TYPES.get(attacker),
+        "attacker_id": attacker_id,
+        "target_type": ATTACKER_TYPES.get(target),
+        "target_id": target_id,
+        "from_x": fx / COORD_SCALE,
+        "from_y": fy / COORD_SCALE,
+        "to_x": tx / COORD_SCALE,
+        "to_y": ty / COORD_SCALE,
+        "damage": damage,
+        "special": bool(special),
+    }
@@ -0,0 +1,248 @@
+# bench.py
+# Микробенчмарки горячих функций сервера "Башни Забытого Пламени" на
+# синтетических мирах: GameServer без сокетов, игроки на поддельных
+# соединениях. Результаты сохраняются в JSON и сравниваются между прогонами.
+#
+#   python bench.py --save base.json              # снять базу
+#   python bench.py --compare base.json           # сравнить, код 1 при замедлении
+import argparse
+import contextlib
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+import server as game
+
+CASES = (
+    "send_state",
+    "broadcast_state_for_level",
+    "enemies_move_level",
+    "enemies_attack_level",
+    "basic_attack",
+    "fireball",
+    "mass_heal",
+    "crowd_fight",
+    "tick",
+)
+STAGE = 12                # большой этаж (40x24), чтобы работало AOI
+UNKILLABLE = 10 ** 9      # столько HP у всех, чтобы мир не менялся от прогона к прогону
+MIN_REPEAT_TIME = 0.02    # секунд на один повтор: под это подбирается число вызовов
+
+
+def build_world(players, enemies, arrays=False, proto=game.PROTO_BINARY, seed=1):
+    """GameServer с players игроками (классы по кругу) и enemies врагами на STAGE.
+
+    Часы виртуальные и зерно фиксировано — один и тот же мир от прогона к прогону."""
+    server = game.GameServer(clock=game.VirtualClock(), seed=seed)
+    rng = server.rng
+    server.enemy_arrays = arrays
+    lvl = server.get_level(STAGE)
+    classes = ("воин", "лучник", "маг", "хилер")
+    for i in range(players):
+        hello = {"type": "hello", "name": f"B{i}", "class": classes[i % len(classes)],
+                 "snapshots": True, "proto": proto}
+        p = server.add_player_from_hello(hello, game.NullConn())
+        p.max_hp = p.hp = UNKILLABLE
+        p.max_mana = p.mana = UNKILLABLE
+        server.join_player(p)
+        p.stage = STAGE
+        p.x = rng.uniform(0, lvl.width - 1)
+        p.y = rng.uniform(0, lvl.height - 1)
+        server.place_player(p)
+    lvl.set_enemies([
+        server._make_enemy(f"Моб{i}", rng.choice(("melee", "ranged")), UNKILLABLE, 25, 3,
+                           rng.uniform(0, lvl.width - 1), rng.uniform(0, lvl.height - 1))
+        for i in range(enemies)
+    ])
+    server.drain_outboxes()
+    return server, lvl
+
+
+def make_case(name, server, lvl):
+    """Функция без аргументов, выполняющая один вызов замера name."""
+    players = list(server.stage_players(STAGE).values())
+    first = players[0]
+    by_cls = {}
+    for p in players:
+        by_cls.setdefault(p.cls, p)
+
+    if name == "send_state":
+        return lambda: (server.send_state(first), server.drain_outboxes())
+    if name == "broadcast_state_for_level":
+        return lambda: (server.broadcast_state_for_level(STAGE), server.drain_outboxes())
+    if name == "enemies_move_level":
+        return lambda: server.enemies_move_level(STAGE)
+    if name == "enemies_attack_level":
+        def run():
+            lvl.last_enemy_attack = 0.0
+            server.enemies_attack_level(STAGE)
+            server.drain_outboxes()
+        return run
+    if name == "basic_attack":
+        mage = by_cls.get("маг", first)
+        return lambda: (server.basic_attack(mage), server.drain_outboxes())
+    if name == "fireball":
+        mage = by_cls.get("маг")
+        if mage is None:
+            return None
+        return lambda: (server.use_special(mage), server.drain_outboxes())
+    if name == "mass_heal":
+        healer = by_cls.get("хилер")
+        if healer is None:
+            return None
+
+        def run():
+            for p in players:
+                p.hp = p.max_hp - 50
+            # часы бенча стоят: без сброса отката все вызовы после первого
+            # мерили бы отказ «Способность в откате»
+            healer.last_special_time = server.clock.time() - healer.special_cd
+            server.use_special(healer)
+            server.drain_outboxes()
+
+        run()
+        if not any(p.hp > p.max_hp - 50 for p in players):
+            raise RuntimeError("mass_heal: массовое лечение никого не вылечило")
+        return run
+    if name == "crowd_fight":
+        mage = by_cls.get("маг")
+        if mage is None:
+            return None
+
+        def run():
+            # один тик массового боя: огненный шар по толпе и залп всей волны,
+            # сотни attack/event на клиента до одного flush
+            lvl.last_enemy_attack = 0.0
+            server.use_special(mage)
+            server.enemies_attack_level(STAGE)
+            server.flush_outboxes()
+            server.drain_outboxes()
+
+        run()
+        dropped = [p.name for p in players if p.dropped]
+        if dropped:
+            raise RuntimeError(f"crowd_fight: здоровых клиентов отключили как медленных: {dropped}")
+        return run
+    if name == "tick":
+        def run():
+            server.clock.advance(game.TICK_INTERVAL)
+            server.tick(server.clock.time())
+            server.drain_outboxes()
+        return run
+    raise ValueError(name)
+
+
+def measure(fn, repeat):
+    """(медиана, минимум) секунд на вызов по repeat повторам."""
+    number = 1
+    while True:
+        t0 = time.perf_counter()
+        for _ in range(number):
+            fn()
+        spent = time.perf_counter() - t0
+        if spent >= MIN_REPEAT_TIME or number >= 1 << 16:
+            break
+        number *= 2
+    times = [spent / number]
+    for _ in range(repeat - 1):
+        t0 = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter() - t0) / number)
+    return statistics.median(times), min(times)
+
+
+def run_suite(cases, players_grid, enemies_grid, repeat, arrays):
+    results = {}
+    devnull = open(os.devnull, "w")
+    for n_players in players_grid:
+        for n_enemies in enemies_grid:
+            for name in cases:
+                # свой мир на каждый замер: прошлые не сдвигают врагов и hp
+                with contextlib.redirect_stdout(devnull):
+                    server, lvl = build_world(n_players, n_enemies, arrays=arrays)
+                    fn = make_case(name, server, lvl)
+                    if fn is None:
+                        continue
+                    median, best = measure(fn, repeat)
+                key = f"{name}[p={n_players},e={n_enemies}]"
+                results[key] = {"median_us": round(median * 1e6, 2), "min_us": round(best * 1e6, 2)}
+                print(f"{key:<48} {median * 1e6:>12.1f} мкс  (min {best * 1e6:.1f})", flush=True)
+    devnull.close()
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Печатает сравнение с базой; возвращает список замедлившихся замеров."""
+    slower = []
+    print(f"\n{'замер':<48} {'база':>10} {'сейчас':>10} {'x':>7}")
+    for key, cur in results.items():
+        old = baseline.get(key)
+        if old is None:
+            print(f"{key:<48} {'—':>10} {cur['median_us']:>10.1f}")
+            continue
+        ratio = cur["median_us"] / max(old["median_us"], 1e-9)
+        mark = ""
+        if ratio > threshold:
+            mark = "  <-- медленнее"
+            slower.append(key)
+        print(f"{key:<48} {old['median_us']:>10.1f} {cur['median_us']:>10.1f} {ratio:>7.2f}{mark}")
+    return slower
+
+
+def parse_list(text):
+    return [int(x) for x in text.split(",") if x.strip()]
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Микробенчмарки сервера «Башни Забытого Пламени»")
+    parser.add_argument("--players", type=parse_list, default=[1, 16, 64],
+                        help="число игроков через запятую (по умолчанию 1,16,64)")
+    parser.add_argument("--enemies", type=parse_list, default=[10, 100, 500],
+                        help="число врагов через запятую (по умолчанию 10,100,500)")
+    parser.add_argument("--only", action="append", choices=CASES, metavar="ЗАМЕР",
+                        help="гонять только эти замеры: " + ", ".join(CASES))
+    parser.add_argument("--repeat", type=int, default=5, help="повторов на замер (берётся медиана)")
+    parser.add_argument("--enemy-arrays", action="store_true", help="враги в EnemyStore (нужен numpy)")
+    parser.add_argument("--save", metavar="ФАЙЛ", help="сохранить результаты как базу")
+    parser.add_argument("--compare", metavar="ФАЙЛ", help="сравнить с сохранённой базой")
+    parser.add_argument("--threshold", type=float, default=1.15,
+                        help="во сколько раз медленнее базы считать замедлением (по умолчанию 1.15)")
+    args = parser.parse_args(argv)
+    if args.enemy_arrays and game.np is None:
+        parser.error("--enemy-arrays требует numpy")
+    return args
+
+
+def main(argv):
+    args = parse_args(argv)
+    results = run_suite(args.only or CASES, args.players, args.enemies, args.repeat, args.enemy_arrays)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({
+                "meta": {
+                    "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+                    "python": platform.python_version(),
+                    "machine": platform.machine(),
+                    "enemy_arrays": args.enemy_arrays,
+                },
+                "results": results,
+            }, f, ensure_ascii=False, indent=2)
+        print(f"\nбаза сохранена в {args.save}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        slower = compare(results, baseline, args.threshold)
+        if slower:
+            print(f"\nзамедлилось: {len(slower)} из {len(results)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,183 @@
+# replay.py
+# Повтор записанной сессии сервера "Башни Забытого Пламени" без сети и сна:
+# GameServer на виртуальных часах с тем же зерном и настройками получает
+# записанные hello/command в те же тики, что и живой сервер. Нужен, чтобы
+# гонять реальную нагрузку под профилировщиком и сравнивать оптимизации.
+#
+#   python server.py --record session.jsonl       # записать игру
+#   python replay.py session.jsonl                # повторить как можно быстрее
+#   python replay.py session.jsonl --profile out.prof
+#
+# Повтор воспроизводит нагрузку, а не каждую цифру: живой сервер догонял
+# тики по настоящим часам, поэтому таймеры могут сработать на тик раньше
+# или позже, чем в записи.
+import argparse
+import contextlib
+import cProfile
+import json
+import os
+import sys
+import time
+
+import server as game
+
+
+def load_sessions(path):
+    """Список сессий файла: (заголовок, записи). Обрезанную последнюю
+    строку (сервер упал посреди записи) пропускаем."""
+    sessions = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(record, dict):
+                if record.get("type") == "session":
+                    sessions.append((record, []))
+            elif sessions:
+                sessions[-1][1].append(record)
+    return sessions
+
+
+def build_server(header):
+    """GameServer с часами, зерном и настройками из заголовка записи."""
+    server = game.GameServer(clock=game.VirtualClock(header.get("start")), seed=header.get("seed"))
+    for name, rate in header.get("rates", {}).items():
+        server.systems.set_rate(name, rate)
+    server.level_evict_after = header.get("evict_after", game.LEVEL_EVICT_AFTER)
+    server.enemy_arrays = bool(header.get("enemy_arrays")) and game.np is not None
+    server.tick_count = header.get("tick", 0)
+    return server
+
+
+class Feeder:
+    """Кладёт записи в inbox сервера к их тику (для GameServer.simulate)."""
+
+    def __init__(self, server, records):
+        self.server = server
+        self.records = records
+        self.pos = 0
+        self.players = {}      # pid из записи -> Player повтора
+        self.commands = 0
+        self.skipped = 0
+
+    @property
+    def last_tick(self):
+        return self.records[-1][0] if self.records else self.server.tick_count
+
+    def __call__(self, tick):
+        records = self.records
+        while self.pos < len(records) and records[self.pos][0] <= tick:
+            record = records[self.pos]
+            self.pos += 1
+            kind, pid = record[1], record[2]
+            if kind == "j":
+                # тот же id, что у живого сервера: по нему ходят цели и снимки
+                self.server.next_player_id = pid
+                player = self.server.add_player_from_hello(record[3], game.NullConn())
+                if player is None:
+                    self.skipped += 1
+                    continue
+                self.players[pid] = player
+                self.server.on_player_connected(player)
+            elif kind == "c":
+                player = self.players.get(pid)
+                if player is None:
+                    self.skipped += 1
+                    continue
+                self.server.inbox.append(("command", player, record[3]))
+                self.commands += 1
+            elif kind == "l":
+                player = self.players.pop(pid, None)
+                if player is not None:
+                    self.server.inbox.append(("leave", player, None))
+
+
+def replay(header, records, tail, events):
+    server = build_server(header)
+    feeder = Feeder(server, records)
+    ticks = feeder.last_tick - server.tick_count + 1 + int(round(tail / game.TICK_INTERVAL))
+    out = contextlib.nullcontext() if events else contextlib.redirect_stdout(open(os.devnull, "w"))
+    started = time.perf_counter()
+    with out:
+        server.simulate(ticks * game.TICK_INTERVAL, feed=feeder)
+    wall = time.perf_counter() - started
+    return server, feeder, wall
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Повтор записанной сессии сервера «Башни Забытого Пламени»")
+    parser.add_argument("file", help="файл записи (server.py --record)")
+    parser.add_argument("--session", type=int, default=-1,
+                        help="номер сессии в файле, с 0; по умолчанию последняя")
+    parser.add_argument("--tail", type=float, default=0.0,
+                        help="секунд игры после последней записи (по умолчанию 0)")
+    parser.add_argument("--events", action="store_true", help="не глушить вывод событий сервера")
+    parser.add_argument("--profile", metavar="ФАЙЛ", help="снять cProfile повтора в ФАЙЛ (pstats)")
+    parser.add_argument("--json", metavar="ФАЙЛ", help="сохранить итоги повтора в JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    sessions = load_sessions(args.file)
+    if not sessions:
+        print(f"в {args.file} нет записанных сессий", file=sys.stderr)
+        return 1
+    try:
+        header, records = sessions[args.session]
+    except IndexError:
+        print(f"в {args.file} сессий {len(sessions)}, нет номера {args.session}", file=sys.stderr)
+        return 1
+    if header.get("enemy_arrays") and game.np is None:
+        print("запись сделана с --enemy-arrays, numpy нет — враги будут объектами", file=sys.stderr)
+
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler is not None:
+        profiler.enable()
+    server, feeder, wall = replay(header, records, args.tail, args.events)
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+
+    ticks = server.tick_stats.ticks
+    seconds = ticks * game.TICK_INTERVAL
+    print(f"[REPLAY] {len(records)} записей, команд {feeder.commands}, пропущено {feeder.skipped}; "
+          f"{seconds:.1f} с игры за {wall:.2f} с ({seconds / max(wall, 1e-9):.0f}x), "
+          f"тиков {ticks} ({ticks / max(wall, 1e-9):.0f}/с), seed {server.seed}", flush=True)
+    print(f"[TICK] {server.tick_stats.summary()}", flush=True)
+    print(f"[SYSTEMS] {server.systems.summary()}", flush=True)
+    print(f"[PROFILE] {server.profiler.summary()}", flush=True)
+    if args.profile:
+        print(f"профиль сохранён в {args.profile}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({
+                "file": args.file,
+                "seed": server.seed,
+                "records": len(records),
+                "commands": feeder.commands,
+                "ticks": ticks,
+                "game_seconds": round(seconds, 3),
+                "wall_seconds": round(wall, 4),
+                "ticks_per_second": round(ticks / max(wall, 1e-9), 1),
+                "systems": {
+                    system.name: {
+                        "runs": system.runs,
+                        "total_ms": round(system.total * 1000, 3),
+                        "max_ms": round(system.max * 1000, 3),
+                    }
+                    for system in server.systems.systems
+                },
+                "profile": server.profiler.summary(),
+            }, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -2,28 +2,67 @@
 # server.py
 # Онлайновый 2D-рогалик "Башня Забытого Пламени" — сервер
 import socket
+import selectors
 import threading
+import heapq
+import itertools
+import hmac
+from bisect import bisect_right
+from collections import deque
 import json
+import struct
 import time
 import random
 import sys
+import argparse
 import traceback
 
+try:
+    import numpy as np   # необязательно: нужен только для --enemy-arrays
+except ImportError:
+    np = None
+
 # Размеры условной карты (в логике сервера — координаты, в клиенте визуализируются в тайлах)
 MAP_WIDTH = 20
 MAP_HEIGHT = 12
+GRID_CELL = 4.0               # размер ячейки пространственной сетки уровня (в тайлах)
 
 # Тайминги
 TICK_INTERVAL = 0.03          # ещё более частые тики для максимальной плавности
+TICK_MAX_CATCHUP = 3          # сколько шагов симуляции подряд догоняем после опоздания, остальные пропускаем
+TICK_STATS_INTERVAL = 60.0    # раз в сколько секунд печатать сводку по тикам
+
+# Подсистемы тика по порядку выполнения: имя -> (частота в Гц, бюджет в мс).
+# Частота не выше частоты тиков; бюджет только для учёта превышений.
+SYSTEM_RATES = {
+    "movement": (1.0 / TICK_INTERVAL, 8.0),
+    "enemy_attacks": (10.0, 5.0),
+    "regen": (2.0, 3.0),
+    "timers": (10.0, 5.0),
+    "network": (20.0, 10.0),
+}
+SYSTEM_ESSENTIAL = ("movement",)      # эти не откладываются, даже если тик выбрал свой бюджет
+# их откладываем первыми: если в шаге какая-то подсистема вышла за свой бюджет
+# или они сами вышли за него в прошлый запуск
+SYSTEM_LOW_PRIORITY = ("regen", "timers")
+TICK_BUDGET = TICK_INTERVAL * 0.7     # сколько шагу можно работать, прежде чем откладывать остальное
+PROFILE_SLOTS = 5             # окно гистограмм профиля: столько последних сводок TICK_STATS_INTERVAL
+# границы корзин гистограмм: от 1 мкс до ~17 с, соседние отличаются в 2**0.25 (~19%)
+PROFILE_BOUNDS = tuple(1e-6 * 2 ** (i / 4) for i in range(97))
+# типы команд, которые профиль считает по отдельности; остальное — "other"
+PROFILE_COMMANDS = ("input", "move", "attack", "special", "res", "enter_door", "status", "who", "help")
 DEATH_TIMEOUT = 300           # 5 минут до рестарта на 1 уровень
 ENEMY_ATTACK_DELAY = 1.0      # враги атакуют не чаще, чем раз в N секунд
 ENEMY_MOVE_INTERVAL = 0.03    # враги ближники двигаются не чаще чем в N секунд
 RESPAWN_INTERVAL = 60.0       # каждые 60 секунд враги возрождаются на уровне (если не зачищен)
 DOOR_RESPAWN_INTERVAL = 120.0     # каждые 2 минуты волна на уровне с дверью
+LEVEL_EVICT_AFTER = 600.0     # через сколько секунд без игроков уровень выгружается из памяти
+ENEMY_COMPACT_MIN = 32        # сколько мёртвых врагов копится в lvl.enemies до чистки
 HP_REGEN_DELAY = 10.0         # через сколько секунд без урона/атаки начать реген HP
 MANA_REGEN_DELAY = 10.0       # через сколько секунд после траты маны начать реген MP
 HP_REGEN_STEP = 2             # сколько HP в секунду восстанавливать
 MANA_REGEN_STEP = 2           # сколько MP в секунду восстанавливать
+PLAYER_SPEED = 9.0            # тайлов в секунду при удержании направления (= шаг 0.15 клиента × 60 кадров)
 
 
 
@@ -54,37 +93,946 @@ BOSS_10_PHASE2_ACTIVE_TIME = 1.0         # сколько секунд круг
 
 BOSS_10_PHASE2_DAMAGE = 20               # урон по игроку при срабатывании круга
 
+# --- Сеть ---
+# "threads" — поток на каждого клиента (старый режим),
+# "select"  — один цикл на selectors обслуживает все сокеты
+NET_MODES = ("threads", "select")
+NET_RECV_CHUNK = 65536        # сколько байт читаем из сокета за раз
+NET_MAX_LINE = 64 * 1024      # максимальная длина одной JSON-строки от клиента
+# сколько байт, уже отданных писателю (flush), может ждать сокета; дальше — клиент
+# не успевает читать, отключаем. Кадры текущего тика до flush не считаются
+OUTBOX_LIMIT = 1 << 20
+AOI_VIEW_W = 20               # экран клиента в тайлах (VIEW_W_TILES/VIEW_H_TILES в client.py)
+AOI_VIEW_H = 12
+AOI_MARGIN = 4                # запас вокруг экрана: сущность приходит до того, как станет видна
+AOI_HYSTERESIS = 2            # уже видимую сущность убираем, только когда она отойдёт ещё дальше
+NET_IOV_MAX = 512             # сколько буферов отдаём в один sendmsg
+SNAPSHOT_HISTORY = 64         # сколько отправленных снимков помним на клиента для дельт (~2 с)
+
+# --- Протокол ---
+# 1 — JSON построчно (удобно для отладки), 2 — бинарные кадры с длиной.
+# Клиент просит версию в hello ("proto"), сервер отвечает выбранной в welcome.
+PROTO_JSON = 1
+PROTO_BINARY = 2
+
+# Бинарный кадр: [тип u8][длина u32][данные]. Первый байт JSON-строки — "{",
+# поэтому сервер различает кадры и строки от клиента по первому байту.
+FRAME_HEADER = struct.Struct("<BI")
+FRAME_JSON = 1        # внутри — обычное JSON-сообщение (event, error, команды клиента...)
+FRAME_SNAPSHOT = 2    # дельта-снимок в фиксированных записях
+FRAME_ATTACK = 3      # визуализация атаки
+FRAME_NAMES = 4       # пополнение таблицы имён: код -> строка
+FRAME_MAX = 1 << 20
+
+COORD_SCALE = 256     # координаты врагов/игроков в кадрах — u16 в 1/256 тайла
+NO_BASE = 0xFFFFFFFF  # base полного снимка
+
+CLASS_CODES = {"воин": 1, "лучник": 2, "маг": 3, "хилер": 4}
+ATTACKER_CODES = {"player": 1, "enemy": 2}
+
+# флаги записей
+EF_RANGED, EF_BOSS, EF_MINIBOSS = 1, 2, 4
+PF_ALIVE, PF_READY = 1, 2
+
+SNAP_HEADER = struct.Struct("<IIB")           # seq, base, есть ли блок level
+YOU_REC = struct.Struct("<IHBBBiiiiffffIf")    # id, имя, класс, флаги, этаж, hp, max_hp, mp, max_mp, x, y, cd, cd_left,
+                                               # номер ввода, время по нему
+ENEMY_FULL = struct.Struct("<IHBiiHH")         # id, имя, флаги, hp, max_hp, x, y
+ENEMY_DYN = struct.Struct("<IiHH")             # id, hp, x, y
+PLAYER_FULL = struct.Struct("<IHBBBiiiiHH")    # id, имя, класс, флаги, этаж, hp, max_hp, mp, max_mp, x, y
+PLAYER_DYN = struct.Struct("<IBiiHH")          # id, флаги, hp, mp, x, y
+COUNT = struct.Struct("<H")
+ID = struct.Struct("<I")
+BLOB_LEN = struct.Struct("<I")
+ATTACK_REC = struct.Struct("<BIBIBBiHHHH")     # кто, id, по кому, id, этаж, special, урон, from x/y, to x/y
+NAME_REC = struct.Struct("<HH")                # код, длина utf-8
+NAME_UNKNOWN = 0xFFFF     # код «имя неизвестно»: таблица кодов u16 заполнена (клиент покажет "?")
+NAME_MAX_BYTES = 0xFFFF   # длина имени в NAME_REC — тоже u16
+
+
+
+def encode_json(obj) -> bytes:
+    return (json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+def encode_frame(kind, payload: bytes) -> bytes:
+    return FRAME_HEADER.pack(kind, len(payload)) + payload
+
+
+def encode_json_frame(obj) -> bytes:
+    return encode_frame(FRAME_JSON, json.dumps(obj, ensure_ascii=False).encode("utf-8"))
+
+
+def recv_message(f):
+    """Читает из бинарного файла сокета одно сообщение клиента: JSON-строку или кадр FRAME_JSON."""
+    first = f.read(1)
+    while first in (b"\n", b"\r", b" "):
+        first = f.read(1)
+    if not first:
+        return None
+    if first == b"{":
+        return json.loads(first + f.readline())
+    rest = f.read(FRAME_HEADER.size - 1)
+    if len(rest) < FRAME_HEADER.size - 1:
+        return None
+    kind, length = FRAME_HEADER.unpack(first + rest)
+    if length > FRAME_MAX:
+        raise ValueError("слишком большой кадр от клиента")
+    payload = f.read(length)
+    if len(payload) < length:
+        return None
+    if kind != FRAME_JSON:
+        return {}
+    return json.loads(payload)
+
+
+def quant(v) -> int:
+    q = int(v * COORD_SCALE + 0.5)
+    return 0 if q < 0 else (65535 if q > 65535 else q)
+
+
+class NameTable:
+    """Имена врагов и игроков -> короткие коды (u16) для бинарного протокола.
+
+    Коды общие для всего сервера (тело снимка кэшируется на всех игроков).
+    Имена врагов, попавшие сюда через code(), остаются навсегда — их
+    конечный набор. Имена игроков держатся acquire()/release() с join по
+    leave, и код ушедшего игрока уходит в свободные и потом переиспользуется.
+
+    Каждое назначение кода пишется в журнал log; клиенту досылается хвост
+    журнала, которого он ещё не видел (Player.names_sent), а переназначенный
+    код он просто перезапишет у себя. Когда в журнале набирается много
+    устаревших записей, он пересобирается из живых кодов с новой эпохой —
+    клиенты старой эпохи получают таблицу заново (только живые имена).
+    """
+
+    def __init__(self):
+        self.codes = {}      # имя -> код
+        self.pinned = set()  # имена, которые не освобождаются (враги)
+        self.refs = {}       # имя игрока -> сколько подключённых с ним
+        self.free = []       # освобождённые коды
+        self.next_code = 0
+        self.log = []        # (код, имя) в порядке назначения
+        self.epoch = 0
+
+    def _assign(self, name):
+        if self.free:
+            c = self.free.pop()
+        elif self.next_code < NAME_UNKNOWN:
+            c = self.next_code
+            self.next_code += 1
+        else:
+            return NAME_UNKNOWN
+        self.codes[name] = c
+        self.log.append((c, name))
+        return c
+
+    def code(self, name) -> int:
+        c = self.codes.get(name)
+        if c is None:
+            c = self._assign(name)
+            if c != NAME_UNKNOWN and name not in self.refs:
+                self.pinned.add(name)
+        return c
+
+    def acquire(self, name):
+        """Имя подключённого игрока: код живёт, пока его не отпустят все."""
+        self.refs[name] = self.refs.get(name, 0) + 1
+        if name not in self.codes:
+            self._assign(name)
+
+    def release(self, name):
+        left = self.refs.get(name, 0) - 1
+        if left > 0:
+            self.refs[name] = left
+            return
+        self.refs.pop(name, None)
+        if name in self.pinned:
+            return
+        c = self.codes.pop(name, None)
+        if c is not None:
+            self.free.append(c)
+            if len(self.log) > 2 * len(self.codes) + 1024:
+                self.compact()
+
+    def compact(self):
+        self.log = sorted((c, name) for name, c in self.codes.items())
+        self.epoch += 1
+
+    def frames_since(self, start) -> list:
+        """Кадры FRAME_NAMES с записями журнала от start (в кадре не больше u16 записей)."""
+        frames = []
+        for chunk in range(start, len(self.log), 0xFFFF):
+            records = self.log[chunk:chunk + 0xFFFF]
+            parts = [COUNT.pack(len(records))]
+            for c, name in records:
+                raw = name.encode("utf-8")
+                if len(raw) > NAME_MAX_BYTES:
+                    raw = raw[:NAME_MAX_BYTES].decode("utf-8", "ignore").encode("utf-8")
+                parts.append(NAME_REC.pack(c, len(raw)))
+                parts.append(raw)
+            frames.append(encode_frame(FRAME_NAMES, b"".join(parts)))
+        return frames
+
+
+def advance_timer(last, now, period):
+    """Следующая отметка периодического таймера без накопления опозданий.
+
+    Обычно сдвигаемся ровно на period от прошлой отметки; если отстали
+    больше чем на период (простой, пауза), начинаем отсчёт от now.
+    """
+    nxt = last + period
+    return nxt if now - nxt < period else now
+
+
+class VirtualClock:
+    """Часы для simulate: время стоит, пока его не сдвинут advance().
+
+    Отсчёт начинается с того же, что time.time(), чтобы отметки игры
+    выглядели как обычные."""
+
+    def __init__(self, start=None):
+        self.now = time.time() if start is None else start
+
+    def time(self):
+        return self.now
+
+    def advance(self, dt):
+        self.now += dt
+
+
+class TickStats:
+    """Счётчики планировщика тиков за текущее окно (см. TICK_STATS_INTERVAL)."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.started = time.monotonic()
+        self.ticks = 0
+        self.steps = 0
+        self.skipped = 0
+        self.overruns = 0           # тиков, работавших дольше TICK_INTERVAL
+        self.late = 0               # тиков, начатых позже дедлайна на полшага и больше
+        self.total_duration = 0.0
+        self.max_duration = 0.0
+        self.max_lateness = 0.0
+
+    def window(self):
+        return time.monotonic() - self.started
+
+    def record(self, duration, lateness, steps, skipped):
+        self.ticks += 1
+        self.steps += steps
+        self.skipped += skipped
+        self.total_duration += duration
+        if duration > self.max_duration:
+            self.max_duration = duration
+        if lateness > self.max_lateness:
+            self.max_lateness = lateness
+        if duration > TICK_INTERVAL:
+            self.overruns += 1
+        if lateness >= TICK_INTERVAL / 2:
+            self.late += 1
+
+    def summary(self):
+        return {
+            "ticks": self.ticks,
+            "steps": self.steps,
+            "skipped": self.skipped,
+            "late": self.late,
+            "overruns": self.overruns,
+            "avg_ms": round(1000 * self.total_duration / max(self.ticks, 1), 2),
+            "max_ms": round(1000 * self.max_duration, 2),
+            "max_late_ms": round(1000 * self.max_lateness, 2),
+        }
+
+
+class TickSystem:
+    """Подсистема тика: своя частота, бюджет времени и счётчики."""
+
+    def __init__(self, name, rate, fn, budget, essential=False, low_priority=False):
+        self.name = name
+        self.period = 1.0 / rate
+        self.fn = fn
+        self.budget = budget
+        self.essential = essential
+        self.low_priority = low_priority
+        self.credit = self.period   # накопленное время шагов; >= period — пора запускать
+        self.deferred = False       # в прошлый раз отложена из-за бюджета
+        self.overran = False        # прошлый запуск вышел за budget
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.runs = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.over_budget = 0
+        self.defers = 0
+
+
+class SystemScheduler:
+    """Запускает подсистемы каждая со своей частотой на фиксированном шаге тика.
+
+    Каждый шаг добавляет подсистеме step секунд «кредита»; когда набралось на
+    её период — она запускается и кредит уменьшается на период. Так 20 Гц на
+    тиках по 30 мс дают ровно 20 запусков в секунду, без дрейфа.
+
+    Бюджеты соблюдаются откладыванием на следующий шаг (но не два раза
+    подряд; essential — никогда): необязательные подсистемы — если шаг уже
+    выбрал tick_budget, low_priority — ещё и если в этом шаге кто-то вышел
+    за свой бюджет или они сами вышли за него в прошлый запуск. throttle=False
+    (simulate) отключает откладывание: оно зависит от настоящего времени.
+    """
+
+    def __init__(self, step, tick_budget):
+        self.step = step
+        self.tick_budget = tick_budget
+        self.throttle = True
+        self.systems = []
+        self.profiler = None   # TickProfiler: длительности запусков подсистем
+
+    def register(self, name, rate, fn, budget, essential=False, low_priority=False):
+        system = TickSystem(name, min(rate, 1.0 / self.step), fn, budget, essential, low_priority)
+        self.systems.append(system)
+        return system
+
+    def set_rate(self, name, rate):
+        for system in self.systems:
+            if system.name == name:
+                system.period = 1.0 / min(rate, 1.0 / self.step)
+                return True
+        return False
+
+    def run(self, now):
+        started = time.perf_counter()
+        strained = False   # в этом шаге кто-то уже вышел за свой бюджет
+        for system in self.systems:
+            system.credit = min(system.credit + self.step, 2 * system.period)
+            # допуск на погрешность float: подсистема на частоте тиков не должна терять шаги
+            if system.credit < system.period - 1e-9:
+                continue
+            if self.throttle and not system.essential and not system.deferred and (
+                    time.perf_counter() - started > self.tick_budget
+                    or (system.low_priority and (strained or system.overran))):
+                system.deferred = True
+                system.defers += 1
+                continue
+            system.deferred = False
+            system.credit -= system.period
+            t0 = time.perf_counter()
+            system.fn(now, system.period)
+            spent = time.perf_counter() - t0
+            system.runs += 1
+            system.total += spent
+            if spent > system.max:
+                system.max = spent
+            system.overran = spent > system.budget
+            if system.overran:
+                system.over_budget += 1
+                strained = True
+            if self.profiler is not None:
+                self.profiler.add(system.name, spent)
+
+    def reset_stats(self):
+        for system in self.systems:
+            system.reset_stats()
+
+    def summary(self):
+        return {
+            system.name: {
+                "runs": system.runs,
+                "avg_ms": round(1000 * system.total / max(system.runs, 1), 3),
+                "max_ms": round(1000 * system.max, 3),
+                "over_budget": system.over_budget,
+                "deferred": system.defers,
+            }
+            for system in self.systems
+        }
+
+
+class LatencyHistogram:
+    """Скользящая гистограмма длительностей на логарифмических корзинах.
+
+    Окно — PROFILE_SLOTS слотов; rotate() начинает новый слот, стирая самый
+    старый. Запись — один bisect и инкремент, перцентили считаются только
+    при выдаче сводки (с точностью до корзины, ~19%).
+    """
+
+    __slots__ = ("slots", "maxes", "pos")
+
+    def __init__(self, slots=PROFILE_SLOTS):
+        self.slots = [[0] * (len(PROFILE_BOUNDS) + 1) for _ in range(slots)]
+        self.maxes = [0.0] * slots
+        self.pos = 0
+
+    def add(self, seconds):
+        pos = self.pos
+        self.slots[pos][bisect_right(PROFILE_BOUNDS, seconds)] += 1
+        if seconds > self.maxes[pos]:
+            self.maxes[pos] = seconds
+
+    def rotate(self):
+        self.pos = (self.pos + 1) % len(self.slots)
+        counts = self.slots[self.pos]
+        for i in range(len(counts)):
+            counts[i] = 0
+        self.maxes[self.pos] = 0.0
+
+    def summary(self):
+        counts = [sum(column) for column in zip(*self.slots)]
+        total = sum(counts)
+        top = max(self.maxes)
+        result = {"n": total}
+        marks = ((50, "p50_ms"), (95, "p95_ms"), (99, "p99_ms"))
+        seen = 0
+        k = 0
+        for i, c in enumerate(counts):
+            seen += c
+            # перцентиль — верхняя граница корзины, где набралась нужная доля
+            while k < len(marks) and seen and seen * 100 >= marks[k][0] * total:
+                bound = PROFILE_BOUNDS[i] if i < len(PROFILE_BOUNDS) else top
+                result[marks[k][1]] = round(1000 * min(bound, top), 3)
+                k += 1
+        for _, key in marks[k:]:
+            result[key] = 0.0
+        result["max_ms"] = round(1000 * top, 3)
+        return result
+
+
+class TickProfiler:
+    """Гистограммы длительности фаз тика и команд по типам (см. LatencyHistogram).
+
+    Фазы — подсистемы SystemScheduler, разбор inbox, тик целиком и самые
+    тяжёлые проходы внутри подсистем. Включён всегда: запись стоит пару
+    вызовов perf_counter и bisect.
+    """
+
+    def __init__(self, slots=PROFILE_SLOTS):
+        self.slots = slots
+        self.phases = {}     # имя фазы -> LatencyHistogram
+        self.commands = {}   # тип команды -> LatencyHistogram
+
+    def add(self, phase, seconds):
+        hist = self.phases.get(phase)
+        if hist is None:
+            hist = self.phases[phase] = LatencyHistogram(self.slots)
+        hist.add(seconds)
+
+    def add_command(self, cmd, seconds):
+        if cmd not in PROFILE_COMMANDS:
+            cmd = "other"   # имя команды приходит от клиента — не плодим гистограммы
+        hist = self.commands.get(cmd)
+        if hist is None:
+            hist = self.commands[cmd] = LatencyHistogram(self.slots)
+        hist.add(seconds)
+
+    def rotate(self):
+        for hist in self.phases.values():
+            hist.rotate()
+        for hist in self.commands.values():
+            hist.rotate()
+
+    def reset(self):
+        self.phases.clear()
+        self.commands.clear()
+
+    def summary(self):
+        return {
+            "phases": {name: hist.summary() for name, hist in self.phases.items()},
+            "commands": {name: hist.summary() for name, hist in self.commands.items()},
+        }
+
+
+class Timer:
+    """Запланированный вызов; отменённый остаётся в куче до своего срока."""
+
+    __slots__ = ("when", "fn", "args", "cancelled")
+
+    def __init__(self, when, fn, args):
+        self.when = when
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+
+class TimerService:
+    """Отложенные вызовы игры на куче по времени срабатывания.
+
+    Долгие таймеры (рестарт мёртвого, волны врагов, возвращение Изгнанника)
+    ставятся один раз и ничего не стоят до своего срока: тик только смотрит
+    на вершину кучи. Отмена ленивая — запись помечается и выбрасывается,
+    когда до неё дойдёт очередь; если отменённых больше половины, куча
+    пересобирается.
+
+    Обработчик вызывается как fn(now, *args), где now — время шага тика,
+    на котором таймер сработал (на догоняющем шаге оно в прошлом).
+    """
+
+    def __init__(self):
+        self.heap = []                  # (when, порядковый номер, Timer)
+        self.order = itertools.count()  # равные сроки — в порядке постановки
+        self.cancelled = 0
+        self.fired = 0
+
+    def __len__(self):
+        return len(self.heap) - self.cancelled
+
+    def schedule(self, when, fn, *args) -> Timer:
+        timer = Timer(when, fn, args)
+        heapq.heappush(self.heap, (when, next(self.order), timer))
+        return timer
+
+    def cancel(self, timer):
+        """Отменяет таймер; None и уже сработавшие/отменённые пропускаются."""
+        if timer is None or timer.cancelled or timer.fn is None:
+            return
+        timer.cancelled = True
+        self.cancelled += 1
+        if self.cancelled > 64 and self.cancelled * 2 > len(self.heap):
+            self.heap = [item for item in self.heap if not item[2].cancelled]
+            heapq.heapify(self.heap)
+            self.cancelled = 0
+
+    def run_due(self, now):
+        """Вызывает всё, чей срок наступил; таймеры, поставленные из
+        обработчиков на уже прошедшее время, срабатывают в этом же вызове."""
+        heap = self.heap
+        while heap and heap[0][0] <= now:
+            timer = heapq.heappop(heap)[2]
+            if timer.cancelled:
+                self.cancelled -= 1
+                continue
+            fn, args = timer.fn, timer.args
+            timer.fn = None     # сработал: cancel() на нём больше ничего не делает
+            self.fired += 1
+            fn(now, *args)
+
+
+class Outbox:
+    """Ограниченная очередь исходящих кадров одного клиента.
+
+    Игровой поток только кладёт сюда готовые байты, а в сокет их пишет
+    отдельный писатель (поток клиента или цикл select), поэтому медленный
+    клиент не держит GameServer.lock. Кадры "state" — «последний побеждает»:
+    новый state вытесняет ещё не отправленный старый. Остальные сообщения
+    (event, error, attack) не выбрасываются.
+
+    Медленный клиент — тот, у кого писатель не забрал уже отданное ему
+    flush(): если таких байт больше limit, очередь закрывается с overflow и
+    клиента отключают. Сколько кадров игра наложила за один тик (массовый
+    бой — сотни attack и event), на это не влияет.
+
+    push писателя не будит: всё, что игра наложила за тик, уходит одной
+    записью после flush() в конце тика.
+    """
+
+    def __init__(self, limit=OUTBOX_LIMIT):
+        self.limit = limit
+        self.frames = deque()       # (kind, bytes)
+        self.has_state = False
+        self.pending_bytes = 0      # байт в очереди
+        self.offered = 0            # сколько первых кадров очереди отдано писателю (flush)
+        self.offered_bytes = 0      # и их размер: то, что писатель ещё не забрал
+        self.cond = threading.Condition()
+        self.closed = False
+        self.overflow = False
+        self.flushed = False        # writer может забирать кадры
+        # колбэк «есть что писать» для цикла select (в режиме threads не нужен)
+        self.on_ready = None
+
+        # счётчики для мониторинга
+        self.max_depth = 0
+        self.dropped_states = 0
+        self.sent_frames = 0
+        self.sent_bytes = 0
+
+    def push(self, kind, data: bytes) -> bool:
+        with self.cond:
+            if self.closed:
+                return False
+            if self.offered_bytes > self.limit:
+                self.overflow = True
+                self.closed = True
+                self.cond.notify_all()
+                return False
+            if kind == "state" and self.has_state:
+                for i, (k, old) in enumerate(self.frames):
+                    if k == "state":
+                        del self.frames[i]
+                        self.pending_bytes -= len(old)
+                        if i < self.offered:
+                            self.offered -= 1
+                            self.offered_bytes -= len(old)
+                        self.dropped_states += 1
+                        break
+            self.frames.append((kind, data))
+            self.pending_bytes += len(data)
+            if kind == "state":
+                self.has_state = True
+            if len(self.frames) > self.max_depth:
+                self.max_depth = len(self.frames)
+        return True
+
+    def flush(self):
+        """Отдаёт накопленное писателю (конец тика или ответ вне тика)."""
+        with self.cond:
+            if not self.frames or self.closed:
+                return
+            self.offered = len(self.frames)
+            self.offered_bytes = self.pending_bytes
+            if self.flushed:
+                # писатель ещё не забрал прошлое — будить некого
+                return
+            self.flushed = True
+            self.cond.notify()
+            on_ready = self.on_ready
+        if on_ready is not None:
+            on_ready()
+
+    def take(self, block=True):
+        """Забирает все накопленные кадры. Пустой список — очередь закрыта (или пуста при block=False)."""
+        with self.cond:
+            while block and not self.flushed and not self.closed:
+                self.cond.wait()
+            if not self.flushed and not self.closed:
+                return []
+            self.flushed = False
+            frames = [data for _, data in self.frames]
+            self.frames.clear()
+            self.has_state = False
+            self.pending_bytes = 0
+            self.offered = 0
+            self.offered_bytes = 0
+            self.sent_frames += len(frames)
+            self.sent_bytes += sum(len(d) for d in frames)
+            return frames
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    @property
+    def depth(self):
+        return len(self.frames)
+
+    def stats(self):
+        return {
+            "depth": self.depth,
+            "max_depth": self.max_depth,
+            "unsent_bytes": self.pending_bytes,
+            "dropped_states": self.dropped_states,
+            "sent_frames": self.sent_frames,
+            "sent_bytes": self.sent_bytes,
+        }
 
 
-def send_json(sock, obj):
-    try:
-        data = json.dumps(obj, ensure_ascii=False) + "\n"
-        sock.sendall(data.encode("utf-8"))
-    except Exception:
+def send_frames(sock, frames):
+    """Пишет список буферов в блокирующий сокет, по возможности одним sendmsg без склейки."""
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(b"".join(frames))
+        return
+    views = [memoryview(f) for f in frames if f]
+    while views:
+        sent = sock.sendmsg(views[:NET_IOV_MAX])
+        while views and sent >= len(views[0]):
+            sent -= len(views[0])
+            views.pop(0)
+        if sent:
+            views[0] = views[0][sent:]
+
+
+class SessionRecorder:
+    """Запись сессии для повтора (replay.py): принятые hello, command и уходы
+    с номером тика, по JSON-строке на запись; файл только дописывается.
+
+    Первая строка сессии — заголовок с зерном, интервалом тика и настройками
+    сервера, дальше [тик, вид, pid, сообщение], вид: j — вход, c — команда,
+    l — уход. Пишется из игрового потока, сбрасывается раз в тик.
+    """
+
+    def __init__(self, path, header: dict):
+        self.file = open(path, "a", encoding="utf-8")
+        self.dirty = False
+        self.records = 0
+        self.write(dict(header, type="session", version=1))
+
+    def write(self, record):
+        self.file.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+        self.dirty = True
+
+    def join(self, tick, player):
+        hello = {"type": "hello", "name": player.name, "class": player.cls,
+                 "snapshots": player.use_snapshots, "proto": player.proto}
+        self.write([tick, "j", player.id, hello])
+        self.records += 1
+
+    def command(self, tick, player, msg):
+        self.write([tick, "c", player.id, msg])
+        self.records += 1
+
+    def leave(self, tick, player):
+        self.write([tick, "l", player.id])
+        self.records += 1
+
+    def flush(self):
+        if self.dirty:
+            self.file.flush()
+            self.dirty = False
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class NullConn:
+    """Соединение без сокета (simulate, бенчмарки): закрыть можно, писать некуда —
+    очереди таких игроков разбирает drain_outboxes."""
+
+    def shutdown(self, how):
         pass
 
+    def close(self):
+        pass
+
+
+class SelectConn:
+    """Сокет клиента в режиме select: буферы чтения/записи и игрок (после hello)."""
+
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.inbuf = bytearray()
+        self.outbuf = b""
+        self.want_write = False
+        self.player = None
+
+    def feed(self, data: bytes):
+        """Добавляет прочитанные байты и возвращает список целых сообщений.
+
+        Клиент может слать и JSON-строки, и бинарные кадры FRAME_JSON —
+        различаем по первому байту.
+        """
+        self.inbuf += data
+        buf = self.inbuf
+        msgs = []
+        pos = 0
+        while pos < len(buf):
+            first = buf[pos]
+            if first in b"\r\n ":
+                pos += 1
+                continue
+            if first == ord("{"):
+                end = buf.find(b"\n", pos)
+                if end < 0:
+                    if len(buf) - pos > NET_MAX_LINE:
+                        raise ValueError("слишком длинное сообщение от клиента")
+                    break
+                msgs.append(json.loads(bytes(buf[pos:end])))
+                pos = end + 1
+                continue
+            if len(buf) - pos < FRAME_HEADER.size:
+                break
+            kind, length = FRAME_HEADER.unpack_from(buf, pos)
+            if length > FRAME_MAX:
+                raise ValueError("слишком большой кадр от клиента")
+            end = pos + FRAME_HEADER.size + length
+            if len(buf) < end:
+                break
+            if kind == FRAME_JSON:
+                msgs.append(json.loads(bytes(buf[pos + FRAME_HEADER.size:end])))
+            pos = end
+        del buf[:pos]
+        return msgs
 
-def recv_json_line(f):
-    line = f.readline()
-    if not line:
-        return None
-    line = line.strip()
-    if not line:
-        return None
-    return json.loads(line)
+
+_MISSING = object()
+
+
+def _dict_delta(old: dict, new: dict) -> dict:
+    """Поля new, которые отличаются от old (id оставляем всегда)."""
+    out = {k: v for k, v in new.items() if old.get(k, _MISSING) != v}
+    if "id" in new:
+        out["id"] = new["id"]
+    return out
+
+
+class LevelSnapshot:
+    """Видимое состояние уровня на момент рассылки.
+
+    Строится один раз на уровень и разделяется всеми игроками на нём
+    (на больших этажах каждый получает свою visible_part).
+    Дельты считаются между двумя снимками и кэшируются по базовому снимку
+    и протоколу: игроки, подтвердившие один и тот же снимок, получают одни
+    и те же байты.
+    """
+
+    def __init__(self, stage, level: dict, enemies: dict, players: dict):
+        self.stage = stage
+        self.level = level          # поля уровня без списка врагов
+        self.enemies = enemies      # eid -> dict
+        self.players = players      # pid -> dict
+        self._legacy = None
+        self._deltas = {}
+
+    def legacy_bytes(self) -> bytes:
+        """Полные "level"/"players" в старом формате state (без внешних скобок)."""
+        if self._legacy is None:
+            shared = {
+                "level": dict(self.level, enemies=list(self.enemies.values())),
+                "players": list(self.players.values()),
+            }
+            self._legacy = json.dumps(shared, ensure_ascii=False)[1:-1].encode("utf-8")
+        return self._legacy
+
+    def diff(self, base):
+        """Что изменилось с base: (поля level или None, {имя: (новые, изменённые пары, ушедшие id)})."""
+        if base is None:
+            return self.level, {
+                "enemies": (list(self.enemies.values()), [], []),
+                "players": (list(self.players.values()), [], []),
+            }
+        level = _dict_delta(base.level, self.level) or None
+        parts = {}
+        for name, cur, old in (("enemies", self.enemies, base.enemies),
+                               ("players", self.players, base.players)):
+            new, changed = [], []
+            for eid, rec in cur.items():
+                prev = old.get(eid)
+                if prev is None:
+                    new.append(rec)
+                elif prev is not rec and prev != rec:
+                    changed.append((prev, rec))
+            gone = [eid for eid in old if eid not in cur]
+            parts[name] = (new, changed, gone)
+        return level, parts
+
+    def visible_part(self, rect, prev=None, own_id=None):
+        """Часть снимка внутри rect = (x0, y0, x1, y1); сам снимок, если видно всё.
+
+        Сущности, которые были в prev (прошлый снимок этого игрока), держатся,
+        пока не выйдут за rect, расширенный на AOI_HYSTERESIS, — иначе на
+        границе они бы мигали. Вход и выход из области — обычные новые и
+        ушедшие записи дельты.
+        """
+        x0, y0, x1, y1 = rect
+        if x0 <= 0 and y0 <= 0 and x1 >= self.level["width"] and y1 >= self.level["height"]:
+            return self
+
+        def pick(records, old, keep=None):
+            out = {}
+            for rid, rec in records.items():
+                m = AOI_HYSTERESIS if old is not None and rid in old else 0.0
+                if (x0 - m <= rec["x"] <= x1 + m and y0 - m <= rec["y"] <= y1 + m) or rid == keep:
+                    out[rid] = rec
+            return out
+
+        enemies = pick(self.enemies, prev.enemies if prev is not None else None)
+        players = pick(self.players, prev.players if prev is not None else None, own_id)
+        if len(enemies) == len(self.enemies) and len(players) == len(self.players):
+            return self
+        return LevelSnapshot(self.stage, self.level, enemies, players)
+
+    def delta_bytes(self, base) -> bytes:
+        """JSON-тело кадра snapshot относительно base (None — полный снимок), без внешних скобок."""
+        key = (id(base) if base is not None else None, PROTO_JSON)
+        data = self._deltas.get(key)
+        if data is None:
+            level, parts = self.diff(base)
+            body = {}
+            if level:
+                body["level"] = level
+            for name, (new, changed, gone) in parts.items():
+                recs = new + [_dict_delta(prev, rec) for prev, rec in changed]
+                if recs:
+                    body[name] = recs
+                if gone:
+                    body[name + "_gone"] = gone
+            data = json.dumps(body, ensure_ascii=False)[1:-1].encode("utf-8")
+            self._deltas[key] = data
+        return data
+
+    def binary_bytes(self, base, names: NameTable):
+        """Бинарное тело FRAME_SNAPSHOT после записи you: (есть ли блок level, байты).
+
+        Новые сущности идут полной записью, изменённые — короткой записью
+        с динамическими полями, ушедшие — списком id.
+        """
+        key = (id(base) if base is not None else None, PROTO_BINARY)
+        cached = self._deltas.get(key)
+        if cached is not None:
+            return cached
+        level, parts = self.diff(base)
+        out = []
+        if level:
+            raw = json.dumps(level, ensure_ascii=False).encode("utf-8")
+            out.append(BLOB_LEN.pack(len(raw)))
+            out.append(raw)
+
+        new, changed, gone = parts["enemies"]
+        out.append(COUNT.pack(len(new)))
+        for e in new:
+            flags = (EF_RANGED if e["etype"] == "ranged" else 0) | \
+                (EF_BOSS if e["boss"] else 0) | (EF_MINIBOSS if e["miniboss"] else 0)
+            out.append(ENEMY_FULL.pack(e["id"], names.code(e["name"]), flags, int(e["hp"]),
+                                       int(e["max_hp"]), quant(e["x"]), quant(e["y"])))
+        out.append(COUNT.pack(len(changed)))
+        for _, e in changed:
+            out.append(ENEMY_DYN.pack(e["id"], int(e["hp"]), quant(e["x"]), quant(e["y"])))
+        out.append(COUNT.pack(len(gone)))
+        out.extend(ID.pack(eid) for eid in gone)
+
+        new, changed, gone = parts["players"]
+        out.append(COUNT.pack(len(new)))
+        for p in new:
+            out.append(PLAYER_FULL.pack(p["id"], names.code(p["name"]), CLASS_CODES.get(p["class"], 0),
+                                        _player_flags(p), p["stage"], int(p["hp"]), int(p["max_hp"]),
+                                        int(p["mana"]), int(p["max_mana"]), quant(p["x"]), quant(p["y"])))
+        out.append(COUNT.pack(len(changed)))
+        for _, p in changed:
+            out.append(PLAYER_DYN.pack(p["id"], _player_flags(p), int(p["hp"]), int(p["mana"]),
+                                       quant(p["x"]), quant(p["y"])))
+        out.append(COUNT.pack(len(gone)))
+        out.extend(ID.pack(pid) for pid in gone)
+
+        data = b"".join(out)
+        self._deltas[key] = (bool(level), data)
+        return self._deltas[key]
+
+
+def _player_flags(p: dict) -> int:
+    return (PF_ALIVE if p["alive"] else 0) | (PF_READY if p.get("archer_stance") == "ready" else 0)
 
 
 class Player:
-    def __init__(self, pid, name, cls_name, conn, fileobj):
+    def __init__(self, pid, name, cls_name, conn, fileobj, now=None):
         self.id = pid
         self.name = name
         self.cls = cls_name
         self.conn = conn
         self.file = fileobj
+        self.outbox = Outbox()
+        self.dropped = False  # отключён сервером как слишком медленный
+        self.admin = False    # соединение оператора (hello с admin): в мир не входит
+
+        # протокол соединения (PROTO_JSON / PROTO_BINARY) и сколько записей
+        # журнала NameTable (какой эпохи) клиент уже получил
+        self.proto = PROTO_JSON
+        self.names_sent = 0
+        self.names_epoch = 0
+
+        # дельта-снимки: включаются клиентом в hello ("snapshots": true)
+        self.use_snapshots = False
+        self.snap_seq = 0           # номер последнего отправленного снимка
+        self.snap_acked = None      # последний подтверждённый клиентом номер
+        self.snapshots = {}         # seq -> LevelSnapshot (последние SNAPSHOT_HISTORY)
+        self.last_view = None       # последний отправленный (уже отфильтрованный по AOI) снимок
 
         self.stage = 0
         self.x = MAP_WIDTH / 2.0
         self.y = MAP_HEIGHT / 2.0
+        self.grid_stage = None   # в сетке какого уровня игрок сейчас лежит
 
         self.max_hp = 0
         self.hp = 0
@@ -99,7 +1047,8 @@ class Player:
         self.dead_since = None
 
         # для регена
-        now = time.time()
+        if now is None:
+            now = time.time()
         self.last_damage_time = now
         self.last_attack_time = now
         self.last_mana_spent_time = now
@@ -116,6 +1065,14 @@ class Player:
 
         self.can_attack = True  # хилер не может атаковать
 
+        # движение по состоянию ввода: направление держится, пока клиент
+        # не пришлёт новое; сервер сам двигает игрока в tick_loop
+        self.move_dx = 0.0
+        self.move_dy = 0.0
+        self.input_seq = 0       # номер последнего принятого ввода
+        self.input_time = 0.0    # сколько секунд сервер уже двигал игрока по этому вводу
+        self.respawn_timer = None  # рестарт на 1 уровень через DEATH_TIMEOUT после смерти
+
 
 class Enemy:
     def __init__(self, eid, name, etype, hp, attack, defense, x, y, miniboss=False, boss=False):
@@ -132,18 +1089,258 @@ class Enemy:
         self.boss = boss
 
 
+def _enemy_column(name, cast):
+    def get(self):
+        return cast(getattr(self.store, name)[self.row])
+
+    def set(self, value):
+        getattr(self.store, name)[self.row] = value
+
+    return property(get, set)
+
+
+class EnemyView(Enemy):
+    """Враг, чьи числа лежат строкой в EnemyStore.
+
+    Снаружи ведёт себя как Enemy: остальной код читает и пишет x, y, hp
+    как обычно, а векторные проходы уровня работают прямо со столбцами.
+    """
+
+    x = _enemy_column("x", float)
+    y = _enemy_column("y", float)
+    hp = _enemy_column("hp", int)
+    max_hp = _enemy_column("max_hp", int)
+    attack = _enemy_column("attack", int)
+    defense = _enemy_column("defense", int)
+
+    def __init__(self, store, row, eid, name):
+        self.store = store
+        self.row = row
+        self.id = eid
+        self.name = name
+
+    @property
+    def etype(self):
+        return "ranged" if self.store.flags[self.row] & EF_RANGED else "melee"
+
+    def detach(self) -> Enemy:
+        """Обычный Enemy с теми же значениями (строка хранилища может быть перезаписана)."""
+        enemy = Enemy(self.id, self.name, self.etype, self.max_hp, self.attack, self.defense,
+                      self.x, self.y, miniboss=self.miniboss, boss=self.boss)
+        enemy.hp = self.hp
+        return enemy
+
+    @property
+    def boss(self):
+        return bool(self.store.flags[self.row] & EF_BOSS)
+
+    @property
+    def miniboss(self):
+        return bool(self.store.flags[self.row] & EF_MINIBOSS)
+
+
+class EnemyStore:
+    """Враги уровня столбцами NumPy (struct of arrays): координаты, hp,
+    атака, защита и флаги EF_* — по строке на врага, views[i] — его Enemy.
+
+    Нужен для этажей с сотнями мобов: погоня за ближайшим игроком,
+    прижатие к карте и calc_damage идут одним шагом на всю волну.
+    """
+
+    COLUMNS = (
+        ("x", "f8"), ("y", "f8"),
+        ("hp", "i8"), ("max_hp", "i8"), ("attack", "i8"), ("defense", "i8"),
+        ("flags", "u1"),
+    )
+
+    def __init__(self, capacity=32):
+        self.n = 0
+        self.views = []
+        for name, dtype in self.COLUMNS:
+            setattr(self, name, np.zeros(capacity, dtype=dtype))
+
+    def clear(self):
+        self.n = 0
+        self.views = []
+
+    def add(self, enemy) -> EnemyView:
+        """Кладёт врага новой строкой и возвращает его view."""
+        flags = (EF_RANGED if enemy.etype == "ranged" else 0) | \
+            (EF_BOSS if enemy.boss else 0) | (EF_MINIBOSS if enemy.miniboss else 0)
+        values = (enemy.x, enemy.y, enemy.hp, enemy.max_hp, enemy.attack, enemy.defense, flags)
+        row = self.n
+        if row == len(self.x):
+            for name, _ in self.COLUMNS:
+                col = getattr(self, name)
+                setattr(self, name, np.concatenate([col, np.zeros_like(col)]))
+        for (name, _), value in zip(self.COLUMNS, values):
+            getattr(self, name)[row] = value
+        view = EnemyView(self, row, enemy.id, enemy.name)
+        self.views.append(view)
+        self.n += 1
+        return view
+
+    def alive_rows(self, melee_only=False):
+        rows = self.hp[:self.n] > 0
+        if melee_only:
+            rows &= (self.flags[:self.n] & EF_RANGED) == 0
+        return np.flatnonzero(rows)
+
+    def nearest(self, rows, px, py):
+        """Для каждой строки rows — индекс ближайшей из точек (px, py)
+        и квадрат расстояния до неё."""
+        dx = px[None, :] - self.x[rows, None]
+        dy = py[None, :] - self.y[rows, None]
+        d2 = dx * dx + dy * dy
+        near = d2.argmin(axis=1)
+        return near, d2[np.arange(len(rows)), near]
+
+    def step_towards(self, rows, tx, ty, step, width, height):
+        """Сдвигает строки rows на step к (tx, ty), не перескакивая цель,
+        и прижимает к границам карты."""
+        dx = tx - self.x[rows]
+        dy = ty - self.y[rows]
+        length = np.sqrt(dx * dx + dy * dy)
+        length[length == 0] = 1.0
+        move = np.minimum(step, length)
+        self.x[rows] = np.clip(self.x[rows] + dx / length * move, 0.0, width - 1)
+        self.y[rows] = np.clip(self.y[rows] + dy / length * move, 0.0, height - 1)
+
+
+class SpatialGrid:
+    """Равномерная сетка уровня для поиска ближайших и попавших в радиус.
+
+    Объекты (игроки или враги) лежат в ячейках по своим координатам;
+    после каждого перемещения вызывается move(), и объект переезжает
+    в другую ячейку только если пересёк её границу. Запросы смотрят
+    ячейки вокруг точки, а не всех на уровне.
+    """
+
+    def __init__(self, width, height, cell=GRID_CELL):
+        self.cell = cell
+        self.max_ring = int(max(width, height) // cell) + 1
+        self.cells = {}    # (cx, cy) -> {id: объект}
+        self.where = {}    # id -> (cx, cy)
+
+    def __len__(self):
+        return len(self.where)
+
+    def _key(self, x, y):
+        return int(x // self.cell), int(y // self.cell)
+
+    def move(self, obj):
+        """Вставляет объект или переносит его в ячейку по текущим x, y."""
+        key = self._key(obj.x, obj.y)
+        old = self.where.get(obj.id)
+        if old == key:
+            return
+        if old is not None:
+            bucket = self.cells[old]
+            del bucket[obj.id]
+            if not bucket:
+                del self.cells[old]
+        self.cells.setdefault(key, {})[obj.id] = obj
+        self.where[obj.id] = key
+
+    def remove(self, oid):
+        key = self.where.pop(oid, None)
+        if key is None:
+            return
+        bucket = self.cells[key]
+        del bucket[oid]
+        if not bucket:
+            del self.cells[key]
+
+    def clear(self):
+        self.cells.clear()
+        self.where.clear()
+
+    def query_radius(self, x, y, radius, pred=None):
+        """Все объекты в круге (x, y, radius), для которых pred(obj) истинно."""
+        r2 = radius * radius
+        x0, y0 = self._key(x - radius, y - radius)
+        x1, y1 = self._key(x + radius, y + radius)
+        out = []
+        for cx in range(x0, x1 + 1):
+            for cy in range(y0, y1 + 1):
+                bucket = self.cells.get((cx, cy))
+                if not bucket:
+                    continue
+                for obj in bucket.values():
+                    dx = obj.x - x
+                    dy = obj.y - y
+                    if dx * dx + dy * dy <= r2 and (pred is None or pred(obj)):
+                        out.append(obj)
+        return out
+
+    def nearest(self, x, y, k=1, pred=None):
+        """До k ближайших объектов (по возрастанию расстояния), для которых pred(obj) истинно.
+
+        Обходим кольца ячеек вокруг точки; всё, что дальше кольца r, не ближе
+        r * cell, поэтому останавливаемся, как только k найденных ближе этого.
+        """
+        if not self.where:
+            return []
+        kx, ky = self._key(x, y)
+        found = []    # (dist2, порядок, объект)
+        for ring in range(self.max_ring + 1):
+            if ring == 0:
+                keys = [(kx, ky)]
+            else:
+                keys = [(kx + d, ky - ring) for d in range(-ring, ring + 1)]
+                keys += [(kx + d, ky + ring) for d in range(-ring, ring + 1)]
+                keys += [(kx - ring, ky + d) for d in range(-ring + 1, ring)]
+                keys += [(kx + ring, ky + d) for d in range(-ring + 1, ring)]
+            for key in keys:
+                bucket = self.cells.get(key)
+                if not bucket:
+                    continue
+                for obj in bucket.values():
+                    if pred is None or pred(obj):
+                        found.append(((obj.x - x) ** 2 + (obj.y - y) ** 2, len(found), obj))
+            if len(found) >= k:
+                found.sort()
+                reach = ring * self.cell
+                if found[k - 1][0] <= reach * reach:
+                    break
+        found.sort()
+        return [obj for _, _, obj in found[:k]]
+
+
+def _is_alive_player(p):
+    return p.alive
+
+
+def _is_alive_enemy(e):
+    return e.hp > 0
+
+
 class LevelState:
-    def __init__(self, stage, width, height):
+    def __init__(self, stage, width, height, arrays=False, now=None):
         self.stage = stage
         self.width = width
         self.height = height
 
-        self.enemies = []
-        self.last_enemy_attack = time.time()
-        self.last_enemy_move = time.time()
+        self.enemies = []          # все враги волны, включая ещё не вычищенных мёртвых
+        self.enemy_by_id = {}      # живые: id -> враг, в порядке self.enemies
+        self.dead_enemies = 0      # мёртвых в self.enemies (см. compact_enemies)
+        # числа врагов столбцами NumPy (--enemy-arrays), иначе None
+        self.store = EnemyStore() if arrays else None
+        # пространственные сетки: враги уровня и игроки, стоящие на нём
+        self.enemy_grid = SpatialGrid(width, height)
+        self.player_grid = SpatialGrid(width, height)
+        if now is None:
+            now = time.time()
+        self.last_enemy_attack = now
+        self.last_enemy_move = now
         self.shield_buff_until = 0.0
         self.completed = False
-        self.last_respawn = time.time()
+        self.last_respawn = now
+        # таймеры уровня в GameServer.timers: "wave" — волна врагов, "boss" — возвращение Изгнанника
+        self.timers = {}
+        # сработавшие без живых игроков на уровне: ждут первого живого
+        self.parked = {}
+        self.evict_timer = None   # выгрузка, пока на уровне никого нет
 
         # дверь на следующий уровень
         self.door_open = False
@@ -187,23 +1384,117 @@ class LevelState:
         self.hazards = []
 
     def enemies_alive(self):
-        return any(e.hp > 0 for e in self.enemies)
+        return bool(self.enemy_by_id)
+
+    def alive_enemies(self):
+        """Живые враги списком (копия: по нему можно бить и убивать)."""
+        return list(self.enemy_by_id.values())
+
+    def enemy_died(self, enemy):
+        """Вызывается там, где hp врага упало до нуля: убирает его из живых и из сетки."""
+        if self.enemy_by_id.pop(enemy.id, None) is None:
+            return
+        self.enemy_grid.remove(enemy.id)
+        self.dead_enemies += 1
+
+    def compact_enemies(self):
+        """Выбрасывает мёртвых из self.enemies, когда их набралось больше живых.
+
+        Не вызывать посреди прохода по врагам: с EnemyStore строки
+        переезжают и старые view становятся недействительны.
+        """
+        if self.dead_enemies < max(ENEMY_COMPACT_MIN, len(self.enemy_by_id)):
+            return
+        self.set_enemies(self.alive_enemies())
+
+    def set_enemies(self, enemies):
+        """Заменяет всех врагов уровня (новая волна) и пересобирает их сетку."""
+        if self.store is not None:
+            # строки могут прийти из этого же хранилища — сначала копируем
+            enemies = [e.detach() if isinstance(e, EnemyView) else e for e in enemies]
+            self.store.clear()
+            enemies = [self.store.add(e) for e in enemies]
+        self.enemies = enemies
+        self.enemy_by_id = {e.id: e for e in enemies if e.hp > 0}
+        self.dead_enemies = len(enemies) - len(self.enemy_by_id)
+        self.enemy_grid.clear()
+        for e in self.enemy_by_id.values():
+            self.enemy_grid.move(e)
+
+    def add_enemy(self, enemy):
+        """Добавляет врага; с EnemyStore возвращается его view."""
+        if self.store is not None:
+            enemy = self.store.add(enemy)
+        self.enemies.append(enemy)
+        self.enemy_by_id[enemy.id] = enemy
+        self.enemy_grid.move(enemy)
+        return enemy
+
+    def nearest_player(self, x, y):
+        """Ближайший живой игрок на уровне или None."""
+        found = self.player_grid.nearest(x, y, pred=_is_alive_player)
+        return found[0] if found else None
+
+    def nearest_enemy(self, x, y):
+        """Ближайший живой враг на уровне или None."""
+        found = self.enemy_grid.nearest(x, y, pred=_is_alive_enemy)
+        return found[0] if found else None
 
 
 class GameServer:
-    def __init__(self):
+    def __init__(self, clock=None, rng=None, seed=None):
+        # часы и случайность игры: всё игровое время — self.clock.time(), все броски — self.rng.
+        # По умолчанию настоящие часы (модуль time); VirtualClock + seed дают
+        # повторяемый прогон быстрее реального времени (см. simulate)
+        self.clock = clock if clock is not None else time
+        if seed is None and rng is None:
+            seed = random.getrandbits(32)
+        self.seed = seed
+        self.rng = rng if rng is not None else random.Random(seed)
         self.players = {}   # pid -> Player
         self.levels = {}    # stage -> LevelState
+        # выгруженные уровни: stage -> компактное состояние (дверь, таймеры), см. evict_level
+        self.dormant = {}
+        self.level_evict_after = LEVEL_EVICT_AFTER
+        # враги столбцами NumPy (EnemyStore) вместо объектов; включается --enemy-arrays
+        self.enemy_arrays = False
+        # зерно NumPy берём из self.rng всегда, есть numpy или нет: иначе одно и то же
+        # --seed (и запись сессии) разыгрывалось бы по-разному на хостах с numpy и без
+        np_seed = self.rng.getrandbits(64)
+        self.np_random = np.random.default_rng(np_seed) if np is not None else None
         self.next_player_id = 1
         self.next_enemy_id = 1
         self.lock = threading.Lock()
+        # входящие от сетевых потоков: (вид, игрок, сообщение), вид — join/command/leave.
+        # Сетевые потоки только добавляют (deque.append атомарен), игровой поток
+        # разбирает всё в начале тика — GameServer.lock они не трогают
+        self.inbox = deque()
+        self.inbox_applied = 0        # сколько записей разобрано всего
+        self.inbox_seconds = 0.0      # и сколько времени это заняло
+        self.tick_stats = TickStats()
+        self.tick_count = 0            # шагов симуляции с запуска (номер тика в записи сессии)
+        self.recorder = None           # SessionRecorder, если включена запись (--record)
+        self.profiler = TickProfiler()  # гистограммы фаз тика и команд (admin profile, [PROFILE])
+        self.admin_token = None        # пароль соединений оператора (--admin-token); None — не пускаем
+        self.timers = TimerService()   # долгие таймеры игры (см. system_timers)
+        self.systems = SystemScheduler(TICK_INTERVAL, TICK_BUDGET)
+        self.systems.profiler = self.profiler
+        for name, (rate, budget_ms) in SYSTEM_RATES.items():
+            self.systems.register(name, rate, getattr(self, "system_" + name),
+                                  budget_ms / 1000.0, essential=name in SYSTEM_ESSENTIAL,
+                                  low_priority=name in SYSTEM_LOW_PRIORITY)
         self.running = True
+        self.names = NameTable()   # коды имён для бинарного протокола
+        self.dirty_stages = set()  # уровни, изменённые командами с прошлой рассылки
+        # индексы по этажам: stage -> {pid: Player}; ведутся в place_player/set_alive
+        self.players_by_stage = {}
+        self.alive_by_stage = {}
 
     # --------- Игровая логика ---------
 
     def create_player_stats(self, p: Player):
         cls = p.cls.lower()
-        now = time.time()
+        now = self.clock.time()
         if cls in ("воин", "warrior"):
             p.max_hp = 160
             p.max_mana = 10
@@ -271,25 +1562,25 @@ class GameServer:
         lvl = self.levels.get(stage)
         if lvl is None:
             w, h = self.get_map_size_for_stage(stage)
-            lvl = LevelState(stage, w, h)
+            lvl = LevelState(stage, w, h, arrays=self.enemy_arrays, now=self.clock.time())
 
             if stage == 0:
                 # ХАБ: нет врагов, только дверь наверх
-                lvl.enemies = []
+                lvl.set_enemies([])
                 lvl.completed = True
                 lvl.door_open = True
                 lvl.door_x = w / 2.0
                 lvl.door_y = 2.0
             elif stage == 11:
                 # 11 уровень — "Безопасная зона"
-                lvl.enemies = []
+                lvl.set_enemies([])
                 lvl.completed = True
                 lvl.door_open = True
                 lvl.door_x = w / 2.0
                 lvl.door_y = 2.0
             else:
                 # обычные боевые уровни
-                lvl.enemies = self.generate_enemies(stage)
+                lvl.set_enemies(self.generate_enemies(stage))
 
             # ### Специальная первичная инициализация для 10 уровня (Изгнанник)
             if stage == 10:
@@ -305,8 +1596,123 @@ class GameServer:
                     lvl.boss_last_death_time = 0.0
 
             self.levels[stage] = lvl
+            self.schedule_wave(lvl)
+            saved = self.dormant.pop(stage, None)
+            if saved is not None:
+                self.restore_level(lvl, saved)
         return lvl
 
+    def evict_level(self, now: float, stage: int, lvl: LevelState):
+        """Уровень простоял пустым level_evict_after секунд: выгружаем его,
+        оставив только то, что нельзя сгенерировать заново, — зачищен ли он,
+        дверь, смерть Изгнанника и сроки таймеров."""
+        lvl.evict_timer = None
+        if self.levels.get(stage) is not lvl or self.stage_players(stage):
+            return
+        timers = {}
+        for key, timer in lvl.timers.items():
+            _, _, fn = timer.args
+            # ждущий спавн Изгнанника без круга не восстановить — повторим телеграф
+            if fn == self.boss10_spawn:
+                fn = self.boss10_telegraph
+            timers[key] = (timer.when, fn.__name__)
+            self.timers.cancel(timer)
+        for key, fn in lvl.parked.items():
+            timers[key] = (0.0, fn.__name__)
+        self.dormant[stage] = {
+            "cleared": not lvl.enemies_alive(),
+            "completed": lvl.completed,
+            "last_respawn": lvl.last_respawn,
+            "door": (lvl.door_open, lvl.door_x, lvl.door_y),
+            "boss_alive": lvl.boss_alive,
+            "boss_last_death_time": lvl.boss_last_death_time,
+            "timers": timers,
+        }
+        del self.levels[stage]
+        self.dirty_stages.discard(stage)
+        self.players_by_stage.pop(stage, None)
+        self.alive_by_stage.pop(stage, None)
+        print(f"[LEVEL] уровень {stage} выгружен после простоя", flush=True)
+
+    def restore_level(self, lvl: LevelState, saved: dict):
+        """Возвращает выгруженному уровню состояние, сохранённое evict_level."""
+        if saved["cleared"]:
+            lvl.set_enemies([])
+        elif lvl.stage == 10 and not saved["boss_alive"]:
+            lvl.set_enemies([e for e in lvl.enemies if not e.boss])
+        if lvl.stage == 10 and not saved["boss_alive"]:
+            lvl.boss_alive = False
+            lvl.boss_phase = None
+        lvl.boss_last_death_time = saved["boss_last_death_time"]
+        lvl.completed = saved["completed"]
+        lvl.last_respawn = saved["last_respawn"]
+        lvl.door_open, lvl.door_x, lvl.door_y = saved["door"]
+        self.timers.cancel(lvl.timers.pop("wave", None))
+        for key, (when, name) in saved["timers"].items():
+            fn = getattr(self, name)
+            if when:
+                self.schedule_level(lvl, key, when, fn)
+            else:
+                lvl.parked[key] = fn
+
+    def active_levels(self):
+        """Уровни с живыми игроками. Остальные спят: в тике они не участвуют,
+        а их волны и Изгнанник ждут в self.timers."""
+        for stage, alive in list(self.alive_by_stage.items()):
+            if alive and stage != 0 and stage != 11:
+                yield stage, self.levels[stage]
+
+    def schedule_level(self, lvl: LevelState, key: str, when: float, fn):
+        """Ставит (или переставляет) таймер уровня key; fn(lvl, now) вызовется
+        не раньше when и только при живых игроках на уровне."""
+        self.timers.cancel(lvl.timers.pop(key, None))
+        lvl.parked.pop(key, None)
+        lvl.timers[key] = self.timers.schedule(when, self.fire_level_timer, lvl, key, fn)
+
+    def fire_level_timer(self, now: float, lvl: LevelState, key: str, fn):
+        # без живых игроков уровень стоит: таймер ждёт, пока кто-нибудь придёт
+        lvl.timers.pop(key, None)
+        if not self.stage_alive(lvl.stage):
+            lvl.parked[key] = fn
+            return
+        fn(lvl, now)
+
+    def schedule_wave(self, lvl: LevelState):
+        """Следующая волна врагов: RESPAWN_INTERVAL до появления двери,
+        DOOR_RESPAWN_INTERVAL после. ХАБ, безопасная зона и уровень
+        Изгнанника волн не имеют."""
+        if lvl.stage in (0, 10, 11):
+            return
+        interval = RESPAWN_INTERVAL if lvl.door_x is None else DOOR_RESPAWN_INTERVAL
+        self.schedule_level(lvl, "wave", lvl.last_respawn + interval, self.wave_due)
+
+    def wave_due(self, lvl: LevelState, now: float):
+        stage = lvl.stage
+        if lvl.door_x is None:
+            # волны до появления двери
+            if lvl.enemies_alive():
+                lvl.set_enemies(self.generate_enemies(stage))
+                lvl.last_respawn = now
+                self.broadcast_event(
+                    f"На уровне {stage} появились новые враги!",
+                    stage=stage,
+                )
+                self.schedule_wave(lvl)
+            else:
+                # если все враги умерли до появления двери — можно открыть дверь
+                self.check_and_open_door(stage, now)
+        elif not lvl.enemies_alive() and not lvl.completed:
+            # после того как дверь появилась, волны идут раз в 2 минуты,
+            # если уровень не зачищен
+            lvl.set_enemies(self.generate_enemies(stage))
+            lvl.last_respawn = now
+            lvl.door_open = False
+            self.broadcast_event(
+                f"На уровне {stage} дверь закрывается, появляются новые враги!",
+                stage=stage,
+            )
+            self.schedule_wave(lvl)
+
 
     def generate_enemies(self, stage: int):
         enemies = []
@@ -314,7 +1720,7 @@ class GameServer:
         w, h = self.get_map_size_for_stage(stage)
 
         def rand_pos():
-            return random.uniform(0, w - 1), random.uniform(0, h - 1)
+            return self.rng.uniform(0, w - 1), self.rng.uniform(0, h - 1)
 
         mob_pool = [
             ("Крыса тоннелей", "melee", 35, 8, 1),
@@ -372,7 +1778,7 @@ class GameServer:
                 atk_scale = 1.6
 
             for _ in range(count):
-                nm, etype, hp, atk, df = random.choice(mob_pool)
+                nm, etype, hp, atk, df = self.rng.choice(mob_pool)
                 hp = int(hp + stage * hp_scale)
                 atk = int(atk + stage * atk_scale)
                 df = int(df + stage // 2)
@@ -388,17 +1794,49 @@ class GameServer:
 
     def calc_damage(self, attack, defense):
         base = attack - defense
-        base += random.randint(-2, 2)
+        base += self.rng.randint(-2, 2)
         if base < 1:
             base = 1
         return base
 
+    def calc_damage_many(self, attack, defense):
+        """calc_damage для целой волны: массивы атаки и защиты -> массив урона."""
+        base = attack - defense + self.np_random.integers(-2, 3, size=len(attack))
+        return np.maximum(base, 1)
+
+    def send(self, player: Player, obj: dict):
+        """Ставит сообщение в очередь клиента; в сокет его запишет писатель соединения."""
+        if player.proto == PROTO_BINARY:
+            data = encode_json_frame(obj)
+        else:
+            data = encode_json(obj)
+        self.send_raw(player, obj.get("type"), data)
+
+    def send_raw(self, player: Player, kind, data: bytes):
+        if not player.outbox.push(kind, data) and player.outbox.overflow:
+            self.drop_slow_client(player)
+
+    def drop_slow_client(self, player: Player):
+        """Клиент не разбирает очередь — рвём соединение, остальное сделает обычный путь отключения."""
+        if player.dropped:
+            return
+        player.dropped = True
+        print(f"[NET] {player.name} не успевает принимать данные, отключаем: {player.outbox.stats()}", flush=True)
+        try:
+            player.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
     def broadcast_event(self, msg, stage=None):
         print("[EVENT]", msg, flush=True)
-        for p in list(self.players.values()):
-            if stage is not None and p.stage != stage:
-                continue
-            send_json(p.conn, {"type": "event", "msg": msg})
+        obj = {"type": "event", "msg": msg}
+        encoded = {}
+        targets = self.players if stage is None else self.stage_players(stage)
+        for p in list(targets.values()):
+            data = encoded.get(p.proto)
+            if data is None:
+                data = encoded[p.proto] = encode_json_frame(obj) if p.proto == PROTO_BINARY else encode_json(obj)
+            self.send_raw(p, "event", data)
 
     def broadcast_attack(self, stage, attacker_type, attacker_id, attacker_name,
                          from_x, from_y, target_type, target_id, target_name,
@@ -419,17 +1857,48 @@ class GameServer:
             "damage": damage,
             "special": special,
         }
-        for p in list(self.players.values()):
-            if p.stage == stage:
-                send_json(p.conn, payload)
+        lvl = self.get_level(stage)
+        json_data = bin_data = None
+        for p in list(self.stage_players(stage).values()):
+            # удар далеко за экраном клиенту не нужен
+            x0, y0, x1, y1 = self.aoi_rect(p, lvl.width, lvl.height)
+            if not (x0 <= from_x <= x1 and y0 <= from_y <= y1) and \
+                    not (x0 <= to_x <= x1 and y0 <= to_y <= y1):
+                continue
+            if p.proto == PROTO_BINARY:
+                if bin_data is None:
+                    bin_data = encode_frame(FRAME_ATTACK, ATTACK_REC.pack(
+                        ATTACKER_CODES.get(attacker_type, 0), attacker_id,
+                        ATTACKER_CODES.get(target_type, 0), target_id,
+                        stage, bool(special), int(damage),
+                        quant(from_x), quant(from_y), quant(to_x), quant(to_y),
+                    ))
+                self.send_raw(p, "attack", bin_data)
+            else:
+                if json_data is None:
+                    json_data = encode_json(payload)
+                self.send_raw(p, "attack", json_data)
 
 
-    def send_state(self, player: Player):
-        lvl = self.get_level(player.stage)
-        now = time.time()
+    def aoi_rect(self, player: Player, width, height):
+        """Область интереса игрока: экран клиента (камера как в draw_game) плюс AOI_MARGIN."""
+        cam_x = max(0.0, min(width - AOI_VIEW_W, player.x + 0.5 - AOI_VIEW_W / 2))
+        cam_y = max(0.0, min(height - AOI_VIEW_H, player.y + 0.5 - AOI_VIEW_H / 2))
+        return (cam_x - AOI_MARGIN, cam_y - AOI_MARGIN,
+                cam_x + AOI_VIEW_W + AOI_MARGIN, cam_y + AOI_VIEW_H + AOI_MARGIN)
+
+    def build_level_snapshot(self, stage: int, now: float = None) -> LevelSnapshot:
+        """Общая для всех игроков уровня часть state ("level" и "players").
 
-        enemies_payload = [
-            {
+        Строится один раз на рассылку, а в каждый кадр вклеивается только
+        маленький личный раздел "you" (см. send_state).
+        """
+        lvl = self.get_level(stage)
+        if now is None:
+            now = self.clock.time()
+
+        enemies_payload = {
+            e.id: {
                 "id": e.id,
                 "name": e.name,
                 "etype": e.etype,
@@ -440,14 +1909,12 @@ class GameServer:
                 "x": e.x,
                 "y": e.y,
             }
-            for e in lvl.enemies if e.hp > 0
-        ]
+            for e in lvl.enemy_by_id.values()
+        }
 
-        players_payload = []
-        for p in self.players.values():
-            if p.stage != player.stage:
-                continue
-            players_payload.append({
+        players_payload = {}
+        for p in self.stage_players(stage).values():
+            players_payload[p.id] = {
                 "id": p.id,
                 "name": p.name,
                 "class": p.cls,
@@ -460,11 +1927,7 @@ class GameServer:
                 "x": p.x,
                 "y": p.y,
                 "archer_stance": getattr(p, "archer_stance", "move"),
-            })
-
-        special_left = 0.0
-        if player.special_cd > 0:
-            special_left = max(0.0, player.special_cd - (now - player.last_special_time))
+            }
 
         # таймер респавна
         next_respawn_in = 0
@@ -492,55 +1955,123 @@ class GameServer:
             "y": lvl.door_y,
         }
 
-        payload = {
-            "type": "state",
-            "you": {
-                "id": player.id,
-                "name": player.name,
-                "class": player.cls,
-                "hp": player.hp,
-                "max_hp": player.max_hp,
-                "mana": player.mana,
-                "max_mana": player.max_mana,
-                "stage": player.stage,
-                "alive": player.alive,
-                "x": player.x,
-                "y": player.y,
-                "archer_stance": getattr(player, "archer_stance", "move"),
-                "special_cd": player.special_cd,
-                "special_cd_left": special_left,
-            },
-            "level": {
-                "stage": player.stage,
-                "width": lvl.width,
-                "height": lvl.height,
-                "shield_active": time.time() < lvl.shield_buff_until,
-                "enemies": enemies_payload,
-                "next_respawn_in": next_respawn_in,
-                "door": door_info,
-
-                # --- Доп. информация для логики босса и эффектов уровня ---
-                # Список опасных зон (пока всегда пуст, заполним на следующих этапах)
-                "hazards": getattr(lvl, "hazards", []),
-
-                # Фаза босса 10 уровня (None, если босса нет или другой уровень)
-                "boss_phase": getattr(lvl, "boss_phase", None),
-
-                # Параметры круга появления босса (фаза 0) или None
-                "boss_spawn_circle": getattr(lvl, "boss_spawn_circle", None),
-            },
-            "players": players_payload,
+        level_info = {
+            "stage": stage,
+            "width": lvl.width,
+            "height": lvl.height,
+            "shield_active": now < lvl.shield_buff_until,
+            "next_respawn_in": next_respawn_in,
+            "door": door_info,
+
+            # --- Доп. информация для логики босса и эффектов уровня ---
+            # Список опасных зон (копия: снимок не должен меняться задним числом)
+            "hazards": list(getattr(lvl, "hazards", [])),
+
+            # Фаза босса 10 уровня (None, если босса нет или другой уровень)
+            "boss_phase": getattr(lvl, "boss_phase", None),
+
+            # Параметры круга появления босса (фаза 0) или None
+            "boss_spawn_circle": getattr(lvl, "boss_spawn_circle", None),
+        }
+        return LevelSnapshot(stage, level_info, enemies_payload, players_payload)
+
+    def send_state(self, player: Player, snap: LevelSnapshot = None, now: float = None):
+        if now is None:
+            now = self.clock.time()
+        if snap is None:
+            snap = self.build_level_snapshot(player.stage, now)
+
+        # только то, что попадает в экран игрока (на малых этажах — весь снимок)
+        prev = player.last_view
+        if prev is not None and prev.stage != snap.stage:
+            prev = None
+        rect = self.aoi_rect(player, snap.level["width"], snap.level["height"])
+        snap = snap.visible_part(rect, prev, player.id)
+        player.last_view = snap
+
+        special_left = 0.0
+        if player.special_cd > 0:
+            special_left = max(0.0, player.special_cd - (now - player.last_special_time))
+
+        you = {
+            "id": player.id,
+            "name": player.name,
+            "class": player.cls,
+            "hp": player.hp,
+            "max_hp": player.max_hp,
+            "mana": player.mana,
+            "max_mana": player.max_mana,
+            "stage": player.stage,
+            "alive": player.alive,
+            "x": player.x,
+            "y": player.y,
+            "archer_stance": getattr(player, "archer_stance", "move"),
+            "special_cd": player.special_cd,
+            "special_cd_left": special_left,
+            "input_seq": player.input_seq,
+            "input_time": player.input_time,
         }
-        send_json(player.conn, payload)
+        if not player.use_snapshots:
+            you_bytes = json.dumps(you, ensure_ascii=False).encode("utf-8")
+            data = b"".join((b'{"type": "state", "you": ', you_bytes, b", ", snap.legacy_bytes(), b"}\n"))
+            self.send_raw(player, "state", data)
+            return
 
+        # дельта относительно последнего подтверждённого снимка;
+        # если его нет (потерян, устарел, другой уровень) — полный снимок
+        base_seq = player.snap_acked
+        base = player.snapshots.get(base_seq)
+        if base is not None and base.stage != snap.stage:
+            base = None
+        player.snap_seq += 1
+        seq = player.snap_seq
+        player.snapshots[seq] = snap
+        player.snapshots.pop(seq - SNAPSHOT_HISTORY, None)
+
+        # кадр snapshot тоже «последний побеждает»: клиент строит следующий
+        # снимок от подтверждённого, а не от предыдущего полученного
+        if player.proto == PROTO_BINARY:
+            has_level, body = snap.binary_bytes(base, self.names)
+            names = self.names
+            name_code = names.code(player.name)
+            if player.names_epoch != names.epoch:
+                # журнал пересобран: шлём таблицу заново
+                player.names_epoch = names.epoch
+                player.names_sent = 0
+            if player.names_sent < len(names.log):
+                for frame in names.frames_since(player.names_sent):
+                    self.send_raw(player, "names", frame)
+                player.names_sent = len(names.log)
+            payload = b"".join((
+                SNAP_HEADER.pack(seq, NO_BASE if base is None else base_seq, has_level),
+                YOU_REC.pack(player.id, name_code, CLASS_CODES.get(player.cls, 0),
+                             _player_flags(you), player.stage, int(player.hp), int(player.max_hp),
+                             int(player.mana), int(player.max_mana), player.x, player.y,
+                             player.special_cd, special_left, player.input_seq, player.input_time),
+                body,
+            ))
+            self.send_raw(player, "state", encode_frame(FRAME_SNAPSHOT, payload))
+            return
 
-    def broadcast_state_for_level(self, stage: int):
-        for p in self.players.values():
-            if p.stage == stage:
-                self.send_state(p)
+        you_bytes = json.dumps(you, ensure_ascii=False).encode("utf-8")
+        header = '{"type": "snapshot", "seq": %d, "base": %s, "you": ' % (
+            seq, "null" if base is None else base_seq)
+        body = snap.delta_bytes(base)
+        data = b"".join((header.encode("ascii"), you_bytes, b", " if body else b"", body, b"}\n"))
+        self.send_raw(player, "state", data)
+
+    def broadcast_state_for_level(self, stage: int, now: float = None):
+        players = self.stage_players(stage)
+        if not players:
+            return
+        if now is None:
+            now = self.clock.time()
+        snap = self.build_level_snapshot(stage, now)
+        for p in players.values():
+            self.send_state(p, snap, now)
 
 
-    def check_and_open_door(self, stage: int):
+    def check_and_open_door(self, stage: int, now: float = None):
         lvl = self.get_level(stage)
         # ХАБ не использует механику зачистки/двери
         if lvl.stage == 0:
@@ -549,27 +2080,30 @@ class GameServer:
             # дверь уже открыта
             return
         if not lvl.enemies_alive():
-            now = time.time()
+            if now is None:
+                now = self.clock.time()
             lvl.completed = True
             # если двери ещё не было — создаём; иначе просто открываем существующую
             if lvl.door_x is None or lvl.door_y is None:
-                lvl.door_x = random.uniform(2, lvl.width - 2)
-                lvl.door_y = random.uniform(2, lvl.height - 2)
+                lvl.door_x = self.rng.uniform(2, lvl.width - 2)
+                lvl.door_y = self.rng.uniform(2, lvl.height - 2)
             lvl.door_open = True
             # от двери отсчитываем таймер до следующего возможного респавна
             lvl.last_respawn = now
+            self.schedule_wave(lvl)
             self.broadcast_event(f"На уровне {stage} открылась дверь наверх!", stage=stage)
 
     def enemies_move_level(self, stage: int):
         """Плавное движение ближников к ближайшему живому игроку."""
         lvl = self.get_level(stage)
-        alive_enemies = [e for e in lvl.enemies if e.hp > 0]
+        if lvl.store is not None:
+            self.enemies_move_arrays(stage, lvl)
+            return
+        alive_enemies = lvl.alive_enemies()
         if not alive_enemies:
             return
 
-        alive_players = [p for p in self.players.values()
-                         if p.stage == stage and p.alive]
-        if not alive_players:
+        if not self.stage_alive(stage):
             return
 
         for enemy in alive_enemies:
@@ -578,10 +2112,9 @@ class GameServer:
                 continue
 
             # ближайшая цель
-            target = min(
-                alive_players,
-                key=lambda p: (p.x - enemy.x) ** 2 + (p.y - enemy.y) ** 2
-            )
+            target = lvl.nearest_player(enemy.x, enemy.y)
+            if target is None:
+                return
             dx = target.x - enemy.x
             dy = target.y - enemy.y
             dist2 = dx * dx + dy * dy
@@ -600,82 +2133,153 @@ class GameServer:
             # не выходим за границы карты
             enemy.x = max(0.0, min(lvl.width - 1, enemy.x))
             enemy.y = max(0.0, min(lvl.height - 1, enemy.y))
+            lvl.enemy_grid.move(enemy)
+
+    def stage_targets(self, stage: int):
+        """Живые игроки этажа по id и их координаты массивами — цели для векторных проходов."""
+        players = sorted(self.stage_alive(stage).values(), key=lambda p: p.id)
+        px = np.array([p.x for p in players], dtype=float)
+        py = np.array([p.y for p in players], dtype=float)
+        return players, px, py
+
+    def enemies_move_arrays(self, stage: int, lvl: LevelState):
+        """enemies_move_level для EnemyStore: вся волна ближников за один шаг."""
+        store = lvl.store
+        rows = store.alive_rows(melee_only=True)
+        if not len(rows) or not self.stage_alive(stage):
+            return
+        players, px, py = self.stage_targets(stage)
+        near, dist2 = store.nearest(rows, px, py)
+        # уже практически вплотную — не подходим, чтобы не залезать в игрока
+        keep = dist2 > 0.25 ** 2
+        rows, near = rows[keep], near[keep]
+        store.step_towards(rows, px[near], py[near], 0.1, lvl.width, lvl.height)
+        views = store.views
+        for row in rows.tolist():
+            lvl.enemy_grid.move(views[row])
+
+    def enemy_damage(self, enemy, target: Player, lvl: LevelState, now: float) -> int:
+        dmg = self.calc_damage(enemy.attack, target.defense)
+        # Ближние враги наносят в 3 раза больше урона
+        if enemy.etype == "melee":
+            dmg = int(dmg * 3)
+            if dmg < 1:
+                dmg = 1
+        if now < lvl.shield_buff_until:
+            dmg = int(dmg * 0.6)
+            if dmg < 1:
+                dmg = 1
+        # Лучник в стойке "Наизготовка" получает на 200% больше урона (x3)
+        t_cls = (target.cls or "").lower()
+        if t_cls == "лучник" and getattr(target, "archer_stance", "move") == "ready":
+            dmg = int(dmg * 3)
+            if dmg < 1:
+                dmg = 1
+        return dmg
+
+    def enemy_hit(self, stage: int, enemy, target: Player, dmg: int, now: float):
+        target.hp -= dmg
+        target.last_damage_time = now
+
+        self.broadcast_event(
+            f"{enemy.name} атакует {target.name} на {dmg} урона. ({max(target.hp,0)} HP)",
+            stage=stage,
+        )
+        self.broadcast_attack(
+            stage,
+            attacker_type="enemy",
+            attacker_id=enemy.id,
+            attacker_name=enemy.name,
+            from_x=enemy.x,
+            from_y=enemy.y,
+            target_type="player",
+            target_id=target.id,
+            target_name=target.name,
+            to_x=target.x,
+            to_y=target.y,
+            damage=dmg,
+            special=False,
+        )
+        if target.hp <= 0 and target.alive:
+            self.set_alive(target, False, now)
+            target.dead_since = now
+            self.broadcast_event(f"{target.name} пал на уровне {stage}!", stage=stage)
+
+    def final_boss_volley(self, stage: int, lvl: LevelState, enemy, now: float) -> bool:
+        """Финальный босс 21 уровня бьёт двух ближайших; False — бить некого."""
+        # два ближайших живых игрока
+        targets = lvl.player_grid.nearest(enemy.x, enemy.y, k=2, pred=_is_alive_player)
+        if not targets:
+            return False
+
+        for target in targets:
+            # дальник может стрелять с любой дистанции, ограничений по расстоянию не ставим
+            dmg = self.calc_damage(enemy.attack, target.defense)
+            if now < lvl.shield_buff_until:
+                dmg = int(dmg * 0.6)
+                if dmg < 1:
+                    dmg = 1
+            # учёт стойки лучника "Наизготовка" (получает x3)
+            t_cls = (target.cls or "").lower()
+            if t_cls == "лучник" and getattr(target, "archer_stance", "move") == "ready":
+                dmg = int(dmg * 3)
+                if dmg < 1:
+                    dmg = 1
 
+            target.hp -= dmg
+            target.last_damage_time = now
+            if target.hp <= 0:
+                target.hp = 0
+                self.set_alive(target, False, now)
+                target.dead_since = now
+                self.broadcast_event(f"{target.name} погиб от удара финального босса.", stage=stage)
 
+            self.broadcast_attack(
+                stage,
+                attacker_type="enemy",
+                attacker_id=enemy.id,
+                attacker_name=enemy.name,
+                from_x=enemy.x,
+                from_y=enemy.y,
+                target_type="player",
+                target_id=target.id,
+                target_name=target.name,
+                to_x=target.x,
+                to_y=target.y,
+                damage=dmg,
+                special=True,  # можно считать это "особой" атакой
+            )
+        return True
 
-    def enemies_attack_level(self, stage: int):
+    def enemies_attack_level(self, stage: int, now: float = None):
         lvl = self.get_level(stage)
-        alive_enemies = [e for e in lvl.enemies if e.hp > 0]
+        alive_enemies = lvl.alive_enemies()
         if not alive_enemies:
             return
-        alive_players = [p for p in self.players.values() if p.stage == stage and p.alive]
-        if not alive_players:
+        if not self.stage_alive(stage):
             return
 
-        now = time.time()
-        lvl.last_enemy_attack = now
+        if now is None:
+            now = self.clock.time()
+        lvl.last_enemy_attack = advance_timer(lvl.last_enemy_attack, now, ENEMY_ATTACK_DELAY)
 
-        for enemy in alive_enemies:
-            alive_players = [p for p in self.players.values() if p.stage == stage and p.alive]
-            if not alive_players:
-                break
+        if lvl.store is not None:
+            self.enemies_attack_arrays(stage, lvl, now)
+            self.check_and_open_door(stage, now)
+            return
 
+        for enemy in alive_enemies:
             # Особая логика для финального босса 21 уровня: дальник, бьёт сразу двух игроков
             if stage == 21 and enemy.boss and enemy.etype == "ranged":
-                # сортируем игроков по расстоянию и берём двух ближайших
-                sorted_players = sorted(
-                    alive_players,
-                    key=lambda p: (p.x - enemy.x) ** 2 + (p.y - enemy.y) ** 2
-                )
-                targets = sorted_players[:2]
-
-                for target in targets:
-                    dist2 = (target.x - enemy.x) ** 2 + (target.y - enemy.y) ** 2
-                    # дальник может стрелять с любой дистанции, ограничений по расстоянию не ставим
-                    dmg = self.calc_damage(enemy.attack, target.defense)
-                    if now < lvl.shield_buff_until:
-                        dmg = int(dmg * 0.6)
-                        if dmg < 1:
-                            dmg = 1
-                    # учёт стойки лучника "Наизготовка" (получает x3)
-                    t_cls = (target.cls or "").lower()
-                    if t_cls == "лучник" and getattr(target, "archer_stance", "move") == "ready":
-                        dmg = int(dmg * 3)
-                        if dmg < 1:
-                            dmg = 1
-
-                    target.hp -= dmg
-                    target.last_damage_time = now
-                    if target.hp <= 0:
-                        target.hp = 0
-                        target.alive = False
-                        target.dead_since = now
-                        self.broadcast_event(f"{target.name} погиб от удара финального босса.", stage=stage)
-
-                    self.broadcast_attack(
-                        stage,
-                        attacker_type="enemy",
-                        attacker_id=enemy.id,
-                        attacker_name=enemy.name,
-                        from_x=enemy.x,
-                        from_y=enemy.y,
-                        target_type="player",
-                        target_id=target.id,
-                        target_name=target.name,
-                        to_x=target.x,
-                        to_y=target.y,
-                        damage=dmg,
-                        special=True,  # можно считать это "особой" атакой
-                    )
-
+                if not self.final_boss_volley(stage, lvl, enemy, now):
+                    break
                 # после удара по двум целям переходим к следующему врагу
                 continue
 
             # Обычная логика для всех остальных врагов
-            target = min(
-                alive_players,
-                key=lambda p: (p.x - enemy.x) ** 2 + (p.y - enemy.y) ** 2
-            )
+            target = lvl.nearest_player(enemy.x, enemy.y)
+            if target is None:
+                break
             dist2 = (target.x - enemy.x) ** 2 + (target.y - enemy.y) ** 2
 
             if enemy.etype == "melee":
@@ -689,6 +2293,7 @@ class GameServer:
                     enemy.y += dy / length * min(step, length)
                     enemy.x = max(0.0, min(lvl.width - 1, enemy.x))
                     enemy.y = max(0.0, min(lvl.height - 1, enemy.y))
+                    lvl.enemy_grid.move(enemy)
 
                     continue  # в этот тик не атакуем
                 # ближний удар
@@ -696,50 +2301,133 @@ class GameServer:
                 # дальний удар — можно стрелять из любой дистанции
                 pass
 
-            dmg = self.calc_damage(enemy.attack, target.defense)
-            # Ближние враги наносят в 3 раза больше урона
-            if enemy.etype == "melee":
-                dmg = int(dmg * 3)
-                if dmg < 1:
-                    dmg = 1
-            if now < lvl.shield_buff_until:
-                dmg = int(dmg * 0.6)
-                if dmg < 1:
-                    dmg = 1
-            # Лучник в стойке "Наизготовка" получает на 200% больше урона (x3)
-            t_cls = (target.cls or "").lower()
-            if t_cls == "лучник" and getattr(target, "archer_stance", "move") == "ready":
-                dmg = int(dmg * 3)
-                if dmg < 1:
-                    dmg = 1
-            target.hp -= dmg
-            target.last_damage_time = now
+            dmg = self.enemy_damage(enemy, target, lvl, now)
+            self.enemy_hit(stage, enemy, target, dmg, now)
 
-            self.broadcast_event(
-                f"{enemy.name} атакует {target.name} на {dmg} урона. ({max(target.hp,0)} HP)",
-                stage=stage,
-            )
-            self.broadcast_attack(
-                stage,
-                attacker_type="enemy",
-                attacker_id=enemy.id,
-                attacker_name=enemy.name,
-                from_x=enemy.x,
-                from_y=enemy.y,
-                target_type="player",
-                target_id=target.id,
-                target_name=target.name,
-                to_x=target.x,
-                to_y=target.y,
-                damage=dmg,
-                special=False,
-            )
-            if target.hp <= 0 and target.alive:
-                target.alive = False
-                target.dead_since = now
-                self.broadcast_event(f"{target.name} пал на уровне {stage}!", stage=stage)
+        self.check_and_open_door(stage, now)
+
+    def enemies_attack_arrays(self, stage: int, lvl: LevelState, now: float):
+        """enemies_attack_level для EnemyStore.
+
+        Цели, подход далёких ближников и урон считаются на всю волну сразу
+        по положению игроков в начале прохода; в цикле остаются только
+        списание HP и события. Если цель умерла от предыдущих ударов,
+        враг выбирает новую и урон для него считается как обычно.
+        """
+        store = lvl.store
+        views = store.views
+        rows = store.alive_rows()
+        if stage == 21:
+            bosses = [row for row in rows.tolist()
+                      if views[row].boss and views[row].etype == "ranged"]
+            for row in bosses:
+                if not self.final_boss_volley(stage, lvl, views[row], now):
+                    return
+            if bosses:
+                rows = np.setdiff1d(rows, bosses)
+        if not len(rows) or not self.stage_alive(stage):
+            return
+
+        players, px, py = self.stage_targets(stage)
+        near, dist2 = store.nearest(rows, px, py)
+        melee = (store.flags[rows] & EF_RANGED) == 0
+
+        # далёкие ближники подходят и в этот тик не атакуют
+        approach = melee & (dist2 > 1.5 ** 2)
+        moving = rows[approach]
+        store.step_towards(moving, px[near[approach]], py[near[approach]], 0.2, lvl.width, lvl.height)
+        for row in moving.tolist():
+            lvl.enemy_grid.move(views[row])
+
+        hit = ~approach
+        rows, near, melee = rows[hit], near[hit], melee[hit]
+        defense = np.array([p.defense for p in players], dtype=np.int64)
+        dmg = self.calc_damage_many(store.attack[rows], defense[near])
+        # Ближние враги наносят в 3 раза больше урона
+        dmg = np.where(melee, dmg * 3, dmg)
+        if now < lvl.shield_buff_until:
+            dmg = np.maximum((dmg * 0.6).astype(np.int64), 1)
+        # Лучник в стойке "Наизготовка" получает на 200% больше урона (x3)
+        ready = np.array([(p.cls or "").lower() == "лучник" and
+                          getattr(p, "archer_stance", "move") == "ready" for p in players])
+        dmg = np.where(ready[near], dmg * 3, dmg)
+
+        for row, j, value in zip(rows.tolist(), near.tolist(), dmg.tolist()):
+            enemy = views[row]
+            target = players[j]
+            if not target.alive:
+                target = lvl.nearest_player(enemy.x, enemy.y)
+                if target is None:
+                    break
+                value = self.enemy_damage(enemy, target, lvl, now)
+            self.enemy_hit(stage, enemy, target, value, now)
+
+    def place_player(self, player: Player, now: float = None):
+        """Переносит игрока в индексы и сетку его уровня (вход, дверь, респавн, воскрешение).
+
+        now — время шага, если вызвано из подсистемы тика (по умолчанию self.clock)."""
+        if player.grid_stage is not None and player.grid_stage != player.stage:
+            self.unplace_player(player, now)
+        lvl = self.get_level(player.stage)
+        if lvl.evict_timer is not None:
+            self.timers.cancel(lvl.evict_timer)
+            lvl.evict_timer = None
+        lvl.player_grid.move(player)
+        player.grid_stage = player.stage
+        self.players_by_stage.setdefault(player.stage, {})[player.id] = player
+        self.set_alive(player, player.alive, now)
+
+    def unplace_player(self, player: Player, now: float = None):
+        """Убирает игрока из индексов и сетки уровня (отключение или уход с этажа)."""
+        stage = player.grid_stage
+        old = self.levels.get(stage)
+        if old is not None:
+            old.player_grid.remove(player.id)
+        self.players_by_stage.get(stage, {}).pop(player.id, None)
+        self.alive_by_stage.get(stage, {}).pop(player.id, None)
+        player.grid_stage = None
+        if old is not None and not self.stage_players(stage) and old.evict_timer is None:
+            if now is None:
+                now = self.clock.time()
+            old.evict_timer = self.timers.schedule(
+                now + self.level_evict_after, self.evict_level, stage, old)
+
+    def set_alive(self, player: Player, alive: bool, now: float = None):
+        """Меняет player.alive, поддерживая набор живых на этаже и таймер
+        рестарта: смерть ставит его на DEATH_TIMEOUT, оживление отменяет."""
+        if now is None:
+            now = self.clock.time()
+        player.alive = alive
+        if alive:
+            self.timers.cancel(player.respawn_timer)
+            player.respawn_timer = None
+        elif player.respawn_timer is None:
+            player.respawn_timer = self.timers.schedule(
+                now + DEATH_TIMEOUT, self.death_timeout, player)
+        if player.grid_stage is None:
+            return
+        if alive:
+            self.alive_by_stage.setdefault(player.grid_stage, {})[player.id] = player
+            lvl = self.levels.get(player.grid_stage)
+            if lvl is not None and lvl.parked:
+                # уровень ожил: отложенные таймеры срабатывают на ближайшем тике
+                for key, fn in list(lvl.parked.items()):
+                    self.schedule_level(lvl, key, now, fn)
+        else:
+            self.alive_by_stage.get(player.grid_stage, {}).pop(player.id, None)
+
+    def death_timeout(self, now: float, player: Player):
+        player.respawn_timer = None
+        if self.players.get(player.id) is player and not player.alive:
+            self.respawn_to_start(player, now)
 
-        self.check_and_open_door(stage)
+    def stage_players(self, stage):
+        """Игроки на этаже (живые и мёртвые)."""
+        return self.players_by_stage.get(stage) or {}
+
+    def stage_alive(self, stage):
+        """Живые игроки на этаже."""
+        return self.alive_by_stage.get(stage) or {}
 
     def move_player(self, player: Player, dx: float, dy: float):
         if not player.alive:
@@ -756,6 +2444,31 @@ class GameServer:
         ny = max(0.0, min(lvl.height - 1, ny))
         player.x = nx
         player.y = ny
+        lvl.player_grid.move(player)
+
+    def set_move_input(self, player: Player, dx, dy, seq):
+        """Запоминает направление движения; устаревшие (по seq) вводы игнорируются."""
+        seq = int(seq)
+        if seq <= player.input_seq:
+            return
+        dx = max(-1.0, min(1.0, float(dx)))
+        dy = max(-1.0, min(1.0, float(dy)))
+        length = (dx * dx + dy * dy) ** 0.5
+        if length > 1.0:
+            dx /= length
+            dy /= length
+        player.move_dx = dx
+        player.move_dy = dy
+        player.input_seq = seq
+        player.input_time = 0.0
+
+    def integrate_movement(self, player: Player, dt: float):
+        """Двигает игрока по удерживаемому направлению с фиксированной скоростью."""
+        if player.move_dx == 0.0 and player.move_dy == 0.0:
+            return
+        player.input_time += dt
+        step = PLAYER_SPEED * dt
+        self.move_player(player, player.move_dx * step, player.move_dy * step)
 
     def update_boss10_phase_on_damage(self, lvl: LevelState, enemy: Enemy):
         """Обновляет фазу Изгнанника при снижении HP."""
@@ -780,13 +2493,13 @@ class GameServer:
         if not player.alive:
             return
 
-        now = time.time()
+        now = self.clock.time()
         cls = (player.cls or "").lower()
 
         # Хилер: вместо атаки — небольшой хил по SPACE
         if cls in ("хилер", "хиллер", "healer"):
             if player.mana < 1:
-                send_json(player.conn, {"type": "error", "msg": "Недостаточно маны для исцеления (нужна 1 MP)."})
+                self.send(player, {"type": "error", "msg": "Недостаточно маны для исцеления (нужна 1 MP)."})
                 return
 
             # цель хилла
@@ -803,7 +2516,7 @@ class GameServer:
                 target = player
 
             if not target.alive:
-                send_json(player.conn, {"type": "error", "msg": "Цель мертва. Сначала воскресите её."})
+                self.send(player, {"type": "error", "msg": "Цель мертва. Сначала воскресите её."})
                 return
 
             old_hp = target.hp
@@ -811,7 +2524,7 @@ class GameServer:
             target.hp = min(target.max_hp, target.hp + heal)
             actual = target.hp - old_hp
             if actual <= 0:
-                send_json(player.conn, {"type": "event", "msg": f"{target.name} уже полностью здоров."})
+                self.send(player, {"type": "event", "msg": f"{target.name} уже полностью здоров."})
                 return
 
             player.mana -= 1
@@ -841,11 +2554,11 @@ class GameServer:
 
         # Для остальных проверяем, может ли класс вообще атаковать
         if not player.can_attack:
-            send_json(player.conn, {"type": "error", "msg": "Ваш класс не может использовать обычную атаку."})
+            self.send(player, {"type": "error", "msg": "Ваш класс не может использовать обычную атаку."})
             return
 
         lvl = self.get_level(player.stage)
-        alive_enemies = [e for e in lvl.enemies if e.hp > 0]
+        alive_enemies = lvl.alive_enemies()
         if not alive_enemies:
             self.broadcast_event("На уровне больше нет врагов.", stage=player.stage)
             return
@@ -853,21 +2566,15 @@ class GameServer:
         # выбор цели
         target = None
         if target_enemy_id is not None:
-            for e in alive_enemies:
-                if e.id == target_enemy_id:
-                    target = e
-                    break
+            target = lvl.enemy_by_id.get(target_enemy_id)
         if target is None:
-            target = min(
-                alive_enemies,
-                key=lambda e: (e.x - player.x) ** 2 + (e.y - player.y) ** 2
-            )
+            target = lvl.nearest_enemy(player.x, player.y)
 
         # Воин: ближний бой — бить можно только рядом
         if cls == "воин":
             dist2 = (target.x - player.x) ** 2 + (target.y - player.y) ** 2
             if dist2 > 1.5 ** 2:
-                send_json(player.conn, {"type": "error", "msg": "Цель слишком далеко для удара в ближнем бою."})
+                self.send(player, {"type": "error", "msg": "Цель слишком далеко для удара в ближнем бою."})
                 return
 
         # Лучник: кд 1 сек на обычную атаку в стойке "Движение"
@@ -875,13 +2582,13 @@ class GameServer:
             if getattr(player, "archer_stance", "move") != "ready":
                 if now - player.last_attack_time < 1.0:
                     remain = 1.0 - (now - player.last_attack_time)
-                    send_json(player.conn, {"type": "error", "msg": f"Выстрел ещё в откате ({remain:.1f} с)."})
+                    self.send(player, {"type": "error", "msg": f"Выстрел ещё в откате ({remain:.1f} с)."})
                     return
 
         # Маг: обычная атака тратит 1 MP
         if cls == "маг":
             if player.mana < 1:
-                send_json(player.conn, {"type": "error", "msg": "Недостаточно маны для атаки (нужна 1 MP)."})
+                self.send(player, {"type": "error", "msg": "Недостаточно маны для атаки (нужна 1 MP)."})
                 return
             player.mana -= 1
             player.last_mana_spent_time = now
@@ -910,15 +2617,10 @@ class GameServer:
             special=False,
         )
         if target.hp <= 0:
+            lvl.enemy_died(target)
             # Особая обработка смерти Изгнанника на 10 уровне
             if player.stage == 10 and target.boss:
-                lvl.boss_alive = False
-                lvl.boss_phase = None
-                lvl.boss_last_death_time = now
-                lvl.boss_spawn_pending = False
-                lvl.boss_spawn_circle = None
-                # убираем круг появления из списка опасностей, если он вдруг остался
-                lvl.hazards = [h for h in lvl.hazards if h.get("type") != "boss10_spawn"]
+                self.boss10_died(lvl, now)
 
             self.broadcast_event(f"{target.name} повержен!", stage=player.stage)
             self.check_and_open_door(player.stage)
@@ -926,22 +2628,22 @@ class GameServer:
 
 
     def use_special(self, player: Player, target_player_id=None):
-        now = time.time()
+        now = self.clock.time()
         cls = (player.cls or "").lower()
 
         # общий кд — не действует на мага (у мага нет кд на спец)
         if cls != "маг" and player.special_cd > 0 and now - player.last_special_time < player.special_cd:
             remain = int(player.special_cd - (now - player.last_special_time))
-            send_json(player.conn, {"type": "error", "msg": f"Способность в откате, ещё {remain} с."})
+            self.send(player, {"type": "error", "msg": f"Способность в откате, ещё {remain} с."})
             return
 
         lvl = self.get_level(player.stage)
-        alive_enemies = [e for e in lvl.enemies if e.hp > 0]
+        alive_enemies = lvl.alive_enemies()
 
         if cls == "воин":
             # щит, который действует пока есть мана (каждую секунду -1 MP, всего 10 MP)
             if player.mana <= 0:
-                send_json(player.conn, {"type": "error", "msg": "Недостаточно маны для Боевого клича."})
+                self.send(player, {"type": "error", "msg": "Недостаточно маны для Боевого клича."})
                 return
             player.special_active = True
             player.special_mode = "warrior_shield"
@@ -970,10 +2672,10 @@ class GameServer:
         elif cls == "маг":
             cost = 15
             if player.mana < cost:
-                send_json(player.conn, {"type": "error", "msg": "Недостаточно маны."})
+                self.send(player, {"type": "error", "msg": "Недостаточно маны."})
                 return
             if not alive_enemies:
-                send_json(player.conn, {"type": "error", "msg": "На уровне нет врагов."})
+                self.send(player, {"type": "error", "msg": "На уровне нет врагов."})
                 return
             player.mana -= cost
             player.last_mana_spent_time = now
@@ -1004,16 +2706,11 @@ class GameServer:
             )
             for enemy in alive_enemies:
                 if enemy.hp <= 0:
+                    lvl.enemy_died(enemy)
 
                     # Особая обработка смерти Изгнанника на 10 уровне
                     if player.stage == 10 and enemy.boss:
-                        lvl = self.get_level(player.stage)
-                        lvl.boss_alive = False
-                        lvl.boss_phase = None
-                        lvl.boss_last_death_time = now
-                        lvl.boss_spawn_pending = False
-                        lvl.boss_spawn_circle = None
-                        lvl.hazards = [h for h in lvl.hazards if h.get("type") != "boss10_spawn"]
+                        self.boss10_died(self.get_level(player.stage), now)
 
                     self.broadcast_event(f"{enemy.name} сгорел дотла!", stage=player.stage)
             self.check_and_open_door(player.stage)
@@ -1021,7 +2718,7 @@ class GameServer:
         elif cls in ("хилер", "хиллер", "healer"):
             cost = 10
             if player.mana < cost:
-                send_json(player.conn, {"type": "error", "msg": "Недостаточно маны для исцеления."})
+                self.send(player, {"type": "error", "msg": "Недостаточно маны для исцеления."})
                 return
             # выбираем основную цель
             target = None
@@ -1036,11 +2733,11 @@ class GameServer:
             if target is None:
                 target = player
             if not target.alive:
-                send_json(player.conn, {"type": "error", "msg": "Цель мертва. Сначала воскресите её."})
+                self.send(player, {"type": "error", "msg": "Цель мертва. Сначала воскресите её."})
                 return
 
             # основная цель — мощный хил, остальные живые союзники на уровне — по 10 HP
-            allies = [p for p in self.players.values() if p.stage == player.stage and p.alive]
+            allies = list(self.stage_alive(player.stage).values())
 
             # большой хил основной цели
             old_hp_main = target.hp
@@ -1049,7 +2746,7 @@ class GameServer:
             actual_main = target.hp - old_hp_main
 
             if actual_main <= 0 and all(a.hp >= a.max_hp for a in allies):
-                send_json(player.conn, {"type": "event", "msg": f"{target.name} уже полностью здоров."})
+                self.send(player, {"type": "event", "msg": f"{target.name} уже полностью здоров."})
                 return
 
             player.mana -= cost
@@ -1104,7 +2801,7 @@ class GameServer:
                 )
 
         else:
-            send_json(player.conn, {"type": "error", "msg": "У вашего класса нет особой способности."})
+            self.send(player, {"type": "error", "msg": "У вашего класса нет особой способности."})
             return
 
         player.last_special_time = now
@@ -1124,23 +2821,23 @@ class GameServer:
                     break
 
         if target is None:
-            send_json(caster.conn, {"type": "error", "msg": "Игрок для воскрешения не найден."})
+            self.send(caster, {"type": "error", "msg": "Игрок для воскрешения не найден."})
             return
 
         cost = 15
-        now = time.time()
+        now = self.clock.time()
         if caster.mana < cost:
-            send_json(caster.conn, {"type": "error", "msg": "Недостаточно маны для воскрешения."})
+            self.send(caster, {"type": "error", "msg": "Недостаточно маны для воскрешения."})
             return
 
         if target.alive:
-            send_json(caster.conn, {"type": "error", "msg": "Этот игрок уже жив."})
+            self.send(caster, {"type": "error", "msg": "Этот игрок уже жив."})
             return
         if target.dead_since is None:
-            send_json(caster.conn, {"type": "error", "msg": "Этого игрока нельзя воскресить."})
+            self.send(caster, {"type": "error", "msg": "Этого игрока нельзя воскресить."})
             return
         if now - target.dead_since > DEATH_TIMEOUT:
-            send_json(caster.conn, {"type": "error", "msg": "Прошло слишком много времени, рестарт уже произошёл."})
+            self.send(caster, {"type": "error", "msg": "Прошло слишком много времени, рестарт уже произошёл."})
             return
 
         caster.mana -= cost
@@ -1150,6 +2847,7 @@ class GameServer:
         target.stage = caster.stage
         target.x = caster.x
         target.y = caster.y
+        self.place_player(target)
         target.hp = max(1, int(target.max_hp * 0.5))
         if (target.cls or "").lower() == "лучник":
             target.archer_stance = "move"
@@ -1158,8 +2856,9 @@ class GameServer:
             stage=caster.stage,
         )
 
-    def respawn_to_start(self, player: Player):
-        now = time.time()
+    def respawn_to_start(self, player: Player, now: float = None):
+        if now is None:
+            now = self.clock.time()
         player.stage = 0
         player.alive = True
         player.dead_since = None
@@ -1168,6 +2867,7 @@ class GameServer:
         w, h = self.get_map_size_for_stage(0)
         player.x = w / 2.0
         player.y = h / 2.0
+        self.place_player(player, now)
 
         player.last_damage_time = now
         player.last_attack_time = now
@@ -1185,12 +2885,12 @@ class GameServer:
     def try_enter_door(self, player: Player):
         lvl = self.get_level(player.stage)
         if not lvl.door_open or lvl.door_x is None:
-            send_json(player.conn, {"type": "error", "msg": "Дверь ещё не открыта."})
+            self.send(player, {"type": "error", "msg": "Дверь ещё не открыта."})
             return
         dx = player.x - lvl.door_x
         dy = player.y - lvl.door_y
         if dx * dx + dy * dy > 0.6 * 0.6:
-            send_json(player.conn, {"type": "error", "msg": "Подойдите вплотную к двери, чтобы войти."})
+            self.send(player, {"type": "error", "msg": "Подойдите вплотную к двери, чтобы войти."})
             return
 
         stage = player.stage
@@ -1203,14 +2903,15 @@ class GameServer:
         player.stage = new_stage
         player.x = w / 2.0
         player.y = h / 2.0
+        self.place_player(player)
         heal_hp = int(player.max_hp * 0.3)
         heal_mana = int(player.max_mana * 0.3)
         player.hp = min(player.max_hp, player.hp + heal_hp)
         player.mana = min(player.max_mana, player.mana + heal_mana)
         self.broadcast_event(f"{player.name} поднимается на уровень {new_stage}.", stage=new_stage)
-        self.get_level(new_stage)
-        self.send_state(player)
-        self.broadcast_state_for_level(new_stage)
+        # оба уровня уйдут в рассылке ближайшего тика
+        self.dirty_stages.add(stage)
+        self.dirty_stages.add(new_stage)
 
 
     def handle_command(self, player: Player, msg: dict):
@@ -1218,11 +2919,21 @@ class GameServer:
         if not cmd:
             return
 
+        if cmd == "input":
+            # ввод принимаем и у мёртвых: это лишь состояние клавиш,
+            # move_player всё равно не двигает мёртвого
+            try:
+                self.set_move_input(player, msg.get("dx", 0.0), msg.get("dy", 0.0), msg.get("seq", 0))
+            except (TypeError, ValueError):
+                pass
+            return
+
         if not player.alive and cmd not in ("status", "who", "help"):
-            send_json(player.conn, {"type": "error", "msg": "Вы мертвы. Ждите воскрешения или рестарта."})
+            self.send(player, {"type": "error", "msg": "Вы мертвы. Ждите воскрешения или рестарта."})
             return
 
         dirty = False
+        stage_before = player.stage
 
         if cmd == "move":
             dx = float(msg.get("dx", 0.0))
@@ -1269,54 +2980,221 @@ class GameServer:
                 f"{p.id}:{p.name}({p.cls}){'†' if not p.alive else ''}"
                 for p in self.players.values()
             )
-            send_json(player.conn, {"type": "event", "msg": "Игроки: " + names})
+            self.send(player, {"type": "event", "msg": "Игроки: " + names})
 
         elif cmd == "help":
             txt = (
                 "Управление: движение WASD/стрелки (удерживать), удар/хил SPACE, спец Q, воскрешение R.\n"
                 "Выбор цели — ЛКМ по врагу/союзнику, переход на следующий уровень — через дверь."
             )
-            send_json(player.conn, {"type": "event", "msg": txt})
+            self.send(player, {"type": "event", "msg": txt})
 
         else:
-            send_json(player.conn, {"type": "error", "msg": "Неизвестная команда."})
+            self.send(player, {"type": "error", "msg": "Неизвестная команда."})
 
         if dirty:
-            # после каждого важного действия сразу шлём состояние уровня, чтобы всё было максимально плавно
-            self.broadcast_state_for_level(player.stage)
+            # состояние не шлём сразу: уровень помечается, и tick_loop разошлёт его
+            # один раз за тик, сколько бы команд (в первую очередь move) ни пришло
+            self.dirty_stages.add(player.stage)
+            if player.stage != stage_before:
+                self.dirty_stages.add(stage_before)
+
+    def is_admin(self, token) -> bool:
+        """Пароль оператора совпал; без --admin-token оператора нет вовсе."""
+        if not self.admin_token or not isinstance(token, str):
+            return False
+        return hmac.compare_digest(token.encode("utf-8"), self.admin_token.encode("utf-8"))
+
+    def admin_command(self, player: Player, msg: dict):
+        """Команда соединения оператора: profile — гистограммы фаз тика и
+        команд, profile_reset — начать их с чистого листа."""
+        self._admin_reply(player, msg)
+        # оператора нет в self.players — flush_outboxes до него не дойдёт
+        player.outbox.flush()
+
+    def _admin_reply(self, player: Player, msg: dict):
+        action = msg.get("action") or "profile"
+        if (msg.get("command") or "").lower() != "admin":
+            self.send(player, {"type": "error", "msg": "Соединению оператора доступна только команда admin."})
+        elif self.profiler is None:
+            self.send(player, {"type": "error", "msg": "Профиль тика выключен (--no-profile)."})
+        elif action == "profile":
+            self.send(player, {
+                "type": "admin",
+                "action": "profile",
+                "window_s": PROFILE_SLOTS * TICK_STATS_INTERVAL,
+                "tick": self.tick_stats.summary(),
+                "systems": self.systems.summary(),
+                "profile": self.profiler.summary(),
+            })
+        elif action == "profile_reset":
+            self.profiler.reset()
+            self.send(player, {"type": "admin", "action": "profile_reset"})
+        else:
+            self.send(player, {"type": "error", "msg": f"Неизвестное действие admin: {action}"})
 
     # --------- Сетевое взаимодействие ---------
 
+    def add_player_from_hello(self, hello: dict, conn, fileobj=None):
+        """Создаёт игрока по сообщению hello (в мир он попадёт в начале тика).
+
+        Возвращает None, если hello некорректен. Вызывается только потоком,
+        принимающим соединения, поэтому next_player_id без лока.
+        """
+        if not hello or hello.get("type") != "hello":
+            return None
+        if "admin" in hello:
+            # соединение оператора: в мир не входит, в запись сессии не попадает,
+            # принимает только команду admin (см. admin_command)
+            if not self.is_admin(hello.get("admin")):
+                return None
+            player = Player(0, "admin", "", conn, fileobj, now=self.clock.time())
+            player.admin = True
+            return player
+        name = hello.get("name", f"Player{self.next_player_id}")
+        cls = hello.get("class", "воин")
+        pid = self.next_player_id
+        self.next_player_id += 1
+        player = Player(pid, name, cls, conn, fileobj, now=self.clock.time())
+        if hello.get("proto") == PROTO_BINARY:
+            # бинарные кадры всегда идут дельта-снимками
+            player.proto = PROTO_BINARY
+            player.use_snapshots = True
+        else:
+            player.use_snapshots = bool(hello.get("snapshots"))
+        self.create_player_stats(player)
+        return player
+
+    def on_player_connected(self, player: Player):
+        if player.admin:
+            print("[ADMIN] подключился оператор", flush=True)
+            return
+        self.inbox.append(("join", player, None))
+
+    def on_player_disconnected(self, player: Player):
+        player.outbox.close()
+        try:
+            player.conn.close()
+        except Exception:
+            pass
+        print(f"[NET] {player.name} отключился, очередь: {player.outbox.stats()}", flush=True)
+        if not player.admin:
+            self.inbox.append(("leave", player, None))
+
+    def on_client_message(self, player: Player, msg: dict):
+        mtype = msg.get("type")
+        if mtype == "command":
+            self.inbox.append(("command", player, msg))
+        elif mtype == "ack":
+            # подтверждение снимка — просто запоминаем номер, лок не нужен:
+            # send_state сам проверит, что такой снимок ещё есть в истории
+            try:
+                player.snap_acked = int(msg.get("seq"))
+            except (TypeError, ValueError):
+                pass
+        elif mtype == "resync":
+            # клиент потерял базу — следующий снимок будет полным
+            player.snap_acked = None
+
     def client_thread(self, player: Player):
         f = player.file
-        conn = player.conn
         try:
-            send_json(conn, {
-                "type": "welcome",
-                "msg": f"Добро пожаловать, {player.name}! Вы {player.cls}. Вы начинаете в ХАБе (уровень 0).",
-                "player_id": player.id
-            })
-            self.send_state(player)
-            self.broadcast_event(f"{player.name} подключился как {player.cls}.", stage=player.stage)
+            self.on_player_connected(player)
 
             while self.running:
-                msg = recv_json_line(f)
+                msg = recv_message(f)
                 if msg is None:
                     break
-                if msg.get("type") == "command":
-                    with self.lock:
-                        self.handle_command(player, msg)
+                self.on_client_message(player, msg)
         except Exception:
             traceback.print_exc()
         finally:
-            with self.lock:
-                if player.id in self.players:
-                    del self.players[player.id]
-            try:
-                conn.close()
-            except Exception:
-                pass
-            self.broadcast_event(f"{player.name} отключился от сервера.", stage=player.stage)
+            self.on_player_disconnected(player)
+
+    def apply_inbox(self):
+        """Начало тика: применяет по порядку всё, что сетевые потоки положили в inbox.
+
+        Разбираем только то, что лежало к началу, чтобы поток команд не
+        задержал тик бесконечно.
+        """
+        started = time.perf_counter()
+        count = len(self.inbox)
+        recorder = self.recorder
+        profiler = self.profiler
+        for _ in range(count):
+            kind, player, msg = self.inbox.popleft()
+            if kind == "command":
+                if player.admin:
+                    self.admin_command(player, msg)
+                elif player.id in self.players:
+                    cmd = str(msg.get("command") or "").lower()
+                    if recorder is not None:
+                        recorder.command(self.tick_count, player, msg)
+                    t0 = time.perf_counter()
+                    try:
+                        self.handle_command(player, msg)
+                    except Exception:
+                        # кривая команда одного клиента не должна сорвать весь тик
+                        traceback.print_exc()
+                    if profiler is not None:
+                        profiler.add_command(cmd, time.perf_counter() - t0)
+            elif kind == "join":
+                if recorder is not None:
+                    recorder.join(self.tick_count, player)
+                self.join_player(player)
+            elif kind == "leave":
+                if recorder is not None and player.id in self.players:
+                    recorder.leave(self.tick_count, player)
+                self.leave_player(player)
+        if recorder is not None:
+            recorder.flush()
+        spent = time.perf_counter() - started
+        self.inbox_applied += count
+        self.inbox_seconds += spent
+        if profiler is not None:
+            profiler.add("inbox", spent)
+
+    def join_player(self, player: Player):
+        self.players[player.id] = player
+        self.names.acquire(player.name)
+        self.place_player(player)
+        # welcome всегда JSON-строкой: клиент переключается на бинарные кадры,
+        # только увидев в нём proto
+        self.send_raw(player, "welcome", encode_json({
+            "type": "welcome",
+            "msg": f"Добро пожаловать, {player.name}! Вы {player.cls}. Вы начинаете в ХАБе (уровень 0).",
+            "player_id": player.id,
+            "proto": player.proto,
+        }))
+        self.send_state(player)
+        self.broadcast_event(f"{player.name} подключился как {player.cls}.", stage=player.stage)
+
+    def leave_player(self, player: Player):
+        if self.players.pop(player.id, None) is None:
+            return
+        self.names.release(player.name)
+        self.unplace_player(player)
+        self.timers.cancel(player.respawn_timer)
+        player.respawn_timer = None
+        self.broadcast_event(f"{player.name} отключился от сервера.", stage=player.stage)
+
+    def flush_outboxes(self):
+        """Конец тика: всё накопленное для каждого клиента уходит одной записью."""
+        for p in self.players.values():
+            p.outbox.flush()
+
+    def writer_thread(self, player: Player):
+        """Режим threads: разбирает очередь клиента и пишет в сокет без GameServer.lock."""
+        outbox = player.outbox
+        try:
+            while True:
+                frames = outbox.take()
+                if not frames:
+                    break
+                send_frames(player.conn, frames)
+        except OSError:
+            # сокет закрыт или клиент отвалился — читатель заметит это сам
+            pass
 
     def spawn_boss10_with_circle_damage(self, lvl: LevelState, now: float):
         """Появление Изгнанника в центре круга и урон игрокам внутри круга."""
@@ -1326,30 +3204,23 @@ class GameServer:
         cy = float(circle.get("y", lvl.height / 2.0))
         radius = float(circle.get("radius", BOSS_10_SPAWN_RADIUS_TILES))
 
-        radius2 = radius * radius
-
         # Урон игрокам, стоящим в круге: 50% текущего HP, минимум 1
-        for p in self.players.values():
-            if p.stage != stage or not p.alive:
-                continue
-            dx = p.x - cx
-            dy = p.y - cy
-            if dx * dx + dy * dy <= radius2:
-                dmg = max(1, int(p.hp * BOSS_10_RESPAWN_DAMAGE_FRACTION))
-                p.hp -= dmg
-                if p.hp <= 0:
-                    p.hp = 0
-                    p.alive = False
-                    p.dead_since = now
-                    self.broadcast_event(
-                        f"{p.name} был сожжён зелёным пламенем при возвращении Изгнанника.",
-                        stage=stage,
-                    )
-                p.last_damage_time = now
+        for p in lvl.player_grid.query_radius(cx, cy, radius, pred=_is_alive_player):
+            dmg = max(1, int(p.hp * BOSS_10_RESPAWN_DAMAGE_FRACTION))
+            p.hp -= dmg
+            if p.hp <= 0:
+                p.hp = 0
+                self.set_alive(p, False, now)
+                p.dead_since = now
+                self.broadcast_event(
+                    f"{p.name} был сожжён зелёным пламенем при возвращении Изгнанника.",
+                    stage=stage,
+                )
+            p.last_damage_time = now
 
         # Спавним самого Изгнанника в центре круга
         enemy = self._make_enemy("Изгнанник", "melee", 500, 60, 4, cx, cy, boss=True)
-        lvl.enemies.append(enemy)
+        lvl.add_enemy(enemy)
         lvl.boss_alive = True
         lvl.boss_phase = 1
         lvl.boss_spawn_pending = False
@@ -1360,49 +3231,33 @@ class GameServer:
 
         self.broadcast_event("Изгнанник восстаёт из зелёного пламени!", stage=stage)
 
-    def update_boss10_respawn(self, lvl: LevelState, now: float):
+    def boss10_died(self, lvl: LevelState, now: float):
+        """Изгнанник повержен: сбрасываем его состояние и ставим таймер
+        возвращения через BOSS_10_RESPAWN_INTERVAL (старый, если был, отменяется)."""
+        lvl.boss_alive = False
+        lvl.boss_phase = None
+        lvl.boss_last_death_time = now
+        lvl.boss_spawn_pending = False
+        lvl.boss_spawn_circle = None
+        # убираем круг появления из списка опасностей, если он вдруг остался
+        lvl.hazards = [h for h in lvl.hazards if h.get("type") != "boss10_spawn"]
+        self.schedule_level(lvl, "boss", now + BOSS_10_RESPAWN_INTERVAL, self.boss10_telegraph)
+
+    def boss10_telegraph(self, lvl: LevelState, now: float):
         """
-        Особая логика респавна Изгнанника на 10 уровне:
-        - если босс жив — ничего не делаем;
-        - после смерти ждём 30 минут;
-        - затем показываем зелёный круг (фаза 0) на 10 секунд;
-        - после чего босс появляется в центре круга.
+        Особая логика респавна Изгнанника на 10 уровне (таймер "boss"):
+        - через 30 минут после смерти показываем зелёный круг (фаза 0);
+        - через BOSS_10_SPAWN_TELEGRAPH секунд босс появляется в центре круга
+          (boss10_spawn).
         """
         stage = lvl.stage
 
-        # 1) Проверяем, жив ли сейчас босс по факту
-        boss_alive_now = any(e.hp > 0 and e.boss for e in lvl.enemies)
-        if boss_alive_now:
+        # Если босс по факту жив (например, уровень пересоздан) — респавнить нечего
+        if any(e.boss for e in lvl.enemy_by_id.values()):
             lvl.boss_alive = True
-            lvl.boss_spawn_pending = False
-            lvl.boss_spawn_circle = None
-            # на всякий случай чистим круг появления
-            lvl.hazards = [h for h in lvl.hazards if h.get("type") != "boss10_spawn"]
             return
 
-        # Босс считаем мёртвым
-        lvl.boss_alive = False
-
-        # 2) Если уже идёт телеграф круга появления — ждём окончания 10 секунд
-        circle = lvl.boss_spawn_circle
-        if lvl.boss_spawn_pending and circle:
-            start_time = circle.get("start_time", now)
-            elapsed = now - start_time
-            if elapsed >= BOSS_10_SPAWN_TELEGRAPH:
-                # время спавнить босса
-                self.spawn_boss10_with_circle_damage(lvl, now)
-            return
-
-        # 3) Если босс ещё ни разу не умирал — нечего респавнить
-        if lvl.boss_last_death_time <= 0.0:
-            return
-
-        # 4) Ждём 30 минут с момента последней смерти
-        elapsed_since_death = now - lvl.boss_last_death_time
-        if elapsed_since_death < BOSS_10_RESPAWN_INTERVAL:
-            return
-
-        # 5) Запускаем телеграф круга появления в центре карты
+        # Запускаем телеграф круга появления в центре карты
         cx = lvl.width / 2.0
         cy = lvl.height / 2.0
 
@@ -1424,148 +3279,359 @@ class GameServer:
             "Под ногами вспыхивает зелёное пламя — Изгнанник готовится вернуться...",
             stage=stage,
         )
+        self.schedule_level(lvl, "boss", now + BOSS_10_SPAWN_TELEGRAPH, self.boss10_spawn)
+
+    def boss10_spawn(self, lvl: LevelState, now: float):
+        if not lvl.boss_spawn_pending:
+            return
+        self.spawn_boss10_with_circle_damage(lvl, now)
 
 
 
     def tick_loop(self):
+        """Планировщик тиков с фиксированным шагом TICK_INTERVAL.
+
+        Спим до следующего дедлайна, а не TICK_INTERVAL после работы, поэтому
+        период не растёт под нагрузкой. Опоздали на несколько шагов — догоняем
+        подряд до TICK_MAX_CATCHUP шагов, остальное пропускаем и считаем в
+        tick_stats. Что именно делать на шаге, решает self.systems: у каждой
+        подсистемы своя частота (см. SYSTEM_RATES).
+        """
+        interval = TICK_INTERVAL
+        next_tick = time.monotonic() + interval
         while self.running:
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            started = time.monotonic()
+            lateness = max(0.0, started - next_tick)
+            behind = int(lateness // interval)
+            steps = 1 + min(behind, TICK_MAX_CATCHUP - 1)
+            skipped = behind - (steps - 1)
             try:
-                time.sleep(TICK_INTERVAL)
                 with self.lock:
-                    now = time.time()
-                    # проверяем мёртвых на рестарт + реген
-                    for p in list(self.players.values()):
-                        if not p.alive and p.dead_since is not None:
-                            if now - p.dead_since >= DEATH_TIMEOUT:
-                                self.respawn_to_start(p)
-                                self.send_state(p)
-
-                        if p.alive:
-                            # реген маны
-                            if now - p.last_mana_spent_time >= MANA_REGEN_DELAY:
-                                if now - p.last_mana_regen_time >= 1.0 and p.mana < p.max_mana:
-                                    p.mana += MANA_REGEN_STEP
-                                    if p.mana > p.max_mana:
-                                        p.mana = p.max_mana
-                                    p.last_mana_regen_time = now
-                            # реген HP
-                            idle_time = now - max(p.last_damage_time, p.last_attack_time)
-                            if idle_time >= HP_REGEN_DELAY:
-                                if now - p.last_hp_regen_time >= 1.0 and p.hp < p.max_hp:
-                                    p.hp += HP_REGEN_STEP
-                                    if p.hp > p.max_hp:
-                                        p.hp = p.max_hp
-                                    p.last_hp_regen_time = now
-
-                            # канал длительных способностей (щит воина по мане)
-                            if (p.cls or "").lower() == "воин" and getattr(p, "special_active", False):
-                                lvl_p = self.get_level(p.stage)
-                                if now - p.special_last_tick >= 1.0:
-                                    if p.mana > 0:
-                                        p.mana -= 1
-                                        if p.mana < 0:
-                                            p.mana = 0
-                                        p.last_mana_spent_time = now
-                                        p.special_last_tick = now
-                                        # продлеваем щит ещё немного, пока идёт канал
-                                        lvl_p.shield_buff_until = now + 1.5
-                                    else:
-                                        p.special_active = False
-                                        p.special_mode = None
-                                        self.broadcast_event(
-                                            f"Щит {p.name} исчез — мана исчерпана.",
-                                            stage=p.stage,
-                                        )
-
-                    # движение, автоатака врагов и респавн
-                    for stage, lvl in self.levels.items():
-                        # ХАБ пропускаем
-                        if stage == 0 or stage == 11:
-                            continue
-
-                        # есть ли живые игроки на уровне
-                        has_players = any(
-                            p.stage == stage and p.alive
-                            for p in self.players.values()
+                    self.tick(self.clock.time(), steps)
+            except Exception:
+                traceback.print_exc()
+            next_tick += (steps + skipped) * interval
+            self.tick_stats.record(time.monotonic() - started, lateness, steps, skipped)
+            if self.tick_stats.window() >= TICK_STATS_INTERVAL:
+                print(f"[TICK] {self.tick_stats.summary()}", flush=True)
+                print(f"[SYSTEMS] {self.systems.summary()}", flush=True)
+                self.tick_stats.reset()
+                self.systems.reset_stats()
+                if self.profiler is not None:
+                    # профиль пишет только этот поток — лок не нужен
+                    print(f"[PROFILE] {self.profiler.summary()}", flush=True)
+                    self.profiler.rotate()
+
+    def tick(self, now: float, steps: int = 1):
+        """Один тик tick_loop (вызывать под self.lock): входящие, затем steps шагов подсистем."""
+        started = time.perf_counter()
+        # команды и входы/выходы, пришедшие с прошлого тика
+        self.apply_inbox()
+        for i in range(steps):
+            # догоняющие шаги идут «в прошлом», как если бы успели вовремя
+            self.systems.run(now - (steps - 1 - i) * TICK_INTERVAL)
+        self.tick_count += steps
+        if self.profiler is not None:
+            self.profiler.add("tick", time.perf_counter() - started)
+
+    def start_recording(self, path):
+        """Включает запись сессии в path (см. SessionRecorder); вызывать до run()."""
+        self.recorder = SessionRecorder(path, {
+            "seed": self.seed,
+            "start": self.clock.time(),
+            "tick": self.tick_count,
+            "tick_interval": TICK_INTERVAL,
+            "rates": {system.name: round(1.0 / system.period, 6) for system in self.systems.systems},
+            "evict_after": self.level_evict_after,
+            "enemy_arrays": self.enemy_arrays,
+        })
+
+    def simulate(self, seconds: float, feed=None):
+        """Гоняет тики подряд без сна, двигая self.clock (VirtualClock) на
+        TICK_INTERVAL за тик; сокетов нет, очереди клиентов выбрасываются.
+        feed(tick_count), если задан, перед каждым тиком кладёт в inbox
+        то, что должно прийти к этому тику (повтор записи).
+        Возвращает число тиков."""
+        # бюджеты меряются настоящим временем — в симуляции откладывание отключено,
+        # иначе от загрузки машины зависело бы, какие подсистемы отложатся
+        self.systems.throttle = False
+        ticks = int(round(seconds / TICK_INTERVAL))
+        for _ in range(ticks):
+            started = time.perf_counter()
+            if feed is not None:
+                feed(self.tick_count)
+            self.clock.advance(TICK_INTERVAL)
+            with self.lock:
+                self.tick(self.clock.time())
+            self.drain_outboxes()
+            self.tick_stats.record(time.perf_counter() - started, 0.0, 1, 0)
+        return ticks
+
+    def drain_outboxes(self):
+        """Клиенты без сокета «прочитали» всё и подтвердили последний снимок."""
+        for p in self.players.values():
+            p.outbox.flush()
+            p.outbox.take(block=False)
+            if p.snap_seq:
+                p.snap_acked = p.snap_seq
+
+    def system_movement(self, now: float, dt: float):
+        """Движение игроков по вводу и ближников к целям (фиксированный шаг dt)."""
+        for p in self.players.values():
+            self.integrate_movement(p, dt)
+        for stage, lvl in self.active_levels():
+            # между командами и проходами — единственное место, где view врагов можно пересобрать
+            lvl.compact_enemies()
+            if lvl.enemies_alive():
+                if now - lvl.last_enemy_move >= ENEMY_MOVE_INTERVAL:
+                    t0 = time.perf_counter()
+                    self.enemies_move_level(stage)
+                    if self.profiler is not None:
+                        self.profiler.add("enemies_move_level", time.perf_counter() - t0)
+                    lvl.last_enemy_move = advance_timer(lvl.last_enemy_move, now, ENEMY_MOVE_INTERVAL)
+
+    def system_enemy_attacks(self, now: float, dt: float):
+        """Автоатака врагов: каждый уровень не чаще ENEMY_ATTACK_DELAY."""
+        for stage, lvl in self.active_levels():
+            if lvl.enemies_alive() and now - lvl.last_enemy_attack >= ENEMY_ATTACK_DELAY:
+                t0 = time.perf_counter()
+                self.enemies_attack_level(stage, now)
+                if self.profiler is not None:
+                    self.profiler.add("enemies_attack_level", time.perf_counter() - t0)
+
+    def system_regen(self, now: float, dt: float):
+        """Реген HP/MP и расход маны на щит воина — всё это действует раз в секунду."""
+        for p in list(self.players.values()):
+            if not p.alive:
+                continue
+            # реген маны
+            if now - p.last_mana_spent_time >= MANA_REGEN_DELAY:
+                if now - p.last_mana_regen_time >= 1.0 and p.mana < p.max_mana:
+                    p.mana += MANA_REGEN_STEP
+                    if p.mana > p.max_mana:
+                        p.mana = p.max_mana
+                    p.last_mana_regen_time = advance_timer(p.last_mana_regen_time, now, 1.0)
+            # реген HP
+            idle_time = now - max(p.last_damage_time, p.last_attack_time)
+            if idle_time >= HP_REGEN_DELAY:
+                if now - p.last_hp_regen_time >= 1.0 and p.hp < p.max_hp:
+                    p.hp += HP_REGEN_STEP
+                    if p.hp > p.max_hp:
+                        p.hp = p.max_hp
+                    p.last_hp_regen_time = advance_timer(p.last_hp_regen_time, now, 1.0)
+
+            # канал длительных способностей (щит воина по мане)
+            if (p.cls or "").lower() == "воин" and getattr(p, "special_active", False):
+                lvl_p = self.get_level(p.stage)
+                if now - p.special_last_tick >= 1.0:
+                    if p.mana > 0:
+                        p.mana -= 1
+                        if p.mana < 0:
+                            p.mana = 0
+                        p.last_mana_spent_time = now
+                        p.special_last_tick = advance_timer(p.special_last_tick, now, 1.0)
+                        # продлеваем щит ещё немного, пока идёт канал
+                        lvl_p.shield_buff_until = now + 1.5
+                    else:
+                        p.special_active = False
+                        p.special_mode = None
+                        self.broadcast_event(
+                            f"Щит {p.name} исчез — мана исчерпана.",
+                            stage=p.stage,
                         )
 
-                        # --- движение ближников ---
-                        if lvl.enemies_alive() and has_players:
-                            if now - lvl.last_enemy_move >= ENEMY_MOVE_INTERVAL:
-                                self.enemies_move_level(stage)
-                                lvl.last_enemy_move = now
-
-                        # --- атака врагов ---
-                        if lvl.enemies_alive() and has_players and \
-                                now - lvl.last_enemy_attack >= ENEMY_ATTACK_DELAY:
-                            self.enemies_attack_level(stage)
-
-                        # если игроков нет — дальше ничего не делаем для уровня
-                        if not has_players:
-                            continue
-
-                        # --- логика респавна волн / двери (оставляем как было) ---
-
-                        if stage == 10:
-                            self.update_boss10_respawn(lvl, now)
-                        else:
-                            # Обычная логика волн и двери
-                            if lvl.door_x is None:
-                                # волны до появления двери
-                                if lvl.enemies_alive():
-                                    if now - lvl.last_respawn >= RESPWAN_INTERVAL:
-                                        lvl.enemies = self.generate_enemies(stage)
-                                        lvl.last_respawn = now
-                                        self.broadcast_event(
-                                            f"На уровне {stage} появились новые враги!",
-                                            stage=stage,
-                                        )
-                                else:
-                                    # если все враги умерли до появления двери — можно открыть дверь
-                                    self.check_and_open_door(stage)
-                            else:
-                                # после того как дверь появилась, волны идут раз в 2 минуты,
-                                # если уровень не зачищен
-                                if not lvl.enemies_alive():
-                                    if now - lvl.last_respawn >= DOOR_RESPAWN_INTERVAL and not lvl.completed:
-                                        lvl.enemies = self.generate_enemies(stage)
-                                        lvl.last_respawn = now
-                                        lvl.door_open = False
-                                        self.broadcast_event(
-                                            f"На уровне {stage} дверь закрывается, появляются новые враги!",
-                                            stage=stage,
-                                        )
-
-                        """
-                        Старая логика респавна / не рассчитана на босса
-                        """
-                        # if lvl.door_x is None:
-                        #     # обычный уровень без двери: волна врагов каждые RESPAWN_INTERVAL, пока враги ещё есть
-                        #     if lvl.enemies_alive() and now - lvl.last_respawn >= RESPAWN_INTERVAL:
-                        #         lvl.enemies = self.generate_enemies(stage)
-                        #         lvl.last_enemy_attack = now
-                        #         lvl.last_respawn = now
-                        #         self.broadcast_event(f"Враги на уровне {stage} возродились!", stage=stage)
-                        # else:
-                        #     # уровень с дверью: каждые DOOR_RESPAWN_INTERVAL после зачистки появляется новая волна,
-                        #     # дверь закрывается, пока враги живы
-                        #     if (not lvl.enemies_alive()) and now - lvl.last_respawn >= DOOR_RESPAWN_INTERVAL:
-                        #         lvl.enemies = self.generate_enemies(stage)
-                        #         lvl.last_enemy_attack = now
-                        #         lvl.last_respawn = now
-                        #         lvl.door_open = False
-                        #         self.broadcast_event(f"На уровне {stage} дверь захлопнулась, враги вернулись!", stage=stage)
-
-
-                    # обновляем состояние для всех уровней, где есть игроки
-                    stages = {p.stage for p in self.players.values()}
-                    for st in stages:
-                        self.broadcast_state_for_level(st)
+    def system_timers(self, now: float, dt: float):
+        """Сработавшие таймеры: рестарт долго мёртвых, волны врагов,
+        возвращение Изгнанника. Пока сроки не подошли — одна проверка вершины кучи."""
+        self.timers.run_due(now)
+
+    def system_network(self, now: float, dt: float):
+        self.emit_state(now)
+
+    def emit_state(self, now: float = None):
+        """Рассылка состояния: ровно одна на уровень за тик (где есть игроки
+        и где что-то поменяли команды), затем сброс очередей в сокеты."""
+        stages = {st for st, ps in self.players_by_stage.items() if ps} | self.dirty_stages
+        self.dirty_stages.clear()
+        profiler = self.profiler
+        for st in stages:
+            t0 = time.perf_counter()
+            self.broadcast_state_for_level(st, now)
+            if profiler is not None:
+                profiler.add("broadcast_state_for_level", time.perf_counter() - t0)
+        t0 = time.perf_counter()
+        self.flush_outboxes()
+        if profiler is not None:
+            profiler.add("flush_outboxes", time.perf_counter() - t0)
+
+    def serve_threads(self, listener):
+        """Старый режим: accept в этом потоке, на каждого клиента — поток чтения и поток записи."""
+        while self.running:
+            conn, addr = listener.accept()
+            # отключаем Nagle, чтобы уменьшить задержки отправки маленьких пакетов
+            try:
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except Exception:
+                pass
+            f = conn.makefile("rb")
+            try:
+                hello = recv_message(f)
+                player = self.add_player_from_hello(hello, conn, f)
+                if player is None:
+                    conn.close()
+                    continue
+                threading.Thread(target=self.writer_thread, args=(player,), daemon=True).start()
+                threading.Thread(target=self.client_thread, args=(player,), daemon=True).start()
             except Exception:
                 traceback.print_exc()
+                conn.close()
+
+    def serve_select(self, listener):
+        """Один цикл на selectors владеет всеми сокетами: без потоков на клиента.
+
+        Сокеты неблокирующие, входящие строки собираются в буфере SelectConn.
+        Игровой поток только кладёт кадры в Outbox и будит цикл через
+        socketpair, а запись в сокеты делает сам цикл.
+        """
+        sel = selectors.DefaultSelector()
+        listener.setblocking(False)
+        sel.register(listener, selectors.EVENT_READ, None)
+
+        wake_r, wake_w = socket.socketpair()
+        wake_r.setblocking(False)
+        wake_w.setblocking(False)
+        sel.register(wake_r, selectors.EVENT_READ, "wake")
+        self._select_wake_sock = wake_w
+        self._select_wake_lock = threading.Lock()
+        self._select_ready = set()
+
+        try:
+            while self.running:
+                for key, mask in sel.select(timeout=1.0):
+                    if key.data is None:
+                        self._select_accept(sel, key.fileobj)
+                    elif key.data == "wake":
+                        self._select_on_wake(sel, wake_r)
+                    else:
+                        sc = key.data
+                        if mask & selectors.EVENT_READ:
+                            self._select_read(sel, sc)
+                        if mask & selectors.EVENT_WRITE and sc.player is not None:
+                            self._select_write(sel, sc)
+        finally:
+            sel.close()
+            wake_r.close()
+            wake_w.close()
+
+    def _select_notify(self, sc: SelectConn):
+        """Вызывается из игрового потока: у клиента появились кадры для отправки."""
+        with self._select_wake_lock:
+            first = not self._select_ready
+            self._select_ready.add(sc)
+        if first:
+            try:
+                self._select_wake_sock.send(b"\0")
+            except (BlockingIOError, OSError):
+                pass
 
+    def _select_on_wake(self, sel, wake_r):
+        try:
+            while wake_r.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        with self._select_wake_lock:
+            ready = self._select_ready
+            self._select_ready = set()
+        for sc in ready:
+            if sc.player is not None:
+                self._select_write(sel, sc)
+
+    def _select_accept(self, sel, listener):
+        try:
+            conn, addr = listener.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        conn.setblocking(False)
+        try:
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except Exception:
+            pass
+        sel.register(conn, selectors.EVENT_READ, SelectConn(conn, addr))
 
-    def run(self, host="0.0.0.0", port=5000):
+    def _select_read(self, sel, sc: SelectConn):
+        try:
+            data = sc.sock.recv(NET_RECV_CHUNK)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        try:
+            if not data:
+                self._select_close(sel, sc)
+                return
+            for msg in sc.feed(data):
+                if sc.player is None:
+                    sc.player = self.add_player_from_hello(msg, sc.sock)
+                    if sc.player is None:
+                        self._select_close(sel, sc)
+                        return
+                    sc.player.outbox.on_ready = lambda sc=sc: self._select_notify(sc)
+                    self.on_player_connected(sc.player)
+                else:
+                    self.on_client_message(sc.player, msg)
+        except Exception:
+            traceback.print_exc()
+            self._select_close(sel, sc)
+
+    def _select_write(self, sel, sc: SelectConn):
+        """Пишет сколько примет сокет; остаток ждёт EVENT_WRITE.
+
+        Из Outbox забираем новые кадры только когда старый буфер ушёл целиком,
+        чтобы у отстающего клиента state продолжал вытесняться в очереди.
+        """
+        try:
+            while True:
+                if not sc.outbuf:
+                    frames = sc.player.outbox.take(block=False)
+                    if not frames:
+                        break
+                    sc.outbuf = b"".join(frames)
+                sent = sc.sock.send(sc.outbuf)
+                sc.outbuf = sc.outbuf[sent:]
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            self._select_close(sel, sc)
+            return
+        want_write = bool(sc.outbuf)
+        if want_write != sc.want_write:
+            sc.want_write = want_write
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if want_write else 0)
+            try:
+                sel.modify(sc.sock, events, sc)
+            except (KeyError, ValueError):
+                pass
+
+    def _select_close(self, sel, sc: SelectConn):
+        try:
+            sel.unregister(sc.sock)
+        except (KeyError, ValueError):
+            pass
+        if sc.player is not None:
+            sc.player.outbox.on_ready = None
+            self.on_player_disconnected(sc.player)
+            sc.player = None
+        else:
+            try:
+                sc.sock.close()
+            except Exception:
+                pass
+
+    def run(self, host="0.0.0.0", port=5000, net_mode="threads"):
         tick_thread = threading.Thread(target=self.tick_loop, daemon=True)
         tick_thread.start()
 
@@ -1573,41 +3639,106 @@ class GameServer:
             s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             s.bind((host, port))
             s.listen()
-            print(f"Сервер запущен на {host}:{port}", flush=True)
-            while True:
-                conn, addr = s.accept()
-                # отключаем Nagle, чтобы уменьшить задержки отправки маленьких пакетов
-                try:
-                    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-                except Exception:
-                    pass
-                f = conn.makefile("r", encoding="utf-8")
-                try:
-                    hello = recv_json_line(f)
-                    if not hello or hello.get("type") != "hello":
-                        conn.close()
-                        continue
-                    name = hello.get("name", f"Player{self.next_player_id}")
-                    cls = hello.get("class", "воин")
-                    with self.lock:
-                        pid = self.next_player_id
-                        self.next_player_id += 1
-                        player = Player(pid, name, cls, conn, f)
-                        self.create_player_stats(player)
-                        self.players[pid] = player
-                    t = threading.Thread(target=self.client_thread, args=(player,), daemon=True)
-                    t.start()
-                except Exception:
-                    traceback.print_exc()
-                    conn.close()
+            print(f"Сервер запущен на {host}:{port} (сеть: {net_mode})", flush=True)
+            if net_mode == "select":
+                self.serve_select(s)
+            else:
+                self.serve_threads(s)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Сервер «Башни Забытого Пламени»")
+    parser.add_argument("host", nargs="?", default="0.0.0.0")
+    parser.add_argument("port", nargs="?", type=int, default=5000)
+    parser.add_argument(
+        "--net", choices=NET_MODES, default="threads",
+        help="сетевое ядро: поток на клиента (threads) или единый цикл selectors (select)",
+    )
+    parser.add_argument(
+        "--rate", action="append", default=[], metavar="ИМЯ=ГЦ",
+        help="частота подсистемы тика, например network=15; имена: " + ", ".join(SYSTEM_RATES),
+    )
+    parser.add_argument(
+        "--evict-after", type=float, default=LEVEL_EVICT_AFTER, metavar="СЕК",
+        help="через сколько секунд без игроков выгружать уровень (по умолчанию %(default)s)",
+    )
+    parser.add_argument(
+        "--enemy-arrays", action="store_true",
+        help="хранить врагов столбцами NumPy и двигать/бить волну векторно (нужен numpy)",
+    )
+    parser.add_argument("--seed", type=int, help="зерно случайности игры (по умолчанию случайное)")
+    parser.add_argument("--admin-token", metavar="ПАРОЛЬ",
+                        help="пускать соединения оператора (client/admin.py, профиль тика) с этим ПАРОЛЕМ")
+    parser.add_argument("--no-profile", action="store_true",
+                        help="не вести гистограммы фаз тика и команд ([PROFILE], admin profile)")
+    parser.add_argument("--record", metavar="ФАЙЛ",
+                        help="дописывать в ФАЙЛ принятые hello/command для replay.py")
+    parser.add_argument(
+        "--simulate", type=float, metavar="СЕК",
+        help="без сети прогнать СЕК секунд игры на виртуальных часах так быстро, как получится",
+    )
+    parser.add_argument("--sim-players", type=int, default=0, help="сколько игроков в --simulate")
+    parser.add_argument("--sim-stage", type=int, default=1, help="на какой этаж их поставить")
+    args = parser.parse_args(argv)
+    if args.enemy_arrays and np is None:
+        parser.error("--enemy-arrays требует numpy")
+    rates = {}
+    for item in args.rate:
+        name, _, value = item.partition("=")
+        try:
+            rate = float(value)
+        except ValueError:
+            rate = 0.0
+        if name not in SYSTEM_RATES or rate <= 0:
+            parser.error(f"неверная частота подсистемы: {item}")
+        rates[name] = rate
+    args.rate = rates
+    return args
+
+
+def add_sim_players(server, count, stage):
+    """Игроки для --simulate: классы по кругу, сразу на этаже stage."""
+    classes = ("воин", "лучник", "маг", "хилер")
+    for i in range(count):
+        hello = {"type": "hello", "name": f"Sim{i + 1}", "class": classes[i % len(classes)], "snapshots": True}
+        player = server.add_player_from_hello(hello, NullConn())
+        server.join_player(player)
+        w, h = server.get_map_size_for_stage(stage)
+        player.stage = stage
+        player.x = server.rng.uniform(0, w - 1)
+        player.y = server.rng.uniform(0, h - 1)
+        server.place_player(player)
+
+
+def run_simulation(server, seconds, players, stage):
+    add_sim_players(server, players, stage)
+    started = time.perf_counter()
+    ticks = server.simulate(seconds)
+    wall = time.perf_counter() - started
+    alive = sum(1 for p in server.players.values() if p.alive)
+    print(f"[SIM] {seconds:.0f} с игры за {wall:.2f} с ({seconds / max(wall, 1e-9):.0f}x), "
+          f"тиков {ticks}, seed {server.seed}, живы {alive}/{len(server.players)}, "
+          f"уровни {sorted(server.levels)}", flush=True)
+    print(f"[TICK] {server.tick_stats.summary()}", flush=True)
+    print(f"[SYSTEMS] {server.systems.summary()}", flush=True)
+    if server.profiler is not None:
+        print(f"[PROFILE] {server.profiler.summary()}", flush=True)
 
 
 if __name__ == "__main__":
-    host = "0.0.0.0"
-    port = 5000
-    if len(sys.argv) >= 2:
-        host = sys.argv[1]
-    if len(sys.argv) >= 3:
-        port = int(sys.argv[2])
-    server = GameServer()
-    server.run(host, port)
+    args = parse_args(sys.argv[1:])
+    clock = VirtualClock() if args.simulate else None
+    server = GameServer(clock=clock, seed=args.seed)
+    for name, rate in args.rate.items():
+        server.systems.set_rate(name, rate)
+    server.level_evict_after = args.evict_after
+    server.enemy_arrays = args.enemy_arrays
+    server.admin_token = args.admin_token
+    if args.no_profile:
+        server.profiler = server.systems.profiler = None
+    if args.record:
+        server.start_recording(args.record)
+    if args.simulate:
+        run_simulation(server, args.simulate, args.sim_players, args.sim_stage)
+    else:
+        server.run(args.host, args.port, net_mode=args.net)